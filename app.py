@@ -1,15 +1,23 @@
-from waitress import serve
-from flask import Flask, render_template, request, redirect, session, flash, send_file
-from forms import AddLoginForm, AddSignUpForm, AddDelAccForm, AddSelectionForm, AddImportForm
-from models import db, connect_db, User, Subscription, LikedVideo, Playlist, PlaylistVideo, Credential
-from flask_bcrypt import Bcrypt
+from waitress import create_server
+from waitress.task import ThreadedTaskDispatcher
+from flask import Flask, Response, render_template, request, redirect, session, flash, jsonify, stream_with_context, g
+from forms import AddLoginForm, AddSignUpForm, AddDelAccForm, AddSelectionForm, AddImportForm, AddMigrateForm, AddCancelJobForm, AddResumeJobForm
+from models import db, connect_db, User, Credential, Job
 import datetime
 import jwt
 from functools import wraps
 import os
 import ytmapi
+import jobs
+import quota
+import selection
+import downloads
+import listings
+import metrics
+import passwords
 import json
-import tempfile
+import threading
+import time
 
 app = Flask(__name__)
 
@@ -22,13 +30,51 @@ PORT = os.environ['PORT']
 # App config
 app.config['SQLALCHEMY_DATABASE_URI'] = DATABASE_URL
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
-app.config['SQLALCHEMY_ECHO'] = True
+app.config['SQLALCHEMY_ECHO'] = os.environ.get('SQLALCHEMY_ECHO', '').lower() in ('1', 'true', 'yes')
 SESSION_COOKIE_SAMESITE = 'Strict'
 
-bcrypt = Bcrypt()
+# Seconds a username's user id is remembered between requests
+USER_ID_MAX_AGE = int(os.environ.get('USER_ID_MAX_AGE', 60))
+
+# Threads serving requests
+WEB_THREADS = int(os.environ.get('WEB_THREADS', 4))
 
 connect_db(app)
 db.create_all()
+metrics.watch_queries(db.engine)
+
+# Hands requests to waitress threads, read by /metrics for thread-pool occupancy
+task_dispatcher = ThreadedTaskDispatcher()
+
+metrics.describe('http_request_seconds', 'histogram', 'Seconds each route took to build its response')
+metrics.describe('http_request_queries', 'histogram', 'Database statements run per request')
+metrics.describe('http_request_db_seconds', 'histogram', 'Seconds per request spent in the database')
+metrics.describe('waitress_threads', 'gauge', 'Threads serving requests')
+metrics.describe('waitress_threads_active', 'gauge', 'Threads busy with a request')
+metrics.describe('waitress_queue_depth', 'gauge', 'Requests waiting for a free thread')
+
+@app.before_request
+def startTimer():
+    """
+    Notes when the request started and counts its database statements from zero
+    """
+
+    g.started = time.perf_counter()
+    metrics.reset_queries()
+
+@app.after_request
+def recordTimer(response):
+    """
+    Records the route's latency and database use
+    """
+
+    route = request.endpoint or 'unknown'
+    count, seconds = metrics.query_totals()
+    metrics.observe('http_request_seconds', time.perf_counter() - g.started, route=route, method=request.method, status=response.status_code)
+    metrics.observe('http_request_queries', count, buckets=metrics.QUERY_COUNT_BUCKETS, route=route)
+    metrics.observe('http_request_db_seconds', seconds, route=route)
+
+    return response
 
 def get_session_user():
     """
@@ -43,14 +89,40 @@ def get_session_user():
     username = authtoken['user']
     return username
 
+user_ids = {}
+user_ids_lock = threading.Lock()
+
 def get_user(username):
     """
     Returns a user object
+
+    The user id behind each username is cached for USER_ID_MAX_AGE seconds, so
+    repeat visits load the user by primary key. A cached id whose user is gone
+    or renamed falls back to the username lookup.
     """
 
+    now = time.time()
+    with user_ids_lock:
+        cached = user_ids.get(username)
+    if cached is not None and cached[1] > now:
+        user = User.query.get(cached[0])
+        if user is not None and user.username == username:
+            return user
+
     user = User.query.filter_by(username=username).first_or_404()
+    with user_ids_lock:
+        user_ids[username] = (user.id, now + USER_ID_MAX_AGE)
     return user
 
+def forget_user(username):
+    """
+    Drops a username's cached user id, for when the account is deleted
+    """
+
+    with user_ids_lock:
+        user_ids.pop(username, None)
+    return
+
 def create_login_token(username):
     """
     Save login session to JWT token
@@ -69,17 +141,14 @@ def login_required(function):
     def wrapper(*args, **kwargs): 
         """
         Checks if username in JWT token is correct or sends to login screen
+
+        The user is resolved once per request and kept in g.user for the route.
         """
         try:
-            username = get_session_user()
-            user = get_user(username)
-            if user.username == username:
-                return function()
-            else:
-                return redirect('/login')
+            g.user = get_user(get_session_user())
         except:
             return redirect('/login')
-        return redirect('/login')
+        return function(*args, **kwargs)
 
     return wrapper
 
@@ -95,6 +164,18 @@ def learnmore():
 def privacyPolicy():
     return render_template('privacy_policy.html')
 
+def busy_page(template, form, errors, field):
+    """
+    Returns a login or sign-up form with a 503, for when passwords cannot be hashed right now
+    """
+
+    app.logger.exception('Password hashing unavailable')
+    errors[field]['error'] = 'Too busy to sign you in, try again in a moment'
+    errors[field]['labelclass'] = 'mdc-text-field--invalid'
+    errors[field]['icon'] = 'error'
+
+    return render_template(template, form=form, errors=errors), 503, {'Retry-After' : '5'}
+
 @app.route('/login', methods=["GET", "POST"])
 def login():
     """
@@ -125,8 +206,14 @@ def login():
         try:
             user = get_user(username)
 
-            # Password correct check
-            if bcrypt.check_password_hash(user.password_hash, password):
+            # Password correct check, off the request thread
+            matches, rehashed = passwords.check_password(user.password_hash, password)
+            if matches:
+                # Keep the stored hash at the configured work factor
+                if rehashed is not None:
+                    user.password_hash = rehashed
+                    db.session.commit()
+
                 # Provide user login token
                 create_login_token(username)
                 return redirect("/dashboard")
@@ -134,6 +221,8 @@ def login():
                 errors['password']['error'] = 'Password is incorrect!'
                 errors['password']['labelclass'] = 'mdc-text-field--invalid'
                 errors['password']['icon'] = 'error'
+        except passwords.HashingUnavailable:
+            return busy_page('login.html', form, errors, 'password')
         except:
             errors['username']['error'] = 'User does not exist!'
             errors['username']['labelclass'] = 'mdc-text-field--invalid'
@@ -181,8 +270,10 @@ def signup():
         # Condition for valid input
         if not userExists and privacyAgree:
             # Hash password
-            hash = bcrypt.generate_password_hash(password)
-            hashutf = hash.decode("utf8")
+            try:
+                hashutf = passwords.hash_password(password)
+            except passwords.HashingUnavailable:
+                return busy_page('signup.html', form, errors, 'username')
 
             # Save user to database
             newuser = User(
@@ -213,6 +304,9 @@ def authenticate():
 
     # Save current state to user's session
     session['state'] = authorization_url[1]
+
+    # Remember which account is being linked, the source unless a migration target was asked for
+    session['link_role'] = ytmapi.TARGET if request.args.get('role') == ytmapi.TARGET else ytmapi.SOURCE
     url = authorization_url[0]
 
     return redirect(url)
@@ -243,12 +337,11 @@ def auth():
     state = request.args['state']
 
     # Grab user info
-    username = get_session_user()
-    user = get_user(username)
+    user = g.user
 
     # Pass access token to api client
     credentials = ytmapi.get_access_token(auth_code, state)
-    ytmapi.save_credentials(credentials, user)
+    ytmapi.save_credentials(credentials, user, session.get('link_role', ytmapi.SOURCE))
 
     return 'Account successfully linked. You may now close this window.'
 
@@ -260,20 +353,26 @@ def dashboard():
     """
 
     # Grab user info
-    username = get_session_user()
-    user = get_user(username) 
+    user = g.user
 
-    # Grab user's data
-    likeslist = LikedVideo.query.filter_by(user_id=user.id).all()
-    subslist = Subscription.query.filter_by(user_id=user.id).all()
-    playlistlist = Playlist.query.filter_by(user_id=user.id).all()
+    # Grab the first page of each list, the browser loads the rest as it scrolls
+    likeslist, likesnext = listings.list_page(user.id, 'likes')
+    subslist, subsnext = listings.list_page(user.id, 'subscriptions')
+    playlistlist, playlistnext = listings.list_page(user.id, 'playlists')
+    activejobs = Job.query.filter_by(user_id=user.id).filter(db.or_(
+        Job.state.in_([jobs.QUEUED, jobs.RUNNING]),
+        db.and_(Job.kind.in_(jobs.RESUMABLE_KINDS), Job.state == jobs.FAILED, Job.finished_at > time.time() - jobs.RESUMABLE_FOR)
+        )).all()
 
     # Add forms
     delAccForm = AddDelAccForm()
     selectionForm = AddSelectionForm()
     importForm = AddImportForm()
+    migrateForm = AddMigrateForm()
+    cancelJobForm = AddCancelJobForm()
+    resumeJobForm = AddResumeJobForm()
 
-    return render_template('dashboard.html', subs=subslist, likes=likeslist, playlists=playlistlist, delAccForm=delAccForm, selectionForm=selectionForm, importForm=importForm)
+    return render_template('dashboard.html', subs=subslist, likes=likeslist, playlists=playlistlist, subsnext=subsnext, likesnext=likesnext, playlistnext=playlistnext, jobs=activejobs, delAccForm=delAccForm, selectionForm=selectionForm, importForm=importForm, migrateForm=migrateForm, cancelJobForm=cancelJobForm, resumeJobForm=resumeJobForm)
 
 @app.route('/delacc', methods=["POST"])
 @login_required
@@ -287,12 +386,13 @@ def delAcc():
     if delAccForm.validate_on_submit():
 
         # Grab user info
-        username = get_session_user()
-        user = get_user(username)
+        user = g.user
 
         # Delete user from DB
+        username = user.username
         db.session.delete(user)
         db.session.commit()
+        forget_user(username)
 
     return redirect("/")
 
@@ -308,8 +408,7 @@ def deleteSelection():
     if selectionform.validate_on_submit():
 
         # Grab user info
-        username = get_session_user()
-        user = get_user(username)
+        user = g.user
 
         # Grab form data
         items = request.form.to_dict()
@@ -318,17 +417,13 @@ def deleteSelection():
         except:
             pass
 
-        # Query items and delete from database
-        for item in items.keys():
-            if item[-7:] == 'videoid':
-                LikedVideo.query.filter_by(user_id=user.id).filter_by(video_id=item[:-7]).delete()
-            elif item[-7:] == 'channel':
-                Subscription.query.filter_by(user_id=user.id).filter_by(channel_id=item[:-7]).delete()
-            elif item[-7:] == 'playlis':
-                playlist = Playlist.query.filter_by(user_id=user.id).filter_by(resource_id=item[:-7]).first_or_404()
-                db.session.delete(playlist)
+        # Delete selected items from database
+        selection.delete_items(user, items.keys())
         db.session.commit()
 
+        # Deleted items must be downloaded again by the next import
+        ytmapi.forget_etags(user)
+
     return redirect("/dashboard")
 
 @app.route('/logout')
@@ -354,16 +449,15 @@ def importData():
     if importForm.validate_on_submit():
 
         # Grab user info
-        username = get_session_user()
-        user = get_user(username)
+        user = g.user
 
-        # Run api client imports for selected categories
-        if importForm.subscriptions.data:
-            ytmapi.import_subscriptions(user)
-        if importForm.likedVideos.data:
-            ytmapi.import_liked_videos(user)
-        if importForm.playlists.data:
-            ytmapi.import_playlists(user)
+        # Queue api client imports for selected categories
+        payload = {
+                'subscriptions' : importForm.subscriptions.data,
+                'likedVideos' : importForm.likedVideos.data,
+                'playlists' : importForm.playlists.data
+                }
+        jobs.enqueue_job(user, 'import', payload)
 
     return redirect('/dashboard')
 
@@ -371,7 +465,7 @@ def importData():
 @login_required
 def downloadJson():
     """
-    Form route to download selected data as a file
+    Form route to download selected data as a JSON, NDJSON or CSV file
     """
 
     # Check for CSRF
@@ -379,53 +473,27 @@ def downloadJson():
     if selectionform.validate_on_submit():
 
         # Grab user info
-        username = get_session_user()
-        user = get_user(username)
+        user = g.user
 
         # Grab form data
         items = request.form.to_dict()
+        items.pop("csrf_token", None)
+        format, _, category = items.pop("format", "json").partition(':')
+        if format not in downloads.FORMATS or (format == 'csv' and category not in downloads.CATEGORIES):
+            return redirect('/dashboard')
 
-        # Query items from form and put into dictionary
-        items.pop("csrf_token")
-        data = {
-                "liked_videos":[],
-                "subscriptions":[],
-                "playlists":[]
-                }
-        for item in items.keys():
-            if item[-7:] == 'videoid':
-                video = LikedVideo.query.filter_by(user_id=user.id).filter_by(video_id=item[:-7]).first_or_404()
-                videoDict = {
-                        'channel_title' : video.channel_title,
-                        'video_title' : video.title,
-                        'video_id' : video.video_id
-                        }
-                data['liked_videos'].append(videoDict)
-            elif item[-7:] == 'channel':
-                channel = Subscription.query.filter_by(user_id=user.id).filter_by(channel_id=item[:-7]).first_or_404()
-                channelDict = {
-                        'channel_title' : channel.title,
-                        'channel_id' : channel.channel_id
-                        }
-                data['subscriptions'].append(channelDict)
-            elif item[-7:] == 'playlis':
-                playlist = Playlist.query.filter_by(user_id=user.id).filter_by(resource_id=item[:-7]).first_or_404()
-                playlist_items = PlaylistVideo.query.filter_by(playlist_id=playlist.id).all()
-                playlist_contents = list(map(lambda x: x.video_id, playlist_items))
-                playlistDict = {
-                        'playlist_title' : playlist.title,
-                        'privacy_status' : playlist.privacy_status,
-                        'playlist_id' : playlist.resource_id,
-                        'playlist_items' : playlist_contents
-                        }
-                data['playlists'].append(playlistDict)
-
-        # Make tempfile and write dictionary as JSON
-        fd, filepath = tempfile.mkstemp()
-        with os.fdopen(fd, "w") as f:
-            json.dump(data, f)
-
-    return send_file(filepath, as_attachment=True, attachment_filename="Your_YouTube_Data.json")
+        # Compress with the best encoding the browser accepts
+        encoding = request.accept_encodings.best_match(downloads.ENCODINGS)
+
+        # Stream the file from the database as it is read
+        download, mimetype, filename = downloads.download(user.id, list(items.keys()), format, category, encoding)
+        headers = {'Content-Disposition' : 'attachment; filename=%s' % filename, 'Vary' : 'Accept-Encoding'}
+        if encoding is not None:
+            headers['Content-Encoding'] = encoding
+
+        return Response(stream_with_context(download), mimetype=mimetype, headers=headers)
+
+    return redirect('/dashboard')
 
 @app.route("/export", methods=["POST"])
 @login_required
@@ -439,33 +507,203 @@ def exportData():
     if selectionform.validate_on_submit():
 
         # Grab user info
-        username = get_session_user()
-        user = get_user(username)
+        user = g.user
 
         # Grab form data
         items = request.form.to_dict()
-        items.pop("csrf_token")
-
-        # Query items from form and export using api client
-        for item in items.keys():
-            if item[-7:] == 'videoid':
-                video = LikedVideo.query.filter_by(user_id=user.id).filter_by(video_id=item[:-7]).first_or_404()
-                ytmapi.export_rating(video, user)
-            elif item[-7:] == 'channel':
-                channel = Subscription.query.filter_by(user_id=user.id).filter_by(channel_id=item[:-7]).first_or_404()
-                try:
-                    ytmapi.export_subscription(channel, user)
-                except:
-                    pass
-            elif item[-7:] == 'playlis':
-                playlist = Playlist.query.filter_by(user_id=user.id).filter_by(resource_id=item[:-7]).first_or_404()
-                response = ytmapi.export_playlist(playlist, user)
-                playlist_items = PlaylistVideo.query.filter_by(playlist_id=playlist.id).all()
-                playlist_contents = list(map(lambda x: x.video_id, playlist_items))
-                for videoId in playlist_contents:
-                    ytmapi.export_playlist_vid(videoId, response['id'], user)
+        items.pop("csrf_token", None)
+
+        # Queue selected items for export by the worker, unless today's quota cannot cover them
+        try:
+            quota.check(jobs.estimate_export(user, items.keys()))
+            jobs.enqueue_job(user, 'export', {'items' : list(items.keys())})
+        except quota.QuotaExceeded as error:
+            flash(str(error))
+
+    return redirect('/dashboard')
+
+@app.route("/migrate", methods=["POST"])
+@login_required
+def migrateData():
+    """
+    Form route to copy selected categories from the linked account straight to the migration target account
+    """
+
+    # Check for CSRF
+    migrateForm = AddMigrateForm()
+    if migrateForm.validate_on_submit():
+
+        # Grab user info
+        user = g.user
+
+        # Queue the migration for the worker once both accounts are linked
+        if Credential.query.filter_by(user_id=user.id, role=ytmapi.TARGET).first() is None:
+            flash('Link the account to migrate to first.')
+        else:
+            payload = {
+                    'subscriptions' : migrateForm.subscriptions.data,
+                    'likedVideos' : migrateForm.likedVideos.data,
+                    'playlists' : migrateForm.playlists.data
+                    }
+            jobs.enqueue_job(user, 'migrate', payload)
 
     return redirect('/dashboard')
 
+@app.route("/quota/import")
+@login_required
+def importEstimate():
+    """
+    JSON estimate of the quota units importing each category will spend,
+    reused for IMPORT_ESTIMATE_MAX_AGE seconds
+    """
+
+    # Grab user info
+    user = g.user
+
+    estimate = ytmapi.cached_import_estimate(user)
+    quota.flush()
+
+    return jsonify(estimate=estimate, remaining=quota.remaining())
+
+@app.route("/quota/export", methods=["POST"])
+@login_required
+def exportEstimate():
+    """
+    JSON estimate of the quota units exporting the selected items will spend
+    """
+
+    # Check for CSRF
+    selectionform = AddSelectionForm()
+    if not selectionform.validate_on_submit():
+        return jsonify(error='Invalid form'), 400
+
+    # Grab user info
+    user = g.user
+
+    # Grab form data
+    items = request.form.to_dict()
+    items.pop("csrf_token", None)
+
+    return jsonify(estimate=jobs.estimate_export(user, items.keys()), remaining=quota.remaining())
+
+@app.route("/api/<category>")
+@login_required
+def listItems(category):
+    """
+    JSON page of the user's liked videos, subscriptions or playlists, after the id in ?after=
+    """
+
+    if category not in listings.LISTINGS:
+        return jsonify(error='Unknown list'), 404
+
+    # Grab user info
+    user = g.user
+
+    after = request.args.get('after', type=int)
+    limit = request.args.get('limit', type=int)
+    if limit is not None:
+        limit = min(max(limit, 1), listings.MAX_PAGE_SIZE)
+    items, cursor = listings.list_page(user.id, category, after, limit)
+
+    return jsonify(items=items, next=cursor)
+
+@app.route("/jobs")
+@login_required
+def listJobs():
+    """
+    JSON progress of the user's recent jobs
+    """
+
+    # Grab user info
+    user = g.user
+
+    recent = Job.query.filter_by(user_id=user.id).order_by(Job.created_at.desc()).limit(20).all()
+
+    return jsonify(jobs=[jobs.job_progress(job) for job in recent])
+
+@app.route("/jobs/<int:job_id>")
+@login_required
+def jobProgress(job_id):
+    """
+    JSON progress of a single job
+    """
+
+    # Grab user info
+    user = g.user
+
+    job = Job.query.filter_by(user_id=user.id).filter_by(id=job_id).first_or_404()
+
+    return jsonify(jobs.job_progress(job))
+
+@app.route("/jobs/<int:job_id>/cancel", methods=["POST"])
+@login_required
+def cancelJob(job_id):
+    """
+    Form route to cancel a queued or running job
+    """
+
+    # Check for CSRF
+    cancelJobForm = AddCancelJobForm()
+    if cancelJobForm.validate_on_submit():
+
+        # Grab user info
+        user = g.user
+
+        job = Job.query.filter_by(user_id=user.id).filter_by(id=job_id).first_or_404()
+        jobs.cancel_job(job)
+
+    return redirect('/dashboard')
+
+@app.route("/jobs/<int:job_id>/resume", methods=["POST"])
+@login_required
+def resumeJob(job_id):
+    """
+    Form route to queue a failed export or migration again from where it stopped
+    """
+
+    # Check for CSRF
+    resumeJobForm = AddResumeJobForm()
+    if resumeJobForm.validate_on_submit():
+
+        # Grab user info
+        user = g.user
+
+        job = Job.query.filter_by(user_id=user.id).filter_by(id=job_id).first_or_404()
+        jobs.resume_job(job)
+
+    return redirect('/dashboard')
+
+@app.route("/metrics")
+def metricsPage():
+    """
+    Metrics of this process in the Prometheus text format, for scrapers sending METRICS_TOKEN
+    """
+
+    if not metrics.authorized(request.headers.get('Authorization')):
+        return Response('Unauthorized', 401, {'WWW-Authenticate' : 'Bearer'})
+
+    # Thread-pool occupancy as of this request
+    with task_dispatcher.lock:
+        metrics.set_gauge('waitress_threads', len(task_dispatcher.threads) - task_dispatcher.stop_count)
+        metrics.set_gauge('waitress_threads_active', task_dispatcher.active_count)
+        metrics.set_gauge('waitress_queue_depth', len(task_dispatcher.queue))
+
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
+
+def make_server(port, threads=WEB_THREADS):
+    """
+    Returns a waitress server for the app on port, its threads run by the dispatcher /metrics reports on
+
+    waitress only starts threads for dispatchers it makes itself, so they are started here.
+    """
+
+    task_dispatcher.set_thread_count(threads)
+
+    return create_server(app, port=port, threads=threads, _dispatcher=task_dispatcher)
+
 # Web Server
-serve(app, port=PORT)
+if __name__ == '__main__':
+    passwords.start()
+    server = make_server(PORT)
+    server.print_listen('Serving on http://{}:{}')
+    server.run()
@@ -0,0 +1,597 @@
+from models import db, connect_db, User, LikedVideo, Subscription, Playlist, PlaylistVideo, Credential, Job, PageEtag, ExportedItem, QuotaUsage
+import ytmapi
+import jobs
+import selection
+import listings
+import fakeyoutube
+import metrics
+import quota
+import datetime
+import json
+import jwt
+import multiprocessing
+import os
+import requests
+import resource
+import subprocess
+import sys
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+from flask import Flask
+
+app = Flask(__name__)
+
+DATABASE_URL = os.environ['DATABASE_URL']
+app.config['SQLALCHEMY_DATABASE_URI'] = DATABASE_URL
+app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+connect_db(app)
+metrics.watch_queries(db.engine)
+
+def make_user():
+    """
+    Creates a throwaway user to own benchmark rows
+    """
+
+    user = User(
+            username = 'benchmark-%s' % time.time(),
+            password_hash = ''
+            )
+    db.session.add(user)
+    db.session.commit()
+
+    return user
+
+def make_pages(count, make_item):
+    """
+    Splits count synthetic items into 50 item API pages
+    """
+
+    return [{'items': [make_item(i) for i in range(start, min(start + 50, count))]} for start in range(0, count, 50)]
+
+def make_like(i):
+    return { "id": "video%s" % i, "snippet": { "title": "Video %s" % i, "channelTitle": "Channel %s" % i, "thumbnails": { "default": { "url": "https://example.com/%s.jpg" % i } } } }
+
+def make_sub(i):
+    return { "snippet": { "title": "Channel %s" % i, "resourceId": { "channelId": "channel%s" % i }, "thumbnails": { "default": { "url": "https://example.com/%s.jpg" % i } } } }
+
+def make_playlist(i):
+    return { "id": "playlist%s" % i, "snippet": { "title": "Playlist %s" % i, "thumbnails": { "default": { "url": "https://example.com/%s.jpg" % i } } }, "status": { "privacyStatus": "private" } }
+
+def make_playlist_item(i):
+    return { "snippet": { "position": i, "resourceId": { "videoId": "video%s" % i } } }
+
+def orm_save_liked_videos(liked_videos, user):
+    """
+    The previous one ORM object per row save path, kept as a baseline
+    """
+
+    for video in liked_videos['items']:
+        newVid = LikedVideo(
+                user_id = user.id,
+                video_id = video['id'],
+                title = video['snippet']['title'],
+                channel_title = video['snippet']['channelTitle'],
+                thumbnail = video['snippet']['thumbnails']['default']['url'],
+                expiration_date = ytmapi.make_expiration_date()
+                )
+        db.session.add(newVid)
+    db.session.commit()
+
+def timed(name, rows, function):
+    """
+    Runs function and prints its rows/sec
+    """
+
+    start = time.perf_counter()
+    function()
+    seconds = time.perf_counter() - start
+    print('%-28s %8d rows %8.3fs %10.0f rows/sec' % (name, rows, seconds, rows / seconds))
+
+    return rows / seconds
+
+def bench_bulk_insert(rows):
+    """
+    Times each save_* path saving rows items page by page
+    """
+
+    user = make_user()
+    try:
+        likes = make_pages(rows, make_like)
+        timed('orm save_liked_videos', rows, lambda: [orm_save_liked_videos(page, user) for page in likes])
+        LikedVideo.query.filter_by(user_id=user.id).delete()
+        db.session.commit()
+        timed('save_liked_videos', rows, lambda: [ytmapi.save_liked_videos(page, user) for page in likes])
+
+        subs = make_pages(rows, make_sub)
+        timed('save_subscriptions', rows, lambda: [ytmapi.save_subscriptions(page, user) for page in subs])
+
+        playlists = make_pages(rows, make_playlist)
+        ids = {}
+        timed('save_playlists', rows, lambda: [ids.update(ytmapi.save_playlists(page, user)) for page in playlists])
+
+        items = make_pages(rows, make_playlist_item)
+        playlist_id = next(iter(ids.values()))
+        timed('save_playlist_items', rows, lambda: [ytmapi.save_playlist_items(page, playlist_id) for page in items])
+    finally:
+        db.session.delete(user)
+        db.session.commit()
+
+    return
+
+def latency(name, runs, function):
+    """
+    Runs function runs times and prints its mean latency
+    """
+
+    start = time.perf_counter()
+    for run in range(runs):
+        function()
+    milliseconds = (time.perf_counter() - start) * 1000 / runs
+    print('%-28s %8d runs %10.2fms' % (name, runs, milliseconds))
+
+    return milliseconds
+
+def populate(total):
+    """
+    Inserts about total rows spread over users of roughly 1000 rows each, returning the user ids
+
+    Rows are generated inside Postgres, so this needs a Postgres database.
+    """
+
+    prefix = 'benchmark-%s-' % time.time()
+    ids = [row[0] for row in db.session.execute(
+            """INSERT INTO users (username, password_hash) SELECT :prefix || n, '' FROM generate_series(1, :count) AS n RETURNING id""",
+            {'prefix': prefix, 'count': max(total // 1000, 1)})]
+    params = {'ids': ids, 'users': len(ids), 'expiration': ytmapi.make_expiration_date()}
+
+    # 40% likes, 20% subscriptions, 5% playlists and 35% playlist videos
+    db.session.execute(
+            """INSERT INTO liked_videos (user_id, video_id, title, channel_title, thumbnail, expiration_date)
+               SELECT (CAST(:ids AS INTEGER[]))[1 + n % :users], 'video' || n, 'Video ' || n, 'Channel ' || n, 'https://example.com/' || n || '.jpg', :expiration
+               FROM generate_series(1, :count) AS n""",
+            dict(params, count=total * 40 // 100))
+    db.session.execute(
+            """INSERT INTO subscriptions (user_id, channel_id, title, thumbnail, expiration_date)
+               SELECT (CAST(:ids AS INTEGER[]))[1 + n % :users], 'channel' || n, 'Channel ' || n, 'https://example.com/' || n || '.jpg', :expiration
+               FROM generate_series(1, :count) AS n""",
+            dict(params, count=total * 20 // 100))
+    db.session.execute(
+            """INSERT INTO playlists (user_id, resource_id, title, thumbnail, privacy_status, expiration_date)
+               SELECT (CAST(:ids AS INTEGER[]))[1 + n % :users], 'playlist' || n, 'Playlist ' || n, 'https://example.com/' || n || '.jpg', 'private', :expiration
+               FROM generate_series(1, :count) AS n""",
+            dict(params, count=total * 5 // 100))
+    db.session.execute(
+            """WITH lists AS (SELECT array_agg(id) AS ids FROM playlists WHERE user_id = ANY(:ids))
+               INSERT INTO playlist_videos (playlist_id, video_id, position)
+               SELECT lists.ids[1 + n % cardinality(lists.ids)], 'video' || n, n / cardinality(lists.ids)
+               FROM lists, generate_series(1, :count) AS n""",
+            dict(params, count=total * 35 // 100))
+    db.session.commit()
+    db.session.execute('ANALYZE')
+    db.session.commit()
+
+    return ids
+
+def depopulate(ids):
+    """
+    Deletes the users made by populate() and all their rows
+    """
+
+    playlists = db.session.query(Playlist.id).filter(Playlist.user_id.in_(ids))
+    PlaylistVideo.query.filter(PlaylistVideo.playlist_id.in_(playlists.subquery())) \
+            .delete(synchronize_session=False)
+    for model in (LikedVideo, Subscription, Playlist, Credential, Job, PageEtag, ExportedItem, QuotaUsage):
+        model.query.filter(model.user_id.in_(ids)).delete(synchronize_session=False)
+    User.query.filter(User.id.in_(ids)).delete(synchronize_session=False)
+    db.session.commit()
+
+    return
+
+def bench_lookups(total, runs=20):
+    """
+    Times the dashboard and selection queries of one user among total rows, without and then with indexes
+    """
+
+    ids = populate(total)
+    try:
+        user = User.query.get(ids[0])
+        username = user.username
+
+        # A selection like one posted by the dashboard
+        items = [video.video_id + 'videoid' for video in LikedVideo.query.filter_by(user_id=user.id).limit(100)]
+        items += [sub.channel_id + 'channel' for sub in Subscription.query.filter_by(user_id=user.id).limit(50)]
+        items += [playlist.resource_id + 'playlis' for playlist in Playlist.query.filter_by(user_id=user.id).limit(10)]
+
+        def dashboard():
+            dashboard_user = User.query.filter_by(username=username).first()
+            Credential.query.filter_by(user_id=dashboard_user.id).first()
+            for category in listings.LISTINGS:
+                listings.list_page(dashboard_user.id, category)
+            Job.query.filter_by(user_id=dashboard_user.id).filter(Job.state.in_([jobs.QUEUED, jobs.RUNNING])).all()
+
+        def bench_selection():
+            selection.select_items(user, items)
+
+        # Postgres DDL is transactional, so rolling back puts the dropped indexes back
+        for model in (User, Credential, LikedVideo, Subscription, Playlist, PlaylistVideo, Job):
+            for index in model.__table__.indexes:
+                db.session.execute('DROP INDEX IF EXISTS %s' % index.name)
+        latency('dashboard, no indexes', runs, dashboard)
+        latency('selection, no indexes', runs, bench_selection)
+        db.session.rollback()
+
+        latency('dashboard', runs, dashboard)
+        latency('selection', runs, bench_selection)
+    finally:
+        db.session.rollback()
+        depopulate(ids)
+
+    return
+
+def peak_rss():
+    """
+    Returns the peak resident set size of this process in megabytes
+    """
+
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+def query_count():
+    """
+    Returns the number of statements this process has run
+    """
+
+    histogram = metrics.histograms.get(metrics.label_key('db_query_seconds', {}))
+
+    return histogram['count'] if histogram else 0
+
+def measure(name, items, function):
+    """
+    Runs function, printing and returning its items/sec, peak RSS and query count
+    """
+
+    rss = peak_rss()
+    queries = query_count()
+    start = time.perf_counter()
+    function()
+    seconds = time.perf_counter() - start
+    result = {
+            'items' : items,
+            'seconds' : seconds,
+            'items_per_sec' : items / seconds,
+            'queries' : query_count() - queries,
+            'peak_rss_mb' : peak_rss(),
+            'rss_growth_mb' : peak_rss() - rss
+            }
+    print('%-22s %8d items %8.3fs %10.0f items/sec %8d queries %8.1fMB peak RSS' % (
+        name, items, seconds, result['items_per_sec'], result['queries'], result['peak_rss_mb']))
+
+    return result
+
+def isolated(function, *args):
+    """
+    Runs function(*args) in a forked process and returns its result, so each benchmark has its own peak RSS
+    """
+
+    # Connections must not be shared with the child
+    db.session.remove()
+    db.engine.dispose()
+    with ProcessPoolExecutor(1, mp_context=multiprocessing.get_context('fork')) as pool:
+        return pool.submit(function, *args).result()
+
+def fake_youtube(items, latency):
+    """
+    Points ytmapi at a fake YouTube with a synthetic source account of about items items and an empty target account
+    """
+
+    youtube = fakeyoutube.FakeYouTube({
+        'source' : fakeyoutube.Account.synthetic(items),
+        'target' : fakeyoutube.Account()
+        }, latency)
+    ytmapi.use_transport(fakeyoutube.transport(youtube), fakeyoutube.DISCOVERY)
+
+    return youtube
+
+def library_size(account):
+    """
+    Returns the number of likes, subscriptions, playlists and playlist videos in a fake account
+    """
+
+    return len(account.likes) + len(account.subscriptions) + sum(1 + len(playlist['items']) for playlist in account.playlists.values())
+
+def web_client(username):
+    """
+    Returns a test client of the web app logged in as username
+    """
+
+    for name in ('FLASK_KEY', 'JWT_KEY', 'PORT'):
+        os.environ.setdefault(name, 'benchmark')
+    import app as web
+
+    web.app.config['WTF_CSRF_ENABLED'] = False
+    client = web.app.test_client()
+    with client.session_transaction() as session:
+        session['auth'] = jwt.encode({'user' : username, 'exp' : datetime.datetime.utcnow() + datetime.timedelta(days=1)}, web.JWT_KEY)
+
+    return client
+
+def selection_keys(user_id):
+    """
+    Returns dashboard form keys selecting every item a user has
+    """
+
+    keys = [video_id + 'videoid' for video_id, in db.session.query(LikedVideo.video_id).filter_by(user_id=user_id)]
+    keys += [channel_id + 'channel' for channel_id, in db.session.query(Subscription.channel_id).filter_by(user_id=user_id)]
+    keys += [resource_id + 'playlis' for resource_id, in db.session.query(Playlist.resource_id).filter_by(user_id=user_id)]
+
+    return keys
+
+# Importers benchmarked, with the size of what each imports from a fake account
+IMPORTERS = {
+        'import_liked_videos' : (ytmapi.import_liked_videos, lambda account: len(account.likes)),
+        'import_subscriptions' : (ytmapi.import_subscriptions, lambda account: len(account.subscriptions)),
+        'import_playlists' : (ytmapi.import_playlists, lambda account: library_size(account) - len(account.likes) - len(account.subscriptions))
+        }
+
+def bench_import(name, user_id, items, latency):
+    """
+    Times one importer reading the synthetic source account
+    """
+
+    youtube = fake_youtube(items, latency)
+    importer, size = IMPORTERS[name]
+    user = User.query.get(user_id)
+
+    return measure(name, size(youtube.accounts['source']), lambda: importer(user))
+
+def bench_export(user_id, items, latency):
+    """
+    Times posting an export of everything imported and running the job it queues, into the empty target account
+    """
+
+    youtube = fake_youtube(items, latency)
+    user = User.query.get(user_id)
+    client = web_client(user.username)
+    keys = selection_keys(user_id)
+
+    # Relink the user to the target account, as the dashboard would
+    Credential.query.filter_by(user_id=user_id).update({'token' : 'target', 'account' : 'target'})
+    db.session.commit()
+    ytmapi.forget_services(user_id)
+
+    def export():
+        client.post('/export', data={key : 'on' for key in keys})
+        job = jobs.claim_job()
+        jobs.run_job(job)
+        if job.state != jobs.DONE:
+            raise RuntimeError('Export job %s: %s' % (job.state, job.error))
+
+    result = measure('exportData', library_size(youtube.accounts['source']), export)
+    result['exported'] = library_size(youtube.accounts['target'])
+
+    return result
+
+def bench_migrate(user_id, items, latency):
+    """
+    Times a migration job copying the synthetic source account straight into an empty target account
+    """
+
+    youtube = fake_youtube(items, latency)
+    user = User.query.get(user_id)
+
+    # Link both accounts, the export benchmark having relinked the source to the target
+    Credential.query.filter_by(user_id=user_id).delete()
+    db.session.add(Credential(user_id=user_id, token='source', refresh_token='benchmark', account='source'))
+    db.session.add(Credential(user_id=user_id, role=ytmapi.TARGET, token='target', refresh_token='benchmark', account='migration-target'))
+    db.session.commit()
+    ytmapi.forget_services(user_id)
+
+    def migrate():
+        jobs.enqueue_job(user, 'migrate', {'likedVideos' : True, 'subscriptions' : True, 'playlists' : True})
+        job = jobs.claim_job()
+        jobs.run_job(job)
+        if job.state != jobs.DONE:
+            raise RuntimeError('Migration job %s: %s' % (job.state, job.error))
+
+    result = measure('migrate', library_size(youtube.accounts['source']), migrate)
+    result['exported'] = library_size(youtube.accounts['target'])
+
+    return result
+
+def bench_download(user_id, items, latency):
+    """
+    Times downloading everything imported as JSON
+    """
+
+    youtube = fake_youtube(items, latency)
+    user = User.query.get(user_id)
+    client = web_client(user.username)
+    keys = selection_keys(user_id)
+    download = {}
+
+    def download_json():
+        download['bytes'] = len(client.post('/download-json', data=dict({key : 'on' for key in keys}, format='json')).get_data())
+
+    result = measure('downloadJson', library_size(youtube.accounts['source']), download_json)
+    result['bytes'] = download['bytes']
+
+    return result
+
+def bench_dashboard(user_id, items, latency, runs=20):
+    """
+    Times loading the dashboard runs times; its items are requests
+    """
+
+    user = User.query.get(user_id)
+    client = web_client(user.username)
+
+    def dashboard():
+        for run in range(runs):
+            client.get('/dashboard').get_data()
+
+    return measure('dashboard', runs, dashboard)
+
+def git_commit():
+    """
+    Returns the commit being benchmarked, or None outside a git checkout
+    """
+
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True, check=True,
+                cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def bench_youtube(items, latency, output):
+    """
+    Imports a synthetic library of about items items from a fake YouTube answering after latency seconds,
+    exports it to another account, downloads it and loads the dashboard, saving the results as JSON to output
+    """
+
+    user = make_user()
+    user_id = user.id
+    db.session.add(Credential(user_id=user_id, token='source', refresh_token='benchmark', account='source'))
+    db.session.commit()
+
+    # The fake API's quota is not the project's
+    quota.DAILY_QUOTA = sys.maxsize
+
+    results = {}
+    try:
+        for name in IMPORTERS:
+            results[name] = isolated(bench_import, name, user_id, items, latency)
+        results['exportData'] = isolated(bench_export, user_id, items, latency)
+        results['migrate'] = isolated(bench_migrate, user_id, items, latency)
+        results['downloadJson'] = isolated(bench_download, user_id, items, latency)
+        results['dashboard'] = isolated(bench_dashboard, user_id, items, latency)
+    finally:
+        db.session.rollback()
+        depopulate([user_id])
+
+    report = {
+            'commit' : git_commit(),
+            'created_at' : datetime.datetime.utcnow().isoformat() + 'Z',
+            'items' : items,
+            'latency' : latency,
+            'results' : results
+            }
+    with open(output, 'w') as f:
+        json.dump(report, f, indent=2)
+    print('Saved results to %s' % output)
+
+    return report
+
+def emulator(path, **settings):
+    """
+    Posts settings to an endpoint of the emulator ytmapi is pointed at, returning its answer
+    """
+
+    response = requests.post(ytmapi.YOUTUBE_API_URL.rstrip('/') + '/emulator/' + path, json=settings, timeout=30)
+    response.raise_for_status()
+
+    return response.json()
+
+def run_jobs(threads):
+    """
+    Runs queued jobs on threads worker threads, as the worker does, until none are left
+    """
+
+    def work():
+        while True:
+            with app.app_context():
+                job = jobs.claim_job()
+                if job is None:
+                    return
+                jobs.run_job(job)
+
+    workers = [threading.Thread(target=work) for i in range(threads)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+
+    return
+
+def bench_load(users, items, threads, output):
+    """
+    Imports a synthetic library of about items items for each of users users at once from the
+    emulator at YOUTUBE_API_URL, then exports them all, saving the results as JSON to output
+
+    Each user has its own source and target account in the emulator, and starts
+    with an access token it does not know, so the first call of each job
+    refreshes it at GOOGLE_TOKEN_URI.
+    """
+
+    if not ytmapi.YOUTUBE_API_URL:
+        sys.exit('Set YOUTUBE_API_URL and GOOGLE_TOKEN_URI to an emulator started with python fakeyoutube.py')
+
+    # The emulator enforces its own quota
+    quota.DAILY_QUOTA = sys.maxsize
+
+    prefix = 'load%s' % int(time.time())
+    ids = []
+    results = {}
+    try:
+        size = 0
+        for i in range(users):
+            user = make_user()
+            ids.append(user.id)
+            source = '%s-%s-source' % (prefix, i)
+            size += sum(emulator('accounts', name=source, items=items).values())
+            emulator('accounts', name='%s-%s-target' % (prefix, i))
+            db.session.add(Credential(user_id=user.id, token='unknown', refresh_token=source, account=source))
+            jobs.enqueue_job(user, 'import', {'subscriptions' : True, 'likedVideos' : True, 'playlists' : True})
+        results['import'] = measure('import x%s users' % users, size, lambda: run_jobs(threads))
+
+        # Relink every user to its empty target account and export everything it imported
+        for i, user_id in enumerate(ids):
+            target = '%s-%s-target' % (prefix, i)
+            Credential.query.filter_by(user_id=user_id).update({'token' : 'unknown', 'refresh_token' : target, 'expiry' : None, 'account' : target})
+            db.session.commit()
+            ytmapi.forget_services(user_id)
+            jobs.enqueue_job(User.query.get(user_id), 'export', {'items' : selection_keys(user_id)})
+        results['export'] = measure('export x%s users' % users, size, lambda: run_jobs(threads))
+
+        states = db.session.query(Job.kind, Job.state, db.func.count()).filter(Job.user_id.in_(ids)).group_by(Job.kind, Job.state)
+        results['jobs'] = {'%s %s' % (kind, state) : count for kind, state, count in states}
+        results['emulator'] = requests.get(ytmapi.YOUTUBE_API_URL.rstrip('/') + '/emulator', timeout=30).json()
+        del results['emulator']['accounts']
+    finally:
+        db.session.rollback()
+        depopulate(ids)
+
+    report = {
+            'commit' : git_commit(),
+            'created_at' : datetime.datetime.utcnow().isoformat() + 'Z',
+            'users' : users,
+            'items' : items,
+            'threads' : threads,
+            'results' : results
+            }
+    with open(output, 'w') as f:
+        json.dump(report, f, indent=2)
+    print('Jobs: %s' % results['jobs'])
+    print('Saved results to %s' % output)
+
+    return report
+
+if __name__ == '__main__':
+    db.create_all()
+
+    # python benchmark.py [rows] times inserts, python benchmark.py lookups [rows] times queries,
+    # python benchmark.py youtube [items] [latency ms] [output.json] times imports, exports, downloads
+    # and the dashboard against a fake YouTube, python benchmark.py load [users] [items] [threads] [output.json]
+    # runs concurrent imports and exports of many users through the emulator at YOUTUBE_API_URL
+    if len(sys.argv) > 1 and sys.argv[1] == 'lookups':
+        bench_lookups(int(sys.argv[2]) if len(sys.argv) > 2 else 1000000)
+    elif len(sys.argv) > 1 and sys.argv[1] == 'youtube':
+        items = int(sys.argv[2]) if len(sys.argv) > 2 else 10000
+        latency = float(sys.argv[3]) / 1000 if len(sys.argv) > 3 else 0
+        bench_youtube(items, latency, sys.argv[4] if len(sys.argv) > 4 else 'benchmark-youtube-%s.json' % items)
+    elif len(sys.argv) > 1 and sys.argv[1] == 'load':
+        users = int(sys.argv[2]) if len(sys.argv) > 2 else 20
+        items = int(sys.argv[3]) if len(sys.argv) > 3 else 1000
+        threads = int(sys.argv[4]) if len(sys.argv) > 4 else 4
+        bench_load(users, items, threads, sys.argv[5] if len(sys.argv) > 5 else 'benchmark-load-%sx%s.json' % (users, items))
+    else:
+        bench_bulk_insert(int(sys.argv[1]) if len(sys.argv) > 1 else 10000)
@@ -0,0 +1,241 @@
+from models import db, LikedVideo, Subscription, Playlist, PlaylistVideo
+import selection
+import csv
+import io
+import json
+import zlib
+import zstandard
+
+# Rows fetched from the server-side cursor, and records sent, at a time
+STREAM_BATCH_SIZE = 1000
+
+# Content-Encodings downloads can be compressed with, best first
+ENCODINGS = ['zstd', 'gzip']
+
+# Kinds of selected items, in the order downloads list them
+CATEGORIES = ('liked_videos', 'subscriptions', 'playlists')
+
+# Columns of the CSV download of each category
+CSV_COLUMNS = {
+        'liked_videos' : ['video_id', 'video_title', 'channel_title'],
+        'subscriptions' : ['channel_id', 'channel_title'],
+        'playlists' : ['playlist_id', 'playlist_title', 'privacy_status', 'position', 'video_id']
+        }
+
+# File extension and mimetype of each download format
+FORMATS = {
+        'json' : ('json', 'application/json'),
+        'ndjson' : ('ndjson', 'application/x-ndjson'),
+        'csv' : ('csv', 'text/csv')
+        }
+
+def stream_rows(query):
+    """
+    Runs a query on a server-side cursor, fetching STREAM_BATCH_SIZE rows at a time
+    """
+
+    return query.yield_per(STREAM_BATCH_SIZE)
+
+def liked_videos(user_id, video_ids):
+    """
+    Yields download records for the selected liked videos
+    """
+
+    if not video_ids:
+        return
+
+    query = db.session.query(LikedVideo.channel_title, LikedVideo.title, LikedVideo.video_id) \
+            .filter_by(user_id=user_id) \
+            .filter(selection.id_filter(LikedVideo.video_id, video_ids, 'selected_videos')) \
+            .order_by(LikedVideo.id)
+    for channel_title, title, video_id in stream_rows(query):
+        yield {
+                'channel_title' : channel_title,
+                'video_title' : title,
+                'video_id' : video_id
+                }
+
+def subscriptions(user_id, channel_ids):
+    """
+    Yields download records for the selected subscriptions
+    """
+
+    if not channel_ids:
+        return
+
+    query = db.session.query(Subscription.title, Subscription.channel_id) \
+            .filter_by(user_id=user_id) \
+            .filter(selection.id_filter(Subscription.channel_id, channel_ids, 'selected_channels')) \
+            .order_by(Subscription.id)
+    for title, channel_id in stream_rows(query):
+        yield {
+                'channel_title' : title,
+                'channel_id' : channel_id
+                }
+
+def playlists(user_id, playlist_ids):
+    """
+    Yields download records for the selected playlists and their contents
+
+    Contents come from the same ordered join as the playlists, so only one
+    playlist's video ids are held at a time.
+    """
+
+    if not playlist_ids:
+        return
+
+    query = db.session.query(Playlist.id, Playlist.title, Playlist.privacy_status, Playlist.resource_id, PlaylistVideo.video_id) \
+            .outerjoin(PlaylistVideo, PlaylistVideo.playlist_id == Playlist.id) \
+            .filter(Playlist.user_id == user_id) \
+            .filter(selection.id_filter(Playlist.resource_id, playlist_ids, 'selected_playlists')) \
+            .order_by(Playlist.id, PlaylistVideo.position)
+    current = None
+    playlist = None
+    for id, title, privacy_status, resource_id, video_id in stream_rows(query):
+        if id != current:
+            if playlist is not None:
+                yield playlist
+            current = id
+            playlist = {
+                    'playlist_title' : title,
+                    'privacy_status' : privacy_status,
+                    'playlist_id' : resource_id,
+                    'playlist_items' : []
+                    }
+        if video_id is not None:
+            playlist['playlist_items'].append(video_id)
+    if playlist is not None:
+        yield playlist
+
+def records(user_id, keys, categories=CATEGORIES):
+    """
+    Yields (category, record) pairs for the items named by selection form keys
+
+    Every serializer reads this one stream. Each category starts with a
+    (category, None) marker, so empty categories are still announced.
+    """
+
+    video_ids, channel_ids, playlist_ids = selection.parse_keys(user_id, keys)
+    sources = {
+            'liked_videos' : lambda: liked_videos(user_id, video_ids),
+            'subscriptions' : lambda: subscriptions(user_id, channel_ids),
+            'playlists' : lambda: playlists(user_id, playlist_ids)
+            }
+    for category in categories:
+        yield category, None
+        for record in sources[category]():
+            yield category, record
+
+def batched(strings):
+    """
+    Joins strings into chunks of STREAM_BATCH_SIZE
+
+    The first string goes out on its own, so the response starts straight away.
+    """
+
+    strings = iter(strings)
+    for string in strings:
+        yield string
+        break
+
+    chunk = []
+    for string in strings:
+        chunk.append(string)
+        if len(chunk) == STREAM_BATCH_SIZE:
+            yield ''.join(chunk)
+            chunk = []
+    if chunk:
+        yield ''.join(chunk)
+
+def json_document(records):
+    """
+    Yields records as one JSON object of lists keyed by category
+    """
+
+    yield '{'
+    opened = False
+    separator = ''
+    for category, record in records:
+        if record is None:
+            yield '%s"%s": [' % ('], ' if opened else '', category)
+            opened = True
+            separator = ''
+            continue
+        yield separator + json.dumps(record)
+        separator = ', '
+    yield ']}' if opened else '}'
+
+def ndjson_lines(records):
+    """
+    Yields records as newline delimited JSON, one object per line tagged with its category
+    """
+
+    for category, record in records:
+        if record is not None:
+            yield json.dumps(dict(record, category=category)) + '\n'
+
+def csv_rows(records, category):
+    """
+    Yields the records of one category as CSV, playlists as one row per entry
+    """
+
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(CSV_COLUMNS[category])
+    for record_category, record in records:
+        if record is None or record_category != category:
+            continue
+        if category == 'playlists':
+            entries = list(enumerate(record['playlist_items'])) or [('', '')]
+            for position, video_id in entries:
+                writer.writerow([record['playlist_id'], record['playlist_title'], record['privacy_status'], position, video_id])
+        else:
+            writer.writerow([record[column] for column in CSV_COLUMNS[category]])
+        yield buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+    yield buffer.getvalue()
+
+def compress(chunks, encoding=None):
+    """
+    Encodes string chunks to bytes, compressing them as they pass if encoding is gzip or zstd
+    """
+
+    if encoding is None:
+        for chunk in chunks:
+            yield chunk.encode('utf-8')
+        return
+
+    if encoding == 'zstd':
+        compressor = zstandard.ZstdCompressor().compressobj()
+    else:
+        compressor = zlib.compressobj(wbits=zlib.MAX_WBITS | 16)
+    for chunk in chunks:
+        data = compressor.compress(chunk.encode('utf-8'))
+        if data:
+            yield data
+    yield compressor.flush()
+
+def download(user_id, keys, format='json', category=None, encoding=None):
+    """
+    Returns a byte chunk generator, mimetype and filename for downloading selected items
+
+    format is json, ndjson or csv; a csv download holds only one category.
+    Nothing is queried until the generator is iterated, and memory use does
+    not grow with the selection.
+    """
+
+    extension, mimetype = FORMATS[format]
+    if format == 'csv':
+        if category not in CATEGORIES:
+            raise ValueError('CSV downloads need one of %s' % ', '.join(CATEGORIES))
+        chunks = csv_rows(records(user_id, keys, [category]), category)
+        filename = 'Your_YouTube_%s.%s' % (category.title(), extension)
+    elif format == 'ndjson':
+        chunks = ndjson_lines(records(user_id, keys))
+        filename = 'Your_YouTube_Data.%s' % extension
+    else:
+        chunks = json_document(records(user_id, keys))
+        filename = 'Your_YouTube_Data.%s' % extension
+
+    return compress(batched(chunks), encoding), mimetype, filename
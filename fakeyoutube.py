@@ -0,0 +1,698 @@
+from email.parser import FeedParser
+from http.client import responses
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlsplit, parse_qs
+import argparse
+import bisect
+import datetime
+import hashlib
+import json
+import random
+import threading
+import time
+import uuid
+import httplib2
+import jwt
+
+# Most items a list page holds, as on YouTube
+MAX_RESULTS = 50
+
+# Seconds an access token from the token endpoint is accepted for
+TOKEN_LIFETIME = 60 * 60
+
+# Faults injected into calls unless configured otherwise. latency is seconds every
+# HTTP request waits, plus up to latency_jitter more at random. rate_limit and
+# server_error are the shares of calls answered 403 rateLimitExceeded and 503
+# backendError. List pages hold at most page_size items whatever maxResults asks
+# for, empty_pages is the share of pages returned empty but with a nextPageToken,
+# and trailing_empty_page follows every last page with an empty one.
+FAULTS = {
+        'latency' : 0.0,
+        'latency_jitter' : 0.0,
+        'rate_limit' : 0.0,
+        'server_error' : 0.0,
+        'page_size' : MAX_RESULTS,
+        'empty_pages' : 0.0,
+        'trailing_empty_page' : False
+        }
+
+def method(resource, name, http_method, parameters, path=None, request=None, response=None):
+    """
+    Describes one API method for the discovery document
+    """
+
+    description = {
+            'id' : 'youtube.%s.%s' % (resource, name),
+            'path' : path or 'youtube/v3/%s' % resource,
+            'httpMethod' : http_method,
+            'parameters' : {key : dict(value, location='query') for key, value in parameters.items()},
+            'parameterOrder' : [key for key, value in parameters.items() if value.get('required')]
+            }
+    if request is not None:
+        description['request'] = {'$ref' : request}
+    if response is not None:
+        description['response'] = {'$ref' : response}
+
+    return description
+
+# Parameters of the list and insert methods ytmapi calls
+PART = {'type' : 'string', 'repeated' : True, 'required' : True}
+LIST_PARAMETERS = {
+        'part' : PART,
+        'id' : {'type' : 'string', 'repeated' : True},
+        'maxResults' : {'type' : 'integer', 'format' : 'uint32'},
+        'pageToken' : {'type' : 'string'},
+        'mine' : {'type' : 'boolean'}
+        }
+
+# Just enough of the YouTube Data API discovery document to build ytmapi's service objects
+DISCOVERY = {
+        'kind' : 'discovery#restDescription',
+        'discoveryVersion' : 'v1',
+        'id' : 'youtube:v3',
+        'name' : 'youtube',
+        'version' : 'v3',
+        'protocol' : 'rest',
+        'rootUrl' : 'https://youtube.googleapis.com/',
+        'servicePath' : '',
+        'batchPath' : 'batch',
+        'parameters' : {
+            'alt' : {'type' : 'string', 'default' : 'json', 'location' : 'query'},
+            'fields' : {'type' : 'string', 'location' : 'query'},
+            'key' : {'type' : 'string', 'location' : 'query'}
+            },
+        'schemas' : {name : {'id' : name, 'type' : 'object'} for name in ('ListResponse', 'Playlist', 'PlaylistItem', 'Subscription')},
+        'resources' : {
+            'playlists' : {'methods' : {
+                'list' : method('playlists', 'list', 'GET', LIST_PARAMETERS, response='ListResponse'),
+                'insert' : method('playlists', 'insert', 'POST', {'part' : PART}, request='Playlist', response='Playlist')
+                }},
+            'playlistItems' : {'methods' : {
+                'list' : method('playlistItems', 'list', 'GET', dict(LIST_PARAMETERS, playlistId={'type' : 'string'}), response='ListResponse'),
+                'insert' : method('playlistItems', 'insert', 'POST', {'part' : PART}, request='PlaylistItem', response='PlaylistItem')
+                }},
+            'subscriptions' : {'methods' : {
+                'list' : method('subscriptions', 'list', 'GET', dict(LIST_PARAMETERS, order={'type' : 'string'}), response='ListResponse'),
+                'insert' : method('subscriptions', 'insert', 'POST', {'part' : PART}, request='Subscription', response='Subscription')
+                }},
+            'videos' : {'methods' : {
+                'list' : method('videos', 'list', 'GET', dict(LIST_PARAMETERS, myRating={'type' : 'string'}), response='ListResponse'),
+                'rate' : method('videos', 'rate', 'POST', {
+                    'id' : {'type' : 'string', 'required' : True},
+                    'rating' : {'type' : 'string', 'required' : True}
+                    }, path='youtube/v3/videos/rate')
+                }}
+            }
+        }
+
+class ApiError(Exception):
+    """Raised while handling a call to answer it with an API error."""
+
+    def __init__(self, status, reason, message=''):
+        super().__init__(message or reason)
+        self.status = status
+        self.reason = reason
+
+class Account():
+    """
+    One YouTube account's liked videos, subscriptions and playlists
+
+    Subscriptions are kept in alphabetical order, the order ytmapi lists them in.
+    """
+
+    def __init__(self, likes=0, subscriptions=0, playlists=0, playlist_items=0):
+        self.lock = threading.Lock()
+        self.likes = ['video%s' % i for i in range(likes)]
+        self.liked = set(self.likes)
+        self.subscriptions = sorted('channel%s' % i for i in range(subscriptions))
+        self.subscribed = set(self.subscriptions)
+        self.playlists = {}
+        for i in range(playlists):
+            self.playlists['playlist%s' % i] = {
+                    'title' : 'Playlist %s' % i,
+                    'privacy_status' : 'private',
+                    'items' : ['video%s' % (i * playlist_items + position) for position in range(playlist_items)]
+                    }
+        self.created = 0
+
+    @classmethod
+    def synthetic(cls, items):
+        """
+        Returns an account of about items items, split like a typical library
+
+        40% are liked videos, 20% subscriptions, and the rest are playlists of
+        about 20 videos each.
+        """
+
+        playlists = max(items * 2 // 100, 1)
+
+        return cls(items * 40 // 100, items * 20 // 100, playlists, items * 38 // 100 // playlists)
+
+    def new_id(self, prefix):
+        """
+        Returns an id for something created in this account
+        """
+
+        self.created += 1
+
+        return '%s-new%s' % (prefix, self.created)
+
+def video(video_id):
+    return {
+            'id' : video_id,
+            'snippet' : {
+                'title' : 'Title of %s' % video_id,
+                'channelTitle' : 'Channel of %s' % video_id,
+                'thumbnails' : {'default' : {'url' : 'https://example.com/%s.jpg' % video_id}}
+                }
+            }
+
+def subscription(channel_id):
+    return {
+            'id' : 'subscription-%s' % channel_id,
+            'snippet' : {
+                'title' : 'Title of %s' % channel_id,
+                'resourceId' : {'kind' : 'youtube#channel', 'channelId' : channel_id},
+                'thumbnails' : {'default' : {'url' : 'https://example.com/%s.jpg' % channel_id}}
+                }
+            }
+
+def playlist(playlist_id, details):
+    return {
+            'id' : playlist_id,
+            'snippet' : {
+                'title' : details['title'],
+                'thumbnails' : {'default' : {'url' : 'https://example.com/%s.jpg' % playlist_id}}
+                },
+            'status' : {'privacyStatus' : details['privacy_status']},
+            'contentDetails' : {'itemCount' : len(details['items'])}
+            }
+
+def playlist_item(playlist_id, position, video_id):
+    return {
+            'id' : '%s-item%s' % (playlist_id, position),
+            'snippet' : {
+                'playlistId' : playlist_id,
+                'position' : position,
+                'resourceId' : {'kind' : 'youtube#video', 'videoId' : video_id}
+                }
+            }
+
+class FakeYouTube():
+    """
+    In-memory YouTube Data API answering the calls ytmapi makes
+
+    Accounts are keyed by name, which is also an access token and refresh token
+    that are always accepted. Calls are charged against a daily project quota at
+    YouTube's costs, and fail with the injected faults first.
+    """
+
+    def __init__(self, accounts, latency=0, quota=None, faults=None, token_lifetime=TOKEN_LIFETIME):
+        self.accounts = accounts
+        self.faults = dict(FAULTS, latency=latency)
+        self.faults.update(faults or {})
+        self.quota = quota
+        self.spent = 0
+        self.quota_day = datetime.date.today()
+        self.token_lifetime = token_lifetime
+        self.tokens = {}
+        self.calls = {}
+        self.lock = threading.Lock()
+
+    def handle(self, method, uri, headers, body):
+        """
+        Answers one HTTP request, returning its status, headers and body
+        """
+
+        headers = {key.lower() : value for key, value in (headers or {}).items()}
+        if isinstance(body, bytes):
+            body = body.decode('utf-8')
+        delay = self.faults['latency'] + random.uniform(0, self.faults['latency_jitter'])
+        if delay:
+            time.sleep(delay)
+
+        if urlsplit(uri).path.rstrip('/').endswith('/batch'):
+            return self.handle_batch(headers, body)
+
+        return self.handle_call(method, uri, headers, body)
+
+    def handle_call(self, method, uri, headers, body):
+        """
+        Answers a single API call
+        """
+
+        parts = urlsplit(uri)
+        endpoint = '%s %s' % (method, parts.path.split('youtube/v3/', 1)[-1])
+        params = {key : values[-1] for key, values in parse_qs(parts.query).items()}
+        try:
+            account = self.account(headers)
+            if endpoint not in ENDPOINTS:
+                raise ApiError(404, 'notFound', 'Unknown endpoint %s' % endpoint)
+            self.inject_faults(endpoint)
+            self.charge(endpoint)
+            if method == 'GET':
+                params['maxResults'] = min(int(params.get('maxResults') or 5), self.faults['page_size'])
+            with account.lock:
+                status, response = ENDPOINTS[endpoint](account, params, json.loads(body) if body else None)
+        except ApiError as error:
+            return error_response(error)
+
+        if status == 204:
+            return 204, {}, b''
+        if 'etag' in response:
+            response = self.page_faults(params, response)
+            if headers.get('if-none-match') == response['etag']:
+                return 304, {}, b''
+        content = json.dumps(response)
+        return status, {'content-type' : 'application/json; charset=UTF-8'}, content.encode('utf-8')
+
+    def handle_batch(self, headers, body):
+        """
+        Answers a multipart/mixed batch of calls, each with its own status
+        """
+
+        parser = FeedParser()
+        parser.feed('content-type: %s\r\n\r\n%s' % (headers.get('content-type', ''), body))
+        message = parser.close()
+
+        boundary = uuid.uuid4().hex
+        parts = []
+        for part in message.get_payload():
+            request_line, rest = part.get_payload().split('\n', 1)
+            method, path, protocol = request_line.split(' ', 2)
+            inner = FeedParser()
+            inner.feed(rest)
+            inner = inner.close()
+            inner_headers = dict(headers, **{key.lower() : value for key, value in inner.items()})
+            status, response_headers, content = self.handle_call(method, 'https://youtube.googleapis.com' + path, inner_headers, inner.get_payload())
+            lines = ['HTTP/1.1 %s %s' % (status, responses.get(status, ''))]
+            lines.extend('%s: %s' % header for header in response_headers.items())
+            lines.append('Content-Length: %s' % len(content))
+            parts.append('--%s\r\nContent-Type: application/http\r\nContent-ID: <response-%s>\r\n\r\n%s\r\n\r\n%s\r\n' % (
+                boundary, part['Content-ID'][1:-1], '\r\n'.join(lines), content.decode('utf-8')))
+        parts.append('--%s--' % boundary)
+
+        return 200, {'content-type' : 'multipart/mixed; boundary=%s' % boundary}, ''.join(parts).encode('utf-8')
+
+    def account(self, headers):
+        """
+        Returns the account whose access token authorizes a request
+        """
+
+        token = headers.get('authorization', '')[len('Bearer '):]
+        name = token
+        with self.lock:
+            if token in self.tokens:
+                name, expiry = self.tokens[token]
+                if expiry <= time.time():
+                    del self.tokens[token]
+                    name = None
+        account = self.accounts.get(name)
+        if account is None:
+            raise ApiError(401, 'authError', 'Invalid Credentials')
+
+        return account
+
+    def inject_faults(self, endpoint):
+        """
+        Fails a call at random with the configured shares of rate limit and server errors
+        """
+
+        if random.random() < self.faults['rate_limit']:
+            self.count(endpoint, 'rateLimitExceeded')
+            raise ApiError(403, 'rateLimitExceeded', 'The request cannot be completed because you have exceeded your quota.')
+        if random.random() < self.faults['server_error']:
+            self.count(endpoint, 'backendError')
+            raise ApiError(503, 'backendError', 'Backend Error')
+
+        return
+
+    def charge(self, endpoint):
+        """
+        Spends a call's cost from today's quota, failing it with quotaExceeded once the quota is used up
+        """
+
+        cost = QUOTA_COSTS[endpoint]
+        with self.lock:
+            if self.quota_day != datetime.date.today():
+                self.quota_day = datetime.date.today()
+                self.spent = 0
+            if self.quota is not None and self.spent + cost > self.quota:
+                exceeded = True
+            else:
+                exceeded = False
+                self.spent += cost
+        if exceeded:
+            self.count(endpoint, 'quotaExceeded')
+            raise ApiError(403, 'quotaExceeded', 'The request cannot be completed because you have exceeded your quota.')
+        self.count(endpoint, 'ok')
+
+        return
+
+    def count(self, endpoint, outcome):
+        """
+        Counts a call to endpoint by outcome, for the state endpoint
+        """
+
+        key = '%s %s' % (endpoint, outcome)
+        with self.lock:
+            self.calls[key] = self.calls.get(key, 0) + 1
+
+        return
+
+    def page_faults(self, params, response):
+        """
+        Empties a list page at random, or adds an empty page after the last one, as configured
+        """
+
+        start = page_offset(params.get('pageToken'))
+        if response['items'] and random.random() < self.faults['empty_pages']:
+            response = dict(response, items=[], nextPageToken='%s~%s' % (start, uuid.uuid4().hex[:8]))
+        elif response['items'] and 'nextPageToken' not in response and self.faults['trailing_empty_page']:
+            response = dict(response, nextPageToken=str(start + len(response['items'])))
+        else:
+            return response
+
+        return dict(response, etag=etag(response))
+
+    def grant(self, params):
+        """
+        Answers the OAuth token endpoint, exchanging an authorization code or
+        refresh token for an access token
+
+        Both are account names. Codes also get the account's refresh token and
+        an unsigned OpenID token naming the account.
+        """
+
+        grant_type = params.get('grant_type')
+        name = params.get('refresh_token' if grant_type == 'refresh_token' else 'code')
+        if grant_type not in ('refresh_token', 'authorization_code') or name not in self.accounts:
+            return 400, {'error' : 'invalid_grant', 'error_description' : 'Bad Request'}
+
+        token = 'ya29.%s' % uuid.uuid4().hex
+        with self.lock:
+            now = time.time()
+            for stale in [key for key, value in self.tokens.items() if value[1] <= now]:
+                del self.tokens[stale]
+            self.tokens[token] = (name, now + self.token_lifetime)
+        response = {'access_token' : token, 'expires_in' : self.token_lifetime, 'token_type' : 'Bearer'}
+        if 'scope' in params:
+            response['scope'] = params['scope']
+        if grant_type == 'authorization_code':
+            response['refresh_token'] = name
+            response['id_token'] = jwt.encode({'sub' : name, 'iat' : int(now), 'exp' : int(now) + self.token_lifetime},
+                    'fakeyoutube', algorithm='HS256').decode('utf-8')
+
+        return 200, response
+
+    def state(self):
+        """
+        Returns the quota, faults, call counts and size of every account
+        """
+
+        with self.lock:
+            return {
+                    'quota' : {'limit' : self.quota, 'spent' : self.spent},
+                    'faults' : dict(self.faults),
+                    'calls' : dict(self.calls),
+                    'accounts' : {name : {
+                        'likes' : len(account.likes),
+                        'subscriptions' : len(account.subscriptions),
+                        'playlists' : len(account.playlists),
+                        'playlist_items' : sum(len(details['items']) for details in account.playlists.values())
+                        } for name, account in self.accounts.items()}
+                    }
+
+def error_response(error):
+    """
+    Returns an API error as status, headers and body
+    """
+
+    content = json.dumps({'error' : {
+        'code' : error.status,
+        'message' : str(error),
+        'errors' : [{'domain' : 'youtube', 'reason' : error.reason, 'message' : str(error)}]
+        }})
+
+    return error.status, {'content-type' : 'application/json; charset=UTF-8'}, content.encode('utf-8')
+
+def page(items, params, render):
+    """
+    Returns one page of a list response, with an ETag of its contents
+
+    Page tokens are offsets, so pages stay stable while nothing changes.
+    """
+
+    start = page_offset(params.get('pageToken'))
+    size = min(int(params.get('maxResults') or 5), MAX_RESULTS)
+    response = {
+            'kind' : 'youtube#listResponse',
+            'pageInfo' : {'totalResults' : len(items), 'resultsPerPage' : size},
+            'items' : [render(item) for item in items[start:start + size]]
+            }
+    if start + size < len(items):
+        response['nextPageToken'] = str(start + size)
+    response['etag'] = etag(response)
+
+    return response
+
+def page_offset(token):
+    """
+    Returns the offset of the first item on the page a page token names
+    """
+
+    return int((token or '0').split('~')[0])
+
+def etag(response):
+    """
+    Returns an ETag of a response's contents
+    """
+
+    return '"%s"' % hashlib.md5(json.dumps(dict(response, etag=None), sort_keys=True).encode('utf-8')).hexdigest()
+
+def list_videos(account, params, body):
+    if params.get('myRating') != 'like':
+        raise ApiError(400, 'invalidParameter', 'Only myRating=like is supported')
+    return 200, page(account.likes, params, video)
+
+def rate_video(account, params, body):
+    video_id = params['id']
+    if params['rating'] == 'like' and video_id not in account.liked:
+        account.likes.insert(0, video_id)
+        account.liked.add(video_id)
+    elif params['rating'] != 'like' and video_id in account.liked:
+        account.likes.remove(video_id)
+        account.liked.discard(video_id)
+    return 204, None
+
+def list_subscriptions(account, params, body):
+    return 200, page(account.subscriptions, params, subscription)
+
+def insert_subscription(account, params, body):
+    channel_id = body['snippet']['resourceId']['channelId']
+    if channel_id in account.subscribed:
+        raise ApiError(400, 'subscriptionDuplicate', 'The subscription already exists')
+    bisect.insort(account.subscriptions, channel_id)
+    account.subscribed.add(channel_id)
+    return 200, subscription(channel_id)
+
+def list_playlists(account, params, body):
+    return 200, page(list(account.playlists.items()), params, lambda item: playlist(*item))
+
+def insert_playlist(account, params, body):
+    playlist_id = account.new_id('playlist')
+    account.playlists[playlist_id] = {
+            'title' : body['snippet']['title'],
+            'privacy_status' : body.get('status', {}).get('privacyStatus', 'public'),
+            'items' : []
+            }
+    return 200, playlist(playlist_id, account.playlists[playlist_id])
+
+def list_playlist_items(account, params, body):
+    playlist_id = params.get('playlistId')
+    if playlist_id not in account.playlists:
+        raise ApiError(404, 'playlistNotFound', 'Playlist %s not found' % playlist_id)
+    items = list(enumerate(account.playlists[playlist_id]['items']))
+    return 200, page(items, params, lambda item: playlist_item(playlist_id, *item))
+
+def insert_playlist_item(account, params, body):
+    playlist_id = body['snippet']['playlistId']
+    if playlist_id not in account.playlists:
+        raise ApiError(404, 'playlistNotFound', 'Playlist %s not found' % playlist_id)
+    items = account.playlists[playlist_id]['items']
+    items.append(body['snippet']['resourceId']['videoId'])
+    return 200, playlist_item(playlist_id, len(items) - 1, items[-1])
+
+# Handler of each supported call, keyed by HTTP method and path under youtube/v3/
+ENDPOINTS = {
+        'GET videos' : list_videos,
+        'POST videos/rate' : rate_video,
+        'GET subscriptions' : list_subscriptions,
+        'POST subscriptions' : insert_subscription,
+        'GET playlists' : list_playlists,
+        'POST playlists' : insert_playlist,
+        'GET playlistItems' : list_playlist_items,
+        'POST playlistItems' : insert_playlist_item
+        }
+
+# Quota units each call costs, as on YouTube
+QUOTA_COSTS = {
+        'GET videos' : 1,
+        'POST videos/rate' : 50,
+        'GET subscriptions' : 1,
+        'POST subscriptions' : 50,
+        'GET playlists' : 1,
+        'POST playlists' : 50,
+        'GET playlistItems' : 1,
+        'POST playlistItems' : 50
+        }
+
+class FakeHttp():
+    """
+    httplib2.Http stand-in that sends requests to a FakeYouTube instead of the network
+    """
+
+    def __init__(self, youtube, token):
+        self.youtube = youtube
+        self.token = token
+
+    def request(self, uri, method='GET', body=None, headers=None, redirections=None, connection_type=None):
+        headers = dict(headers or {})
+        headers.setdefault('authorization', 'Bearer %s' % self.token)
+        status, response_headers, content = self.youtube.handle(method, uri, headers, body)
+
+        return httplib2.Response(dict(response_headers, status=status)), content
+
+def transport(youtube):
+    """
+    Returns a ytmapi transport factory whose service objects call youtube with the user's access token
+    """
+
+    return lambda credentials: FakeHttp(youtube, credentials.token)
+
+def json_response(status, response):
+    """
+    Returns a JSON response as status, headers and body
+    """
+
+    return status, {'content-type' : 'application/json; charset=UTF-8'}, json.dumps(response).encode('utf-8')
+
+class EmulatorHandler(BaseHTTPRequestHandler):
+    """
+    Serves a FakeYouTube over HTTP, with the OAuth token endpoint, the
+    discovery document and endpoints to inspect and configure the emulator
+
+    GET /emulator returns its state. POST /emulator/faults takes a JSON object
+    of FAULTS to change, POST /emulator/quota a limit and spent count, and
+    POST /emulator/accounts a name and a number of items to give a new
+    synthetic account.
+    """
+
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        self.answer('GET')
+
+    def do_POST(self):
+        self.answer('POST')
+
+    def answer(self, method):
+        body = self.rfile.read(int(self.headers.get('Content-Length') or 0))
+        try:
+            status, headers, content = self.route(method, urlsplit(self.path).path, body)
+        except (KeyError, TypeError, ValueError) as error:
+            status, headers, content = json_response(400, {'error' : 'invalid_request', 'error_description' : str(error)})
+        self.send_response(status)
+        for header in headers.items():
+            self.send_header(*header)
+        self.send_header('Content-Length', str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def route(self, method, path, body):
+        """
+        Answers a request to the emulator itself, or passes it on to the API
+        """
+
+        youtube = self.server.youtube
+        if method == 'GET' and path == '/discovery/v1/apis/youtube/v3/rest':
+            return json_response(200, dict(DISCOVERY, rootUrl='http://%s/' % self.headers['Host']))
+        if method == 'POST' and path == '/token':
+            params = {key : values[-1] for key, values in parse_qs(body.decode('utf-8')).items()}
+            return json_response(*youtube.grant(params))
+        if method == 'GET' and path == '/emulator':
+            return json_response(200, youtube.state())
+        if method == 'POST' and path == '/emulator/faults':
+            faults = json.loads(body)
+            unknown = set(faults) - set(FAULTS)
+            if unknown:
+                raise ValueError('Unknown faults %s' % ', '.join(sorted(unknown)))
+            youtube.faults.update(faults)
+            return json_response(200, youtube.faults)
+        if method == 'POST' and path == '/emulator/quota':
+            settings = json.loads(body)
+            with youtube.lock:
+                youtube.quota = settings.get('limit')
+                youtube.spent = int(settings.get('spent', 0))
+            return json_response(200, youtube.state()['quota'])
+        if method == 'POST' and path == '/emulator/accounts':
+            settings = json.loads(body)
+            items = int(settings.get('items', 0))
+            youtube.accounts[settings['name']] = Account.synthetic(items) if items else Account()
+            return json_response(200, youtube.state()['accounts'][settings['name']])
+
+        return youtube.handle(method, self.path, dict(self.headers), body)
+
+    def log_message(self, format, *args):
+        return
+
+def make_server(youtube, port):
+    """
+    Returns an HTTP server of youtube on port, answering each connection in its own thread
+    """
+
+    server = ThreadingHTTPServer(('', port), EmulatorHandler)
+    server.daemon_threads = True
+    server.youtube = youtube
+
+    return server
+
+def serve(youtube, port=0):
+    """
+    Serves youtube on port from a daemon thread, returning the server
+
+    Port 0 picks a free port, found in server.server_address.
+    """
+
+    server = make_server(youtube, port)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    return server
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Local YouTube Data API emulator. Point ytmapi at it with '
+            'YOUTUBE_API_URL=http://localhost:PORT/ and GOOGLE_TOKEN_URI=http://localhost:PORT/token.')
+    parser.add_argument('--port', type=int, default=8090)
+    parser.add_argument('--accounts', type=int, default=1, help='synthetic accounts source0.. and empty accounts target0.. to create')
+    parser.add_argument('--items', type=int, default=1000, help='items in each synthetic account')
+    parser.add_argument('--quota', type=int, default=None, help='daily quota units, unlimited by default')
+    parser.add_argument('--token-lifetime', type=int, default=TOKEN_LIFETIME, help='seconds access tokens are accepted for')
+    parser.add_argument('--seed', type=int, default=None, help='seed of the random faults')
+    for name, default in FAULTS.items():
+        if isinstance(default, bool):
+            parser.add_argument('--' + name.replace('_', '-'), action='store_true')
+        else:
+            parser.add_argument('--' + name.replace('_', '-'), type=type(default), default=default)
+    args = parser.parse_args()
+
+    random.seed(args.seed)
+    accounts = {}
+    for i in range(args.accounts):
+        accounts['source%s' % i] = Account.synthetic(args.items)
+        accounts['target%s' % i] = Account()
+    youtube = FakeYouTube(accounts, quota=args.quota, token_lifetime=args.token_lifetime,
+            faults={name : getattr(args, name) for name in FAULTS})
+
+    server = make_server(youtube, args.port)
+    print('Emulating YouTube at http://localhost:%s/' % args.port)
+    server.serve_forever()
@@ -23,3 +23,15 @@ class AddImportForm(FlaskForm):
     subscriptions = BooleanField("Subscriptions")
     likedVideos = BooleanField("Liked Videos")
     playlists = BooleanField("Your Playlists")
+
+class AddMigrateForm(FlaskForm):
+    """Form to select data to migrate to another account"""
+    subscriptions = BooleanField("Subscriptions")
+    likedVideos = BooleanField("Liked Videos")
+    playlists = BooleanField("Your Playlists")
+
+class AddCancelJobForm(FlaskForm):
+    """Form to cancel a background job"""
+
+class AddResumeJobForm(FlaskForm):
+    """Form to resume a failed export"""
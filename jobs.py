@@ -0,0 +1,708 @@
+from models import db, Job, User, Credential, ExportedItem, LikedVideo, Subscription, Playlist
+import ytmapi
+import quota
+import metrics
+import selection
+import json
+import logging
+import os
+import time
+from collections import Counter
+from itertools import groupby
+
+logger = logging.getLogger(__name__)
+
+# Job states, in the order a job normally moves through them
+QUEUED = 'queued'
+RUNNING = 'running'
+DONE = 'done'
+FAILED = 'failed'
+CANCELLED = 'cancelled'
+
+# Jobs in these states will not change again
+FINISHED_STATES = (DONE, FAILED, CANCELLED)
+
+# Seconds a failed export is offered for resuming
+RESUMABLE_FOR = 60 * 60 * 24
+
+# Most failed items listed in a job's report
+REPORT_MAX_FAILURES = 1000
+
+# Pages a migration lists from the source account ahead of inserting them into the target
+MIGRATION_READ_AHEAD = int(os.environ.get('MIGRATION_READ_AHEAD', 8))
+
+# Kinds of job that can be queued again after failing, skipping what they already did
+RESUMABLE_KINDS = ('export', 'migrate')
+
+# Seconds a running job may go without progress before its worker is taken to be dead
+JOB_STALE_AFTER = int(os.environ.get('JOB_STALE_AFTER', 15 * 60))
+
+# Error recorded on jobs that were running when their worker died
+WORKER_DIED = 'The worker running this job stopped'
+
+metrics.describe('job_items_total', 'counter', 'Items imported or exported by jobs, by job kind')
+
+class JobCancelled(Exception):
+    """Raised inside a running job once the user has cancelled it."""
+
+class PlaylistNotCreated(Exception):
+    """Reported for each video of a playlist that could not be created in the target account."""
+
+def enqueue_job(user, kind, payload):
+    """
+    Saves a new queued job for the worker process to pick up
+    """
+
+    job = Job(
+            user_id = user.id,
+            kind = kind,
+            state = QUEUED,
+            payload = json.dumps(payload),
+            created_at = time.time()
+            )
+    db.session.add(job)
+    db.session.commit()
+
+    return job
+
+def claim_job():
+    """
+    Marks the oldest queued job as running and returns it, or None if there is no work
+    """
+
+    recover_stale_jobs()
+
+    # Lock the row so concurrent workers never claim the same job
+    query = Job.query.filter_by(state=QUEUED).order_by(Job.created_at)
+    if db.engine.dialect.name == 'postgresql':
+        query = query.with_for_update(skip_locked=True)
+    job = query.first()
+    if job is None:
+        db.session.commit()
+        return None
+
+    job.state = RUNNING
+    job.started_at = time.time()
+    job.heartbeat_at = job.started_at
+    db.session.commit()
+
+    return job
+
+def recover_stale_jobs(now=None):
+    """
+    Recovers running jobs whose worker stopped sending progress JOB_STALE_AFTER seconds ago
+
+    Exports and migrations are queued again, to carry on where they stopped.
+    Other jobs are failed, and the user can start them again. Returns the
+    number of jobs recovered.
+    """
+
+    now = now or time.time()
+    stale = Job.query.filter(Job.state == RUNNING, Job.heartbeat_at < now - JOB_STALE_AFTER)
+    requeued = stale.filter(Job.kind.in_(RESUMABLE_KINDS)).update({
+            'state' : QUEUED,
+            'error' : None,
+            'finished_at' : None
+            }, synchronize_session=False)
+    failed = stale.filter(~Job.kind.in_(RESUMABLE_KINDS)).update({
+            'state' : FAILED,
+            'error' : WORKER_DIED,
+            'finished_at' : now
+            }, synchronize_session=False)
+    db.session.commit()
+    if requeued or failed:
+        logger.warning('Requeued %d and failed %d jobs left running by a stopped worker', requeued, failed)
+
+    return requeued + failed
+
+def cancel_job(job):
+    """
+    Cancels a job that has not finished yet
+    """
+
+    if job.state not in FINISHED_STATES:
+        job.state = CANCELLED
+        job.finished_at = time.time()
+        db.session.commit()
+
+    return
+
+def resume_job(job):
+    """
+    Queues a failed or cancelled export or migration again, to carry on where it stopped
+    """
+
+    if job.kind in RESUMABLE_KINDS and job.state in (FAILED, CANCELLED):
+        job.state = QUEUED
+        job.error = None
+        job.finished_at = None
+
+        # Items that failed are tried again, so they are reported again if they still fail
+        if job.report:
+            report = json.loads(job.report)
+            report['failed'] = 0
+            report['failures'] = []
+            job.report = json.dumps(report)
+        db.session.commit()
+
+    return
+
+def job_progress(job):
+    """
+    Returns a dictionary describing how far along a job is
+    """
+
+    # Items per second since the job started
+    throughput = 0
+    if job.started_at is not None:
+        elapsed = (job.finished_at or time.time()) - job.started_at
+        if elapsed > 0:
+            throughput = job.items_done / elapsed
+
+    progress = {
+            'id' : job.id,
+            'kind' : job.kind,
+            'state' : job.state,
+            'items_done' : job.items_done,
+            'items_total' : job.items_total,
+            'throughput' : round(throughput, 2),
+            'error' : job.error,
+            'report' : json.loads(job.report) if job.report else None
+            }
+
+    return progress
+
+def make_progress(job):
+    """
+    Returns a progress callback for ytmapi that records counts on the job
+    and in the job_items_total metric
+
+    The callback raises JobCancelled once the job has been cancelled, which
+    stops the job at the next page or batch. Each call also marks the job as
+    still alive, so it is not recovered as stale.
+    """
+
+    def progress(done, total=0):
+        metrics.inc('job_items_total', done, kind=job.kind)
+        job.items_done += done
+        job.items_total += total
+        job.heartbeat_at = time.time()
+        db.session.commit()
+        quota.flush()
+        state = db.session.query(Job.state).filter_by(id=job.id).scalar()
+        if state == CANCELLED:
+            raise JobCancelled()
+
+    return progress
+
+def new_report():
+    """
+    Returns an empty report of how each item of a job turned out
+    """
+
+    return {'succeeded' : 0, 'duplicate' : 0, 'failed' : 0, 'failures' : []}
+
+def add_failures(report, failures):
+    """
+    Adds (item, exception) pairs to a job report
+    """
+
+    for item, exception in failures:
+        logger.warning('%s failed: %s', item, exception)
+        report['failed'] += 1
+        if len(report['failures']) < REPORT_MAX_FAILURES:
+            report['failures'].append({'item' : item, 'reason' : ytmapi.error_reason(exception)})
+
+    return
+
+def add_results(report, results, describe):
+    """
+    Adds the outcome of each batched call to a job report, naming items with describe(key)
+    """
+
+    failures = []
+    for key, (response, exception) in results.items():
+        if exception is None:
+            report['succeeded'] += 1
+        elif ytmapi.classify_error(exception) == ytmapi.DUPLICATE:
+            report['duplicate'] += 1
+        else:
+            failures.append((describe(key), exception))
+    add_failures(report, failures)
+
+    return
+
+def run_import(job, user, payload, report):
+    """
+    Runs api client imports for selected categories
+
+    A category that fails is added to the report and the next one still runs.
+    """
+
+    # Refuse imports that would run out of quota part way through
+    categories = [category for category in ('subscriptions', 'likedVideos', 'playlists') if payload.get(category)]
+    quota.check(sum(ytmapi.estimate_import(user, categories).values()))
+
+    progress = make_progress(job)
+    failures = []
+    importers = {
+            'subscriptions' : lambda: ytmapi.import_subscriptions(user, progress),
+            'likedVideos' : lambda: ytmapi.import_liked_videos(user, progress),
+            'playlists' : lambda: ytmapi.import_playlists(user, progress, failures)
+            }
+    for category in categories:
+        try:
+            importers[category]()
+        except ytmapi.API_ERRORS as exception:
+            db.session.rollback()
+            ytmapi.report_failure(failures, category, exception)
+
+    add_failures(report, failures)
+    report['succeeded'] = job.items_done
+
+    return
+
+def export_steps(videos, channels, playlists, contents):
+    """
+    Lists every item an export creates, in order, as (kind, source_id, item) tuples
+
+    Playlist videos are identified by playlist and position, so a video that
+    appears twice in a playlist is exported twice.
+    """
+
+    steps = [('video', video.video_id, video) for video in videos]
+    steps.extend(('channel', channel.channel_id, channel) for channel in channels)
+    for playlist in playlists:
+        steps.append(('playlist', playlist.resource_id, playlist))
+        steps.extend(('playlist_video', '%s:%s' % (playlist.resource_id, position), (playlist, videoId))
+                for position, videoId in enumerate(contents[playlist.id]))
+
+    return steps
+
+def describe_step(step):
+    """
+    Names an export step for job reports
+    """
+
+    kind, source_id, item = step
+    if kind == 'playlist':
+        return 'playlist ' + item.title
+    if kind == 'playlist_video':
+        return 'video %s in playlist %s' % (item[1], item[0].title)
+
+    return '%s %s' % (kind, source_id)
+
+def target_account(user, role=ytmapi.SOURCE):
+    """
+    Returns the Google account linked in role, which exports and migrations go
+    to, or None if it is not known
+
+    Credentials linked before accounts were recorded have no account until
+    they are linked again.
+    """
+
+    credential = Credential.query.filter_by(user_id=user.id, role=role).first()
+    if credential is None:
+        return None
+
+    return credential.account
+
+def load_ledger(user, account):
+    """
+    Returns the target ids of items already exported to an account, keyed by (kind, source_id)
+
+    An unknown account has an empty ledger, since what the ledger has for one
+    unknown account may have gone to another.
+    """
+
+    if account is None:
+        return {}
+
+    rows = db.session.query(ExportedItem.kind, ExportedItem.source_id, ExportedItem.target_id).filter_by(user_id=user.id, account=account)
+
+    return {(kind, source_id): target_id for kind, source_id, target_id in rows}
+
+def save_ledger(user, account, exported):
+    """
+    Records (kind, source_id, target_id) tuples as exported to an account, without committing
+
+    Nothing is recorded for an unknown account.
+    """
+
+    if account is None:
+        return
+
+    now = time.time()
+    rows = [{'user_id' : user.id, 'account' : account, 'kind' : kind, 'source_id' : source_id, 'target_id' : target_id, 'created_at' : now}
+            for kind, source_id, target_id in exported]
+    ytmapi.upsert_rows(ExportedItem, rows, ['user_id', 'account', 'kind', 'source_id'])
+
+    return
+
+def pending_steps(steps, ledger):
+    """
+    Returns the indexes of steps not in the ledger
+    """
+
+    return [index for index, (kind, source_id, item) in enumerate(steps) if (kind, source_id) not in ledger]
+
+class TargetState():
+    """
+    What a target account already has, listed once so exports skip it
+
+    Liked videos and subscriptions are listed up front, at one quota unit per
+    50, for each kind where that costs less than inserting the pending items
+    blindly would. A playlist's contents are listed the first time its videos
+    come up, if the playlist was created before this job.
+    """
+
+    def __init__(self, user, ledger, role=ytmapi.SOURCE):
+        self.user = user
+        self.role = role
+        self.liked = None
+        self.subscribed = None
+        self.playlists = {source_id for kind, source_id in ledger if kind == 'playlist'}
+        self.contents = {}
+        self.used = {}
+
+    def load(self, counts):
+        """
+        Lists the target's likes and subscriptions, given how many of each kind of step are pending
+        """
+
+        if counts.get('video') and self.worth_listing('likedVideos', counts['video']):
+            self.liked = {item['id'] for page in ytmapi.get_liked_videos(self.user, role=self.role) for item in page['items']}
+        if counts.get('channel') and self.worth_listing('subscriptions', counts['channel']):
+            self.subscribed = {item['snippet']['resourceId']['channelId']
+                    for page in ytmapi.get_subscriptions(self.user, role=self.role) for item in page['items']}
+
+        return
+
+    def worth_listing(self, category, pending):
+        """
+        Returns True if listing a category of the target costs less than inserting pending items
+        """
+
+        return quota.estimate_pages(ytmapi.count_items(self.user, category, self.role)) < quota.estimate_inserts(pending)
+
+    def playlist_contents(self, playlist, ledger):
+        """
+        Returns a count of each video in the target copy of a source playlist, listing it the first time
+        """
+
+        if playlist.resource_id in self.contents:
+            return self.contents[playlist.resource_id]
+
+        contents = self.contents[playlist.resource_id] = Counter()
+        if playlist.resource_id in self.playlists:
+            try:
+                for page in ytmapi.get_playlist_items(self.user, ledger[('playlist', playlist.resource_id)], role=self.role):
+                    contents.update(item['snippet']['resourceId']['videoId'] for item in page['items'])
+            except ytmapi.API_ERRORS as exception:
+                if ytmapi.classify_error(exception) == ytmapi.FATAL:
+                    raise
+
+        return contents
+
+    def split(self, steps, pending, ledger):
+        """
+        Splits pending step indexes into those the target lacks and those it already has
+
+        Each copy of a video in a target playlist accounts for one position,
+        and positions the ledger has use theirs up first, so every step of a
+        playlist must be passed in order, pending or not.
+        """
+
+        pending = set(pending)
+        missing = []
+        present = []
+        for index, (kind, source_id, item) in enumerate(steps):
+            if kind == 'playlist_video':
+                used = self.used.setdefault(item[0].resource_id, Counter())
+                if (kind, source_id) in ledger:
+                    used[item[1]] += 1
+                elif index in pending and self.playlist_contents(item[0], ledger)[item[1]] > used[item[1]]:
+                    used[item[1]] += 1
+                    present.append(index)
+                elif index in pending:
+                    missing.append(index)
+                continue
+            if index not in pending:
+                continue
+            if kind == 'video' and self.liked is not None and source_id in self.liked:
+                present.append(index)
+            elif kind == 'channel' and self.subscribed is not None and source_id in self.subscribed:
+                present.append(index)
+            else:
+                missing.append(index)
+
+        return missing, present
+
+def skip_present(user, account, steps, present, ledger, report):
+    """
+    Records steps the target already has in the ledger, without committing, and reports them as duplicates
+    """
+
+    exported = []
+    for index in present:
+        kind, source_id, item = steps[index]
+        ledger[(kind, source_id)] = None
+        exported.append((kind, source_id, None))
+    save_ledger(user, account, exported)
+    report['duplicate'] += len(present)
+
+    return
+
+def estimate_export(user, items):
+    """
+    Predicts the quota units exporting the selected items will spend, leaving out items already exported
+
+    Items the target account has from elsewhere are only found when the export
+    lists it, so this is an upper bound.
+    """
+
+    videos, channels, playlists, contents = selection.select_items(user, items)
+    steps = export_steps(videos, channels, playlists, contents)
+    pending = pending_steps(steps, load_ledger(user, target_account(user)))
+
+    return quota.estimate_inserts(len(pending))
+
+def export_chunk(user, steps, chunk, ledger, role=ytmapi.SOURCE):
+    """
+    Exports a chunk of steps of one kind to the user's account in role, returning outcomes keyed by step index
+    """
+
+    kind, source_id, item = steps[chunk[0]]
+    if kind == 'playlist':
+        try:
+            response = ytmapi.export_playlist(item, user, role)
+            return {chunk[0] : (response, None)}
+        except ytmapi.API_ERRORS as exception:
+            if ytmapi.classify_error(exception) == ytmapi.FATAL:
+                raise
+            return {chunk[0] : (None, exception)}
+
+    if kind == 'playlist_video':
+        playlistId = ledger[('playlist', item[0].resource_id)]
+        results = ytmapi.export_playlist_vids([steps[index][2][1] for index in chunk], playlistId, user, role=role)
+        return {chunk[position] : outcome for position, outcome in results.items()}
+
+    if kind == 'video':
+        results = ytmapi.export_ratings([steps[index][2] for index in chunk], user, role=role)
+    else:
+        results = ytmapi.export_subscriptions([steps[index][2] for index in chunk], user, role=role)
+    indexes = {steps[index][1] : index for index in chunk}
+
+    return {indexes[source_id] : outcome for source_id, outcome in results.items()}
+
+def step_group(steps, index):
+    """
+    Returns what export steps are batched by: their kind, and for playlist videos
+    their playlist, while every playlist is created on its own
+    """
+
+    kind, source_id, item = steps[index]
+    if kind == 'playlist_video':
+        return kind, item[0].resource_id
+    if kind == 'playlist':
+        return kind, index
+
+    return kind, None
+
+def export_pending(user, account, steps, pending, ledger, report, role=ytmapi.SOURCE):
+    """
+    Exports the pending steps to the user's account in role in batches, yielding each chunk of step indexes once it is done
+
+    Each chunk's outcomes are added to the report, and what it created to the
+    ledger, without committing, so the caller commits them with its own progress.
+    """
+
+    for (kind, key), indexes in groupby(pending, key=lambda index: step_group(steps, index)):
+        for chunk in ytmapi.chunked(indexes, ytmapi.BATCH_SIZE):
+
+            # Videos of a playlist that could not be created have nowhere to go, and fail
+            if kind == 'playlist_video' and ('playlist', key) not in ledger:
+                results = {index : (None, PlaylistNotCreated()) for index in chunk}
+            else:
+                results = export_chunk(user, steps, chunk, ledger, role)
+            add_results(report, results, lambda index: describe_step(steps[index]))
+
+            # Record what was created
+            exported = []
+            for index, (response, exception) in results.items():
+                if exception is None or ytmapi.classify_error(exception) == ytmapi.DUPLICATE:
+                    kind, source_id, item = steps[index]
+                    target_id = (response or {}).get('id')
+                    ledger[(kind, source_id)] = target_id
+                    exported.append((kind, source_id, target_id))
+            save_ledger(user, account, exported)
+            yield chunk
+
+def run_export(job, user, payload, report):
+    """
+    Exports selected items using batched api client requests, reporting each item's outcome
+
+    Every item created is written to the export ledger in the same transaction
+    that records its progress. Rerunning or resuming an export skips items the
+    ledger has for the target account, so neither creates a playlist or spends
+    quota twice, however the selected items changed in between.
+    """
+
+    videos, channels, playlists, contents = selection.select_items(user, payload['items'])
+    steps = export_steps(videos, channels, playlists, contents)
+    account = target_account(user)
+    if account is None:
+        logger.warning('Job %s exports to an account linked before accounts were recorded, so it skips nothing it exported before', job.id)
+    ledger = load_ledger(user, account)
+    pending = pending_steps(steps, ledger)
+
+    # Leave out what the target account already has
+    state = TargetState(user, ledger)
+    state.load(Counter(steps[index][0] for index in pending))
+    pending, present = state.split(steps, pending, ledger)
+    skip_present(user, account, steps, present, ledger, report)
+
+    # Refuse exports that would run out of quota part way through
+    quota.check(quota.estimate_inserts(len(pending)))
+
+    # Count finished items as done so progress has a real total
+    progress = make_progress(job)
+    job.items_done = len(steps) - len(pending)
+    job.items_total = len(steps)
+    progress(0)
+
+    # Commit each chunk the ledger records along with its progress
+    for chunk in export_pending(user, account, steps, pending, ledger, report):
+        progress(len(chunk))
+
+    return
+
+def source_steps(user, credentials, categories, failures):
+    """
+    Lists the selected categories of the user's source account a page at a time,
+    yielding each page as export steps with the items it adds to the total
+
+    Runs on a read-ahead thread, so user is a ytmapi.DetachedUser and nothing
+    here touches the database. Each page of playlists comes before the videos
+    of the playlists on it. Playlists whose videos cannot be listed are added
+    to failures.
+    """
+
+    ytmapi.get_service(user, credentials)
+    if 'likedVideos' in categories:
+        for index, page in enumerate(ytmapi.get_liked_videos(user)):
+            yield [('video', item['id'], LikedVideo(video_id=item['id'])) for item in page['items']], ytmapi.page_total(page, index == 0)
+
+    if 'subscriptions' in categories:
+        for index, page in enumerate(ytmapi.get_subscriptions(user)):
+            channel_ids = [item['snippet']['resourceId']['channelId'] for item in page['items']]
+            yield [('channel', channel_id, Subscription(channel_id=channel_id)) for channel_id in channel_ids], ytmapi.page_total(page, index == 0)
+
+    if 'playlists' not in categories:
+        return
+    for index, page in enumerate(ytmapi.get_playlists(user)):
+        playlists = [Playlist(resource_id=item['id'], title=item['snippet']['title'], privacy_status=item['status']['privacyStatus'])
+                for item in page['items']]
+        yield [('playlist', playlist.resource_id, playlist) for playlist in playlists], ytmapi.page_total(page, index == 0)
+
+        # Positions number a playlist's videos across its pages, as export_steps() does
+        for playlist in playlists:
+            position = 0
+            try:
+                for item_index, items in enumerate(ytmapi.get_playlist_items(user, playlist.resource_id)):
+                    video_ids = [item['snippet']['resourceId']['videoId'] for item in items['items']]
+                    yield [('playlist_video', '%s:%s' % (playlist.resource_id, position + offset), (playlist, video_id))
+                            for offset, video_id in enumerate(video_ids)], ytmapi.page_total(items, item_index == 0)
+                    position += len(video_ids)
+            except ytmapi.API_ERRORS as exception:
+                ytmapi.report_failure(failures, 'playlist ' + playlist.title, exception)
+
+def run_migration(job, user, payload, report):
+    """
+    Copies selected categories straight from the user's source account to their target account
+
+    A read-ahead thread lists the source up to MIGRATION_READ_AHEAD pages ahead
+    while this thread inserts each page into the target, so the migration takes
+    about as long as the slower of the two rather than both, and nothing is
+    saved to the user's library. Items the ledger has for the target account
+    are skipped, so a resumed or repeated migration only inserts what is left.
+    """
+
+    # Refuse migrations that cannot even list the source today
+    categories = [category for category in ('likedVideos', 'subscriptions', 'playlists') if payload.get(category)]
+    quota.check(sum(ytmapi.estimate_import(user, categories).values()))
+
+    account = target_account(user, ytmapi.TARGET)
+    if account is None:
+        logger.warning('Job %s migrates to an account linked before accounts were recorded, so it skips nothing it migrated before', job.id)
+    ledger = load_ledger(user, account)
+    credentials = ytmapi.get_credentials(user.id)
+
+    # Leave out what the target account already has, sized by what the source has
+    state = TargetState(user, ledger, ytmapi.TARGET)
+    state.load({kind : ytmapi.count_items(user, category) for kind, category in (('video', 'likedVideos'), ('channel', 'subscriptions'))
+            if category in categories})
+
+    progress = make_progress(job)
+    job.items_done = 0
+    job.items_total = 0
+    failures = []
+    pages = ytmapi.read_ahead(source_steps(ytmapi.DetachedUser(user.id), credentials, categories, failures), MIGRATION_READ_AHEAD)
+    try:
+        for steps, total in pages:
+            pending = [index for index, (kind, source_id, item) in enumerate(steps) if (kind, source_id) not in ledger]
+            pending, present = state.split(steps, pending, ledger)
+            skip_present(user, account, steps, present, ledger, report)
+            progress(len(steps) - len(pending), total)
+            for chunk in export_pending(user, account, steps, pending, ledger, report, ytmapi.TARGET):
+                progress(len(chunk))
+    finally:
+        # Stop listing the source once inserting stops, however it stopped
+        pages.close()
+
+    add_failures(report, failures)
+
+    return
+
+# Functions that run each kind of job
+RUNNERS = {
+        'import' : run_import,
+        'export' : run_export,
+        'migrate' : run_migration
+        }
+
+def run_job(job):
+    """
+    Runs a claimed job to completion, recording how it finished
+    """
+
+    user = User.query.get(job.user_id)
+
+    # A resumed job adds to the report it already has
+    report = json.loads(job.report) if job.report else new_report()
+    try:
+        RUNNERS[job.kind](job, user, json.loads(job.payload), report)
+        state = DONE
+        error = None
+    except JobCancelled:
+        state = CANCELLED
+        error = None
+    except Exception as exception:
+        logger.exception('Job %s failed', job.id)
+        db.session.rollback()
+        state = FAILED
+        error = str(exception)
+
+    # Save quota spent since the last progress update
+    quota.flush()
+
+    # A cancellation from the web process wins over whatever the job got to
+    db.session.refresh(job)
+    job.report = json.dumps(report)
+    if job.state != CANCELLED:
+        job.state = state
+        job.error = error
+        job.finished_at = time.time()
+    db.session.commit()
+
+    return
@@ -0,0 +1,34 @@
+from models import db, LikedVideo, Subscription, Playlist
+
+# Items in one page of a dashboard list, and the most a client may ask for
+PAGE_SIZE = 100
+MAX_PAGE_SIZE = 500
+
+# Model and displayed columns of each dashboard list
+LISTINGS = {
+        'likes' : (LikedVideo, ('video_id', 'title', 'channel_title', 'thumbnail')),
+        'subscriptions' : (Subscription, ('channel_id', 'title', 'thumbnail')),
+        'playlists' : (Playlist, ('resource_id', 'title', 'privacy_status', 'thumbnail'))
+        }
+
+def list_page(user_id, category, after=None, limit=None):
+    """
+    Returns one page of a user's items in a category as dictionaries, and the cursor of the next page
+
+    Pages are ordered by id and start after the id given as cursor, so each
+    one is a single index range scan however deep the client has scrolled.
+    Only the displayed columns are selected, without building ORM objects.
+    The cursor is None on the last page.
+    """
+
+    limit = limit or PAGE_SIZE
+    model, columns = LISTINGS[category]
+    query = db.session.query(model.id, *[getattr(model, column) for column in columns]).filter(model.user_id == user_id)
+    if after is not None:
+        query = query.filter(model.id > after)
+    rows = query.order_by(model.id).limit(limit + 1).all()
+
+    items = [dict(zip(columns, row[1:])) for row in rows[:limit]]
+    cursor = rows[limit - 1].id if len(rows) > limit else None
+
+    return items, cursor
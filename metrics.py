@@ -0,0 +1,223 @@
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from sqlalchemy import event
+import bisect
+import hmac
+import os
+import threading
+import time
+
+# Bearer token a scraper must send to read metrics. Without one, metrics are not served
+METRICS_TOKEN = os.environ.get('METRICS_TOKEN')
+
+# Upper bounds in seconds of the buckets latency histograms count into
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+# Upper bounds of the buckets per-request query counts are counted into
+QUERY_COUNT_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 500)
+
+# Type and help text of each metric, keyed by name
+descriptions = {}
+
+# Current values keyed by (name, labels), labels being a sorted tuple of pairs
+counters = {}
+gauges = {}
+histograms = {}
+
+lock = threading.Lock()
+
+def describe(name, kind, text):
+    """
+    Sets the type (counter, gauge or histogram) and help text a metric is listed with
+    """
+
+    descriptions[name] = (kind, text)
+
+    return
+
+def label_key(name, labels):
+    """
+    Returns the key a metric with these labels is stored under
+    """
+
+    return name, tuple(sorted((key, str(value)) for key, value in labels.items()))
+
+def inc(name, amount=1, **labels):
+    """
+    Adds amount to a counter
+    """
+
+    key = label_key(name, labels)
+    with lock:
+        counters[key] = counters.get(key, 0) + amount
+
+    return
+
+def set_gauge(name, value, **labels):
+    """
+    Sets a gauge to value
+    """
+
+    with lock:
+        gauges[label_key(name, labels)] = value
+
+    return
+
+def observe(name, value, buckets=LATENCY_BUCKETS, **labels):
+    """
+    Counts value into a histogram
+    """
+
+    key = label_key(name, labels)
+    with lock:
+        histogram = histograms.get(key)
+        if histogram is None:
+            histogram = histograms[key] = {'buckets' : buckets, 'counts' : [0] * len(buckets), 'sum' : 0, 'count' : 0}
+        index = bisect.bisect_left(histogram['buckets'], value)
+        if index < len(histogram['counts']):
+            histogram['counts'][index] += 1
+        histogram['sum'] += value
+        histogram['count'] += 1
+
+    return
+
+@contextmanager
+def timed(name, **labels):
+    """
+    Observes the seconds the block takes in a histogram, whether or not it raises
+    """
+
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe(name, time.perf_counter() - start, **labels)
+
+def format_labels(labels, extra=()):
+    """
+    Returns labels in Prometheus text format, such as {route="dashboard"}
+    """
+
+    pairs = list(labels) + list(extra)
+    if not pairs:
+        return ''
+
+    escaped = [(key, value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')) for key, value in pairs]
+
+    return '{%s}' % ','.join('%s="%s"' % pair for pair in escaped)
+
+def render():
+    """
+    Returns every metric of this process in the Prometheus text exposition format
+    """
+
+    with lock:
+        samples = {}
+        for (name, labels), value in counters.items():
+            samples.setdefault(name, []).append('%s%s %s' % (name, format_labels(labels), value))
+        for (name, labels), value in gauges.items():
+            samples.setdefault(name, []).append('%s%s %s' % (name, format_labels(labels), value))
+        for (name, labels), histogram in histograms.items():
+            lines = samples.setdefault(name, [])
+            cumulative = 0
+            for bound, count in zip(histogram['buckets'], histogram['counts']):
+                cumulative += count
+                lines.append('%s_bucket%s %s' % (name, format_labels(labels, [('le', repr(float(bound)))]), cumulative))
+            lines.append('%s_bucket%s %s' % (name, format_labels(labels, [('le', '+Inf')]), histogram['count']))
+            lines.append('%s_sum%s %s' % (name, format_labels(labels), histogram['sum']))
+            lines.append('%s_count%s %s' % (name, format_labels(labels), histogram['count']))
+
+    output = []
+    for name in sorted(samples):
+        if name in descriptions:
+            kind, text = descriptions[name]
+            output.append('# HELP %s %s' % (name, text))
+            output.append('# TYPE %s %s' % (name, kind))
+        output.extend(samples[name])
+
+    return '\n'.join(output) + '\n'
+
+# Statements run by the current thread since reset_queries(), for per-request totals
+queries = threading.local()
+
+describe('db_query_seconds', 'histogram', 'Seconds each database statement took')
+
+def reset_queries():
+    """
+    Starts counting the current thread's statements from zero
+    """
+
+    queries.count = 0
+    queries.seconds = 0
+
+    return
+
+def query_totals():
+    """
+    Returns the number of statements the current thread ran since reset_queries(), and their seconds
+    """
+
+    return getattr(queries, 'count', 0), getattr(queries, 'seconds', 0)
+
+def watch_queries(engine):
+    """
+    Times every statement run on engine into db_query_seconds and the current thread's totals
+    """
+
+    def before(conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault('metrics_query_start', []).append(time.perf_counter())
+
+    def after(conn, cursor, statement, parameters, context, executemany):
+        seconds = time.perf_counter() - conn.info['metrics_query_start'].pop()
+        observe('db_query_seconds', seconds)
+        queries.count = getattr(queries, 'count', 0) + 1
+        queries.seconds = getattr(queries, 'seconds', 0) + seconds
+
+    event.listen(engine, 'before_cursor_execute', before)
+    event.listen(engine, 'after_cursor_execute', after)
+
+    return
+
+def authorized(header):
+    """
+    Returns True if an Authorization header carries the metrics bearer token
+    """
+
+    if not METRICS_TOKEN or not header:
+        return False
+    scheme, _, token = header.partition(' ')
+
+    return scheme.lower() == 'bearer' and hmac.compare_digest(token.strip().encode('utf-8'), METRICS_TOKEN.encode('utf-8'))
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    """
+    Answers every GET carrying the metrics token with the metrics of this process
+    """
+
+    def do_GET(self):
+        if not authorized(self.headers.get('Authorization')):
+            self.send_response(401)
+            self.send_header('WWW-Authenticate', 'Bearer')
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+
+        body = render().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        return
+
+def serve(port):
+    """
+    Serves metrics on port from a daemon thread, for processes without a web server
+    """
+
+    server = ThreadingHTTPServer(('', port), MetricsHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    return server
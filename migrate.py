@@ -0,0 +1,94 @@
+from models import db, connect_db
+import os
+from flask import Flask
+
+app = Flask(__name__)
+
+DATABASE_URL = os.environ['DATABASE_URL']
+app.config['SQLALCHEMY_DATABASE_URI'] = DATABASE_URL
+app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+connect_db(app)
+
+# Schema changes db.create_all() cannot make to existing tables, in order.
+# Every statement is safe to run again on an already migrated database.
+MIGRATIONS = [
+        # Playlist videos remember their position so repeated videos stay distinct
+        """ALTER TABLE playlist_videos ADD COLUMN IF NOT EXISTS position INTEGER NOT NULL DEFAULT 0""",
+        """UPDATE playlist_videos SET position = numbered.position
+           FROM (SELECT id, ROW_NUMBER() OVER (PARTITION BY playlist_id ORDER BY id) - 1 AS position
+                 FROM playlist_videos) AS numbered
+           WHERE playlist_videos.id = numbered.id
+           AND NOT EXISTS (SELECT 1 FROM playlist_videos AS positioned WHERE positioned.position > 0)""",
+
+        # Drop duplicates left by earlier re-imports, keeping the oldest row
+        """DELETE FROM liked_videos AS a USING liked_videos AS b
+           WHERE a.id > b.id AND a.user_id = b.user_id AND a.video_id = b.video_id""",
+        """DELETE FROM subscriptions AS a USING subscriptions AS b
+           WHERE a.id > b.id AND a.user_id = b.user_id AND a.channel_id = b.channel_id""",
+        """DELETE FROM playlists AS a USING playlists AS b
+           WHERE a.id > b.id AND a.user_id = b.user_id AND a.resource_id = b.resource_id""",
+        """DELETE FROM playlist_videos AS a USING playlist_videos AS b
+           WHERE a.id > b.id AND a.playlist_id = b.playlist_id AND a.video_id = b.video_id AND a.position = b.position""",
+
+        # Natural keys used by import upserts
+        """CREATE UNIQUE INDEX IF NOT EXISTS liked_videos_user_id_video_id_key ON liked_videos (user_id, video_id)""",
+        """CREATE UNIQUE INDEX IF NOT EXISTS subscriptions_user_id_channel_id_key ON subscriptions (user_id, channel_id)""",
+        """CREATE UNIQUE INDEX IF NOT EXISTS playlists_user_id_resource_id_key ON playlists (user_id, resource_id)""",
+        """CREATE UNIQUE INDEX IF NOT EXISTS playlist_videos_playlist_id_video_id_position_key ON playlist_videos (playlist_id, video_id, position)""",
+
+        # Jobs keep a JSON report of how each item turned out
+        """ALTER TABLE jobs ADD COLUMN IF NOT EXISTS report TEXT""",
+
+        # Credentials remember which account they belong to, so exports resume from its ledger
+        """ALTER TABLE credentials ADD COLUMN IF NOT EXISTS account TEXT""",
+
+        # Indexes for per-user lookups, playlist contents, job claiming and pruning
+        """CREATE INDEX IF NOT EXISTS users_username_idx ON users (username)""",
+        """CREATE INDEX IF NOT EXISTS playlist_videos_playlist_id_position_idx ON playlist_videos (playlist_id, position)""",
+        """CREATE INDEX IF NOT EXISTS jobs_user_id_state_idx ON jobs (user_id, state)""",
+        """CREATE INDEX IF NOT EXISTS jobs_state_created_at_idx ON jobs (state, created_at)""",
+        """CREATE INDEX IF NOT EXISTS quota_usage_day_idx ON quota_usage (day)""",
+        """CREATE INDEX IF NOT EXISTS liked_videos_expiration_date_idx ON liked_videos (expiration_date)""",
+        """CREATE INDEX IF NOT EXISTS subscriptions_expiration_date_idx ON subscriptions (expiration_date)""",
+        """CREATE INDEX IF NOT EXISTS playlists_expiration_date_idx ON playlists (expiration_date)""",
+
+        # Keyset pagination of the dashboard lists
+        """CREATE INDEX IF NOT EXISTS liked_videos_user_id_id_idx ON liked_videos (user_id, id)""",
+        """CREATE INDEX IF NOT EXISTS subscriptions_user_id_id_idx ON subscriptions (user_id, id)""",
+        """CREATE INDEX IF NOT EXISTS playlists_user_id_id_idx ON playlists (user_id, id)""",
+
+        # Refreshed access tokens are saved with their expiry
+        """ALTER TABLE credentials ADD COLUMN IF NOT EXISTS expiry DOUBLE PRECISION""",
+
+        # Users link a source account and, for migrations, a target account
+        """ALTER TABLE credentials ADD COLUMN IF NOT EXISTS role TEXT NOT NULL DEFAULT 'source'""",
+        """CREATE UNIQUE INDEX IF NOT EXISTS credentials_user_id_role_key ON credentials (user_id, role)""",
+
+        # Running jobs record when they last made progress, so a dead worker's jobs can be recovered
+        """ALTER TABLE jobs ADD COLUMN IF NOT EXISTS heartbeat_at DOUBLE PRECISION""",
+
+        # Exports resume from the ledger alone, since positions shift when items change between attempts
+        """ALTER TABLE jobs DROP COLUMN IF EXISTS cursor""",
+
+        # Finished jobs and old export ledger rows are pruned
+        """CREATE INDEX IF NOT EXISTS jobs_finished_at_idx ON jobs (finished_at)""",
+        """CREATE INDEX IF NOT EXISTS export_ledger_created_at_idx ON export_ledger (created_at)""",
+
+        # The unique (user_id, role) index already serves lookups by user
+        """DROP INDEX IF EXISTS credentials_user_id_idx""",
+        ]
+
+def migrate():
+    """
+    Creates missing tables, then applies every migration in one transaction
+    """
+
+    db.create_all()
+    for statement in MIGRATIONS:
+        db.session.execute(statement)
+    db.session.commit()
+
+    return
+
+if __name__ == '__main__':
+    migrate()
@@ -1,5 +1,4 @@
 from flask_sqlalchemy import SQLAlchemy
-import datetime
 
 db = SQLAlchemy()
 
@@ -13,6 +12,9 @@ class User(db.Model):
     """User."""
 
     __tablename__ = "users"
+    __table_args__ = (
+            db.Index('users_username_idx', 'username'),
+            )
 
     id = db.Column( db.Integer, primary_key=True, autoincrement=True)
     username = db.Column( db.Text, nullable=False)
@@ -21,11 +23,19 @@ class User(db.Model):
     liked_videos = db.relationship('LikedVideo', backref='users', cascade='all, delete-orphan')
     playlists = db.relationship('Playlist', backref='users', cascade='all, delete-orphan')
     credentials = db.relationship('Credential', backref='users', cascade='all, delete-orphan')
+    jobs = db.relationship('Job', backref='users', cascade='all, delete-orphan')
+    page_etags = db.relationship('PageEtag', backref='users', cascade='all, delete-orphan')
+    exported_items = db.relationship('ExportedItem', backref='users', cascade='all, delete-orphan')
 
 class Subscription(db.Model):
     """Subscription."""
 
     __tablename__ = "subscriptions"
+    __table_args__ = (
+            db.Index('subscriptions_user_id_channel_id_key', 'user_id', 'channel_id', unique=True),
+            db.Index('subscriptions_expiration_date_idx', 'expiration_date'),
+            db.Index('subscriptions_user_id_id_idx', 'user_id', 'id'),
+            )
 
     id = db.Column( db.Integer, primary_key=True, autoincrement=True)
     user_id = db.Column( db.Integer, db.ForeignKey('users.id'))
@@ -38,6 +48,11 @@ class LikedVideo(db.Model):
     """liked Video."""
 
     __tablename__ = "liked_videos"
+    __table_args__ = (
+            db.Index('liked_videos_user_id_video_id_key', 'user_id', 'video_id', unique=True),
+            db.Index('liked_videos_expiration_date_idx', 'expiration_date'),
+            db.Index('liked_videos_user_id_id_idx', 'user_id', 'id'),
+            )
 
     id = db.Column( db.Integer, primary_key=True, autoincrement=True)
     user_id = db.Column( db.Integer, db.ForeignKey('users.id'))
@@ -51,6 +66,11 @@ class Playlist(db.Model):
     """Playlist."""
 
     __tablename__ = "playlists"
+    __table_args__ = (
+            db.Index('playlists_user_id_resource_id_key', 'user_id', 'resource_id', unique=True),
+            db.Index('playlists_expiration_date_idx', 'expiration_date'),
+            db.Index('playlists_user_id_id_idx', 'user_id', 'id'),
+            )
 
     id = db.Column( db.Integer, primary_key=True, autoincrement=True)
     user_id = db.Column( db.Integer, db.ForeignKey('users.id'))
@@ -65,17 +85,105 @@ class PlaylistVideo(db.Model):
     """PlaylistVideo."""
 
     __tablename__ = "playlist_videos"
+    __table_args__ = (
+            db.Index('playlist_videos_playlist_id_video_id_position_key', 'playlist_id', 'video_id', 'position', unique=True),
+            db.Index('playlist_videos_playlist_id_position_idx', 'playlist_id', 'position'),
+            )
 
     id = db.Column( db.Integer, primary_key=True, autoincrement=True)
     playlist_id = db.Column( db.Integer, db.ForeignKey('playlists.id', ondelete="CASCADE"))
     video_id = db.Column( db.Text, nullable=False)
+    position = db.Column( db.Integer, nullable=False, default=0)
 
 class Credential(db.Model):
     """Credential."""
 
     __tablename__ = "credentials"
+    __table_args__ = (
+            db.Index('credentials_user_id_role_key', 'user_id', 'role', unique=True),
+            )
 
     id = db.Column( db.Integer, primary_key=True, autoincrement=True)
     user_id = db.Column( db.Integer, db.ForeignKey('users.id'), primary_key=True)
+    role = db.Column( db.Text, nullable=False, default='source')
     token = db.Column( db.Text, nullable=False)
     refresh_token = db.Column( db.Text, nullable=False)
+    expiry = db.Column( db.Float)
+    account = db.Column( db.Text)
+
+class Job(db.Model):
+    """Background import or export job."""
+
+    __tablename__ = "jobs"
+    __table_args__ = (
+            db.Index('jobs_user_id_state_idx', 'user_id', 'state'),
+            db.Index('jobs_state_created_at_idx', 'state', 'created_at'),
+            db.Index('jobs_finished_at_idx', 'finished_at'),
+            )
+
+    id = db.Column( db.Integer, primary_key=True, autoincrement=True)
+    user_id = db.Column( db.Integer, db.ForeignKey('users.id'))
+    kind = db.Column( db.Text, nullable=False)
+    state = db.Column( db.Text, nullable=False, default='queued')
+    payload = db.Column( db.Text, nullable=False)
+    items_done = db.Column( db.Integer, nullable=False, default=0)
+    items_total = db.Column( db.Integer, nullable=False, default=0)
+    error = db.Column( db.Text)
+    report = db.Column( db.Text)
+    created_at = db.Column( db.Float, nullable=False)
+    started_at = db.Column( db.Float)
+    heartbeat_at = db.Column( db.Float)
+    finished_at = db.Column( db.Float)
+
+class PageEtag(db.Model):
+    """ETag of one page of a YouTube list response."""
+
+    __tablename__ = "page_etags"
+    __table_args__ = (
+            db.Index('page_etags_user_id_resource_page_token_key', 'user_id', 'resource', 'page_token', unique=True),
+            )
+
+    id = db.Column( db.Integer, primary_key=True, autoincrement=True)
+    user_id = db.Column( db.Integer, db.ForeignKey('users.id'))
+    resource = db.Column( db.Text, nullable=False)
+    page_token = db.Column( db.Text, nullable=False)
+    etag = db.Column( db.Text, nullable=False)
+    next_page_token = db.Column( db.Text)
+    item_count = db.Column( db.Integer, nullable=False)
+    total_results = db.Column( db.Integer, nullable=False)
+    expiration_date = db.Column( db.Float, nullable=False )
+
+class QuotaUsage(db.Model):
+    """YouTube API quota units spent by a user on one endpoint in one day.
+
+    Usage outlives account deletion so the project's daily total stays right.
+    """
+
+    __tablename__ = "quota_usage"
+    __table_args__ = (
+            db.Index('quota_usage_user_id_endpoint_day_key', 'user_id', 'endpoint', 'day', unique=True),
+            db.Index('quota_usage_day_idx', 'day'),
+            )
+
+    id = db.Column( db.Integer, primary_key=True, autoincrement=True)
+    user_id = db.Column( db.Integer, db.ForeignKey('users.id', ondelete='SET NULL'))
+    endpoint = db.Column( db.Text, nullable=False)
+    day = db.Column( db.Text, nullable=False)
+    units = db.Column( db.Integer, nullable=False)
+
+class ExportedItem(db.Model):
+    """Item an export has already created in a Google account, and the id it got there."""
+
+    __tablename__ = "export_ledger"
+    __table_args__ = (
+            db.Index('export_ledger_user_id_account_kind_source_id_key', 'user_id', 'account', 'kind', 'source_id', unique=True),
+            db.Index('export_ledger_created_at_idx', 'created_at'),
+            )
+
+    id = db.Column( db.Integer, primary_key=True, autoincrement=True)
+    user_id = db.Column( db.Integer, db.ForeignKey('users.id'))
+    account = db.Column( db.Text, nullable=False, default='')
+    kind = db.Column( db.Text, nullable=False)
+    source_id = db.Column( db.Text, nullable=False)
+    target_id = db.Column( db.Text)
+    created_at = db.Column( db.Float, nullable=False)
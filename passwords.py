@@ -0,0 +1,135 @@
+from concurrent.futures import ProcessPoolExecutor, TimeoutError
+from concurrent.futures.process import BrokenProcessPool
+import multiprocessing
+import os
+import threading
+import bcrypt
+import metrics
+
+# bcrypt work factor of new hashes; stored hashes with another cost are rehashed at login
+BCRYPT_LOG_ROUNDS = int(os.environ.get('BCRYPT_LOG_ROUNDS', 12))
+
+# Processes hashing passwords, which bounds the CPU a burst of logins can take from requests
+HASH_WORKERS = int(os.environ.get('HASH_WORKERS', 2))
+
+# Seconds a request waits for a hash, queueing included, before giving up
+HASH_TIMEOUT = float(os.environ.get('HASH_TIMEOUT', 10))
+
+metrics.describe('password_hash_seconds', 'histogram', 'Seconds to hash or check a password, including time queued for the pool')
+metrics.describe('password_rehashes_total', 'counter', 'Stored password hashes replaced at login because the work factor changed')
+metrics.describe('password_hash_rounds', 'gauge', 'bcrypt work factor of new password hashes')
+metrics.set_gauge('password_hash_rounds', BCRYPT_LOG_ROUNDS)
+
+class HashingUnavailable(Exception):
+    """Raised when the hashing pool has broken or is too busy to answer in time."""
+
+pool = None
+pool_lock = threading.Lock()
+
+def start():
+    """
+    Starts the hashing processes
+
+    Called before the web server starts its threads, so the processes are
+    forked from a single threaded parent. Hashing starts the pool itself if
+    this was not called.
+    """
+
+    global pool
+    with pool_lock:
+        if pool is None:
+            pool = ProcessPoolExecutor(HASH_WORKERS, mp_context=multiprocessing.get_context('fork'))
+            pool.submit(int).result()
+
+    return pool
+
+def stop():
+    """
+    Shuts the hashing processes down
+    """
+
+    global pool
+    with pool_lock:
+        if pool is not None:
+            pool.shutdown()
+            pool = None
+
+    return
+
+def discard(broken):
+    """
+    Drops a broken pool, so the next hash starts a new one
+    """
+
+    global pool
+    with pool_lock:
+        if pool is broken:
+            pool = None
+    broken.shutdown(wait=False)
+
+    return
+
+def run(operation, function, *args):
+    """
+    Runs function in the hashing pool, timing it as operation
+
+    Raises HashingUnavailable if a pool process died or no answer came within
+    HASH_TIMEOUT seconds.
+    """
+
+    with metrics.timed('password_hash_seconds', operation=operation):
+        executor = start()
+        try:
+            return executor.submit(function, *args).result(timeout=HASH_TIMEOUT)
+        except BrokenProcessPool as exception:
+            discard(executor)
+            raise HashingUnavailable('Password hashing pool broke') from exception
+        except TimeoutError as exception:
+            raise HashingUnavailable('Password hashing took over %s seconds' % HASH_TIMEOUT) from exception
+
+def hash_in_process(password, rounds):
+    """
+    Hashes a password with bcrypt, in a pool process
+    """
+
+    return bcrypt.hashpw(password.encode('utf-8'), bcrypt.gensalt(rounds)).decode('utf-8')
+
+def check_in_process(password, password_hash):
+    """
+    Checks a password against a bcrypt hash, in a pool process
+    """
+
+    return bcrypt.checkpw(password.encode('utf-8'), password_hash.encode('utf-8'))
+
+def hash_rounds(password_hash):
+    """
+    Returns the work factor a bcrypt hash was made with
+    """
+
+    return int(password_hash.split('$')[2])
+
+def hash_password(password):
+    """
+    Returns a bcrypt hash of password at the configured work factor
+    """
+
+    return run('hash', hash_in_process, password, BCRYPT_LOG_ROUNDS)
+
+def check_password(password_hash, password):
+    """
+    Checks password against a stored hash
+
+    Returns whether it matches, and a new hash to store in place of the old one
+    when the password matches but the configured work factor has changed since
+    it was hashed, otherwise None.
+    """
+
+    if not run('check', check_in_process, password, password_hash):
+        return False, None
+
+    if hash_rounds(password_hash) == BCRYPT_LOG_ROUNDS:
+        return True, None
+
+    metrics.inc('password_rehashes_total')
+
+    return True, hash_password(password)
@@ -1,26 +1,90 @@
-from models import db, connect_db, User, Subscription, LikedVideo, Playlist, PlaylistVideo, Credential
+from models import db, connect_db, LikedVideo, Subscription, Playlist, PageEtag, Job, ExportedItem, QuotaUsage
+import jobs
+import quota
 import datetime
+import logging
 import os
-from flask import Flask
-
-app = Flask(__name__)
-
-DATABASE_URL = os.environ['DATABASE_URL']
-app.config['SQLALCHEMY_DATABASE_URI'] = DATABASE_URL
-app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
-app.config['SQLALCHEMY_ECHO'] = True
-connect_db(app)
-db.create_all()
-
-timenow = datetime.datetime.utcnow().timestamp()
-vids = LikedVideo.query.filter(LikedVideo.expiration_date <= timenow).all()
-for vid in vids:
-    db.session.delete(vid)
-subs = Subscription.query.filter(Subscription.expiration_date <= timenow).all()
-for sub in subs:
-    db.session.delete(sub)
-lists = Playlist.query.filter(Playlist.expiration_date <= timenow).all()
-for plist in lists:
-    db.session.delete(plist)
-
-db.session.commit()
+import time
+
+logger = logging.getLogger(__name__)
+
+# Rows deleted per statement, so each transaction's locks and WAL stay bounded
+PRUNE_BATCH_SIZE = int(os.environ.get('PRUNE_BATCH_SIZE', 5000))
+
+# Seconds between prunes run by the worker
+PRUNE_INTERVAL = int(os.environ.get('PRUNE_INTERVAL', 60 * 60))
+
+# Tables with expiring rows. Playlist videos go with their playlists through
+# ON DELETE CASCADE, and ETags go too so the next import downloads everything.
+PRUNED_MODELS = (LikedVideo, Subscription, Playlist, PageEtag)
+
+# Days finished jobs, export ledger rows and quota usage are kept. A ledger
+# row older than this no longer stops an export creating its item again, but
+# exports still skip likes and subscriptions the target account has.
+JOB_RETENTION_DAYS = int(os.environ.get('JOB_RETENTION_DAYS', 30))
+LEDGER_RETENTION_DAYS = int(os.environ.get('LEDGER_RETENTION_DAYS', 180))
+QUOTA_RETENTION_DAYS = int(os.environ.get('QUOTA_RETENTION_DAYS', 90))
+
+def retained(now):
+    """
+    Returns (model, condition) pairs selecting rows kept past their retention as of now
+    """
+
+    day = 60 * 60 * 24
+    oldest_quota_day = datetime.datetime.fromtimestamp(now - QUOTA_RETENTION_DAYS * day, quota.QUOTA_TIMEZONE).strftime('%Y-%m-%d')
+
+    return [
+            (Job, Job.state.in_(jobs.FINISHED_STATES) & (Job.finished_at <= now - JOB_RETENTION_DAYS * day)),
+            (ExportedItem, ExportedItem.created_at <= now - LEDGER_RETENTION_DAYS * day),
+            (QuotaUsage, QuotaUsage.day < oldest_quota_day)
+            ]
+
+def prune_rows(model, condition, batch_size=None):
+    """
+    Deletes a model's rows matching condition, batch_size rows per statement and transaction
+
+    Returns the number of rows deleted.
+    """
+
+    batch_size = batch_size or PRUNE_BATCH_SIZE
+    deleted = 0
+    while True:
+        expired = db.session.query(model.id).filter(condition).limit(batch_size).subquery()
+        count = model.query.filter(model.id.in_(expired)).delete(synchronize_session=False)
+        db.session.commit()
+        deleted += count
+        if count < batch_size:
+            return deleted
+
+def prune(now=None):
+    """
+    Deletes every expired row and every row kept past its retention, logging rows/sec for each table
+
+    Returns the number of rows deleted from each table.
+    """
+
+    now = now or datetime.datetime.utcnow().timestamp()
+    pruned = [(model, model.expiration_date <= now) for model in PRUNED_MODELS] + retained(now)
+    counts = {}
+    for model, condition in pruned:
+        start = time.perf_counter()
+        counts[model.__tablename__] = prune_rows(model, condition)
+        seconds = time.perf_counter() - start
+        logger.info('Pruned %d rows from %s in %.3fs (%.0f rows/sec)', counts[model.__tablename__],
+                model.__tablename__, seconds, counts[model.__tablename__] / seconds if seconds > 0 else 0)
+
+    return counts
+
+if __name__ == '__main__':
+    from flask import Flask
+
+    app = Flask(__name__)
+
+    DATABASE_URL = os.environ['DATABASE_URL']
+    app.config['SQLALCHEMY_DATABASE_URI'] = DATABASE_URL
+    app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+    connect_db(app)
+
+    logging.basicConfig(level=logging.INFO)
+    with app.app_context():
+        prune()
@@ -0,0 +1,140 @@
+from models import db, QuotaUsage
+from sqlalchemy.dialects import postgresql
+from collections import Counter
+import datetime
+import math
+import os
+import threading
+import pytz
+
+# Project-wide YouTube Data API units available per day
+DAILY_QUOTA = int(os.environ.get('YOUTUBE_DAILY_QUOTA', 10000))
+
+# Units charged per call, by API method
+QUOTA_COSTS = {
+        'list' : 1,
+        'insert' : 50,
+        'update' : 50,
+        'delete' : 50,
+        'rate' : 50
+        }
+
+# YouTube quota days start at midnight Pacific Time
+QUOTA_TIMEZONE = pytz.timezone('America/Los_Angeles')
+
+class QuotaExceeded(Exception):
+    """Raised when a job would spend more quota than is left today."""
+
+def quota_day():
+    """
+    Returns the current quota day as YYYY-MM-DD
+    """
+
+    return datetime.datetime.now(QUOTA_TIMEZONE).strftime('%Y-%m-%d')
+
+def request_endpoint(request):
+    """
+    Returns the API method a request calls, such as videos.list
+    """
+
+    methodId = getattr(request, 'methodId', None) or 'unknown.unknown'
+
+    return methodId.split('.', 1)[-1]
+
+def request_cost(endpoint):
+    """
+    Returns the quota units charged for one call to an endpoint
+    """
+
+    return QUOTA_COSTS.get(endpoint.rsplit('.', 1)[-1], 1)
+
+# Units spent but not yet saved, keyed by (user_id, endpoint, day)
+unsaved = Counter()
+unsaved_lock = threading.Lock()
+
+def record(user_id, request):
+    """
+    Counts the quota cost of a request about to be sent
+
+    Safe to call from threads without a database session; the counts are
+    written by the next flush().
+    """
+
+    endpoint = request_endpoint(request)
+    with unsaved_lock:
+        unsaved[(user_id, endpoint, quota_day())] += request_cost(endpoint)
+
+    return
+
+def flush():
+    """
+    Adds recorded quota usage to the database
+    """
+
+    with unsaved_lock:
+        usage = dict(unsaved)
+        unsaved.clear()
+    if not usage:
+        return
+
+    rows = [{'user_id' : user_id, 'endpoint' : endpoint, 'day' : day, 'units' : units}
+            for (user_id, endpoint, day), units in usage.items()]
+    table = QuotaUsage.__table__
+    if db.engine.dialect.name == 'postgresql':
+        statement = postgresql.insert(table).values(rows)
+        statement = statement.on_conflict_do_update(
+                index_elements=['user_id', 'endpoint', 'day'],
+                set_={'units': table.c.units + statement.excluded.units}
+                )
+        db.session.execute(statement)
+    else:
+        for row in rows:
+            updated = QuotaUsage.query.filter_by(user_id=row['user_id'], endpoint=row['endpoint'], day=row['day']).update(
+                    {'units': QuotaUsage.units + row['units']}, synchronize_session=False)
+            if not updated:
+                db.session.execute(table.insert().values(row))
+    db.session.commit()
+
+    return
+
+def spent_today():
+    """
+    Returns the quota units the whole project has spent today
+    """
+
+    flush()
+    spent = db.session.query(db.func.sum(QuotaUsage.units)).filter_by(day=quota_day()).scalar()
+
+    return spent or 0
+
+def remaining():
+    """
+    Returns the quota units left for today
+    """
+
+    return max(DAILY_QUOTA - spent_today(), 0)
+
+def estimate_inserts(count):
+    """
+    Predicts the units count insert or rate calls will spend
+    """
+
+    return count * QUOTA_COSTS['insert']
+
+def estimate_pages(total):
+    """
+    Returns the number of 50 item list pages needed for total results
+    """
+
+    return max(math.ceil(total / 50), 1)
+
+def check(estimate):
+    """
+    Raises QuotaExceeded if an estimate is more than what is left today
+    """
+
+    left = remaining()
+    if estimate > left:
+        raise QuotaExceeded('This needs about %s quota units but only %s are left today.' % (estimate, left))
+
+    return
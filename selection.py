@@ -0,0 +1,140 @@
+from models import db, LikedVideo, Subscription, Playlist, PlaylistVideo
+
+# Sets of ids larger than this are matched through a temporary table instead of an IN list
+TEMP_TABLE_THRESHOLD = 1000
+
+# Form key suffixes naming each kind of selected item
+VIDEO_SUFFIX = 'videoid'
+CHANNEL_SUFFIX = 'channel'
+PLAYLIST_SUFFIX = 'playlis'
+
+# Form key naming every item of a kind, and the prefix of keys leaving one out
+# again. Neither character appears in YouTube ids.
+WHOLE_KIND = '*'
+EXCLUDED_PREFIX = '!'
+
+# Model and id column of the items each suffix names
+KINDS = {
+        VIDEO_SUFFIX : (LikedVideo, LikedVideo.video_id),
+        CHANNEL_SUFFIX : (Subscription, Subscription.channel_id),
+        PLAYLIST_SUFFIX : (Playlist, Playlist.resource_id)
+        }
+
+def parse_keys(user_id, keys):
+    """
+    Splits posted selection form keys into lists of video, channel and playlist ids
+
+    Ids keep the order they were posted in, without repeats. A WHOLE_KIND key
+    selects all of the user's items of its kind, in the order the dashboard
+    lists them, less those posted with EXCLUDED_PREFIX, so selecting a whole
+    list does not need every row of it on the page.
+    """
+
+    ids = {suffix : {} for suffix in KINDS}
+    whole = set()
+    excluded = {suffix : set() for suffix in KINDS}
+    for key in keys:
+        suffix, name = key[-7:], key[:-7]
+        if suffix not in ids:
+            continue
+        if name == WHOLE_KIND:
+            whole.add(suffix)
+        elif name.startswith(EXCLUDED_PREFIX):
+            excluded[suffix].add(name[len(EXCLUDED_PREFIX):])
+        else:
+            ids[suffix][name] = None
+
+    # Whole kinds take one id-only query each
+    for suffix in whole:
+        model, column = KINDS[suffix]
+        rows = db.session.query(column).filter(model.user_id == user_id).order_by(model.id)
+        ids[suffix] = {id : None for (id,) in rows if id not in excluded[suffix]}
+
+    return list(ids[VIDEO_SUFFIX]), list(ids[CHANNEL_SUFFIX]), list(ids[PLAYLIST_SUFFIX])
+
+def id_filter(column, ids, name):
+    """
+    Returns a filter matching column against ids in a single statement
+
+    Large sets on Postgres are loaded into a temporary table called name with
+    one multi-row insert, and matched with a join instead of a long IN list.
+    """
+
+    if len(ids) <= TEMP_TABLE_THRESHOLD or db.engine.dialect.name != 'postgresql':
+        return column.in_(ids)
+
+    db.session.execute('DROP TABLE IF EXISTS %s' % name)
+    db.session.execute('CREATE TEMPORARY TABLE %s (id TEXT PRIMARY KEY) ON COMMIT DROP' % name)
+    table = db.table(name, db.column('id'))
+    db.session.execute(table.insert().values([{'id' : id} for id in ids]))
+
+    return column.in_(db.select([table.c.id]))
+
+def select_items(user, keys):
+    """
+    Returns the user's liked videos, subscriptions and playlists named by selection form keys,
+    plus a dictionary of each playlist's video ids in order
+
+    Takes one query per kind of item and one for all playlist contents, however
+    many items are selected. Items that no longer exist are left out.
+    """
+
+    video_ids, channel_ids, playlist_ids = parse_keys(user.id, keys)
+
+    videos = []
+    if video_ids:
+        videos = LikedVideo.query.filter_by(user_id=user.id).filter(id_filter(LikedVideo.video_id, video_ids, 'selected_videos')).all()
+        order = {video_id : index for index, video_id in enumerate(video_ids)}
+        videos.sort(key=lambda video: order[video.video_id])
+
+    channels = []
+    if channel_ids:
+        channels = Subscription.query.filter_by(user_id=user.id).filter(id_filter(Subscription.channel_id, channel_ids, 'selected_channels')).all()
+        order = {channel_id : index for index, channel_id in enumerate(channel_ids)}
+        channels.sort(key=lambda channel: order[channel.channel_id])
+
+    playlists = []
+    contents = {}
+    if playlist_ids:
+        playlists = Playlist.query.filter_by(user_id=user.id).filter(id_filter(Playlist.resource_id, playlist_ids, 'selected_playlists')).all()
+        order = {playlist_id : index for index, playlist_id in enumerate(playlist_ids)}
+        playlists.sort(key=lambda playlist: order[playlist.resource_id])
+
+        # Every selected playlist's contents in one ordered query
+        contents = {playlist.id : [] for playlist in playlists}
+        if playlists:
+            rows = db.session.query(PlaylistVideo.playlist_id, PlaylistVideo.video_id) \
+                    .filter(PlaylistVideo.playlist_id.in_(list(contents))) \
+                    .order_by(PlaylistVideo.playlist_id, PlaylistVideo.position)
+            for playlist_id, video_id in rows:
+                contents[playlist_id].append(video_id)
+
+    return videos, channels, playlists, contents
+
+def delete_items(user, keys):
+    """
+    Deletes the user's liked videos, subscriptions and playlists named by selection form keys
+
+    Runs one DELETE per table, without loading the rows. Does not commit.
+    """
+
+    video_ids, channel_ids, playlist_ids = parse_keys(user.id, keys)
+
+    if video_ids:
+        LikedVideo.query.filter_by(user_id=user.id) \
+                .filter(id_filter(LikedVideo.video_id, video_ids, 'selected_videos')) \
+                .delete(synchronize_session=False)
+
+    if channel_ids:
+        Subscription.query.filter_by(user_id=user.id) \
+                .filter(id_filter(Subscription.channel_id, channel_ids, 'selected_channels')) \
+                .delete(synchronize_session=False)
+
+    if playlist_ids:
+        # Contents go first, since a bulk delete skips the ORM cascade
+        selected = db.session.query(Playlist.id).filter_by(user_id=user.id) \
+                .filter(id_filter(Playlist.resource_id, playlist_ids, 'selected_playlists'))
+        PlaylistVideo.query.filter(PlaylistVideo.playlist_id.in_(selected.subquery())).delete(synchronize_session=False)
+        Playlist.query.filter(Playlist.id.in_(selected.subquery())).delete(synchronize_session=False)
+
+    return
@@ -7,7 +7,8 @@ $(function () {
     mdc.textField.MDCTextField.attachTo(field);
   }
 
-  for (box of $(".mdc-checkbox")) {
+  // Selection checkboxes are styled by CSS alone, so long lists need no per-row setup
+  for (box of $(".mdc-checkbox:not(.selection-checkbox)")) {
     mdc.checkbox.MDCCheckbox.attachTo(box);
   }
 
@@ -24,7 +25,7 @@ $(function () {
     }
   }
 
-  for (let list of $(".mdc-list-group").children()) {
+  for (let list of $(".lazy-list")) {
     if ($(list).children().length == 0) {
       $(list).parent().prev().remove();
       $(list).parent().remove();
@@ -41,11 +42,44 @@ $(function () {
   let topBarRegular = $(".mdc-top-app-bar--regular")[0];
   let topBarContextual = $(".mdc-top-app-bar--contextual")[0];
 
+  // What is selected lives here rather than in checkboxes, since a list only
+  // has rows for what is on screen. A whole list is posted as one "*" key,
+  // less the rows unchecked since as "!" keys, so selecting it loads nothing.
+  let selected = new Set();
+  let whole = new Set();
+  let excluded = new Set();
+
+  function isSelected(list, key) {
+    let suffix = list.dataset.suffix;
+    if (whole.has(suffix)) {
+      return !excluded.has(key + suffix);
+    }
+    return selected.has(key + suffix);
+  }
+
+  function setSelected(list, key, checked) {
+    let suffix = list.dataset.suffix;
+    let keys = whole.has(suffix) ? excluded : selected;
+    if (checked == whole.has(suffix)) {
+      keys.delete(key + suffix);
+    } else {
+      keys.add(key + suffix);
+    }
+  }
+
   function boxCheckCount() {
-    let checkboxCount = $("#list-categories").find("input:checkbox:checked")
-      .length;
-    $(".mdc-top-app-bar__title").text(checkboxCount.toString() + " selected");
-    if (checkboxCount > 0) {
+    let parts = [];
+    for (let list of lists) {
+      if (whole.has(list.dataset.suffix)) {
+        let left = [...excluded].filter((key) => key.endsWith(list.dataset.suffix)).length;
+        parts.push("all " + list.dataset.label + (left > 0 ? " but " + left : ""));
+      }
+    }
+    if (selected.size > 0 || parts.length == 0) {
+      parts.unshift(selected.size.toString());
+    }
+    $(".mdc-top-app-bar__title").text(parts.join(", ") + " selected");
+    if (selected.size > 0 || whole.size > 0) {
       topBarRegular.classList.add("hidden-item");
       topBarContextual.classList.remove("hidden-item");
     } else {
@@ -54,16 +88,143 @@ $(function () {
     }
   }
 
-  for (box of $(".selection-checkbox")) {
-    $(box).on("click", boxCheckCount);
+  $("#list-categories").on("change", ".selection-checkbox input", (event) => {
+    let row = event.target.closest(".mdc-list-item");
+    setSelected(row.parentElement, row.dataset.key, event.target.checked);
+    boxCheckCount();
+  });
+
+  // Posts the selection as form keys, whichever action the form is sent to
+  function writeSelection() {
+    let keys = [...selected];
+    for (let suffix of whole) {
+      keys.push("*" + suffix);
+    }
+    for (let key of excluded) {
+      keys.push("!" + key);
+    }
+    $("#selected-keys")
+      .empty()
+      .append(keys.map((key) => $("<input>", { type: "hidden", name: key, value: "on" })));
+  }
+  $("#selections").on("submit", writeSelection);
+
+  // Rows kept above and below the screen, so quick scrolls find them ready
+  const OVERSCAN = 10;
+
+  // Lists hold their items as data and only have rows for the ones on
+  // screen, which are reused for other items as the page scrolls
+  let lists = $(".lazy-list").toArray();
+  for (let list of lists) {
+    list.items = [];
+    for (let row of list.children) {
+      let item = {};
+      for (let field of row.querySelectorAll("[data-field]")) {
+        item[field.dataset.field] = field.textContent;
+      }
+      item.thumbnail = row.querySelector("img").getAttribute("src");
+      item[list.dataset.key] = row.querySelector("input").id;
+      list.items.push(item);
+    }
+    list.rowHeight = list.firstElementChild ? list.firstElementChild.offsetHeight || 72 : 72;
+    list.rows = [];
+    $(list).empty();
+    list.classList.add("virtual-list");
   }
 
+  function makeRow(list) {
+    let row = document.getElementById(list.dataset.category + "-row").content.firstElementChild.cloneNode(true);
+    let input = row.querySelector("input");
+    input.removeAttribute("name");
+    input.removeAttribute("id");
+    list.appendChild(row);
+    list.rows.push(row);
+  }
+
+  function fillRow(list, row, index) {
+    if (row.index !== index) {
+      let item = list.items[index];
+      for (let field of row.querySelectorAll("[data-field]")) {
+        field.textContent = item[field.dataset.field];
+      }
+      row.querySelector("img").src = item.thumbnail;
+      row.dataset.key = item[list.dataset.key];
+      row.style.transform = "translateY(" + index * list.rowHeight + "px)";
+      row.index = index;
+    }
+    row.querySelector("input").checked = isSelected(list, row.dataset.key);
+    row.classList.remove("spare-row");
+  }
+
+  // Shows the items of a list that are on screen, loading more near its end
+  function renderList(list) {
+    list.style.height = list.items.length * list.rowHeight + "px";
+    if (list.offsetParent === null) {
+      return;
+    }
+    let top = list.getBoundingClientRect().top;
+    let first = Math.max(0, Math.floor(-top / list.rowHeight) - OVERSCAN);
+    let last = Math.max(first, Math.min(list.items.length, Math.ceil((window.innerHeight - top) / list.rowHeight) + OVERSCAN));
+    while (list.rows.length < last - first) {
+      makeRow(list);
+    }
+
+    // Each item has one row it can use, so rows still on screen keep theirs
+    let shown = new Set();
+    for (let index = first; index < last; index++) {
+      let row = list.rows[index % list.rows.length];
+      fillRow(list, row, index);
+      shown.add(row);
+    }
+    for (let row of list.rows) {
+      if (!shown.has(row)) {
+        row.classList.add("spare-row");
+      }
+    }
+
+    if (list.dataset.next && last + OVERSCAN >= list.items.length) {
+      loadPage(list).then(() => renderList(list));
+    }
+  }
+
+  let rendering = null;
+  function renderLists() {
+    if (rendering === null) {
+      rendering = requestAnimationFrame(() => {
+        rendering = null;
+        for (let list of lists) {
+          renderList(list);
+        }
+      });
+    }
+  }
+  document.addEventListener("scroll", renderLists, true);
+  window.addEventListener("resize", renderLists);
+  $(".collapse-btn").click(renderLists);
+
+  // Adds the next page of a list from the data API to its items, returning a promise
+  function loadPage(list) {
+    if (list.loading) {
+      return list.loading;
+    }
+    list.loading = fetch("/api/" + list.dataset.category + "?after=" + list.dataset.next)
+      .then((response) => response.json())
+      .then((page) => {
+        list.items.push(...page.items);
+        list.dataset.next = page.next === null ? "" : page.next;
+        list.loading = null;
+      });
+    return list.loading;
+  }
+
+  renderLists();
+
   function deselect_all() {
-    $(".mdc-checkbox--selected")
-      .find('input[type="checkbox"]:not(:disabled)')
-      .prop("checked", false);
-    topBarContextual.classList.add("hidden-item");
-    topBarRegular.classList.remove("hidden-item");
+    selected.clear();
+    whole.clear();
+    excluded.clear();
+    renderLists();
+    boxCheckCount();
   }
 
   $("#deselect_all").on("click", deselect_all);
@@ -85,8 +246,18 @@ $(function () {
     menu.open = true;
   });
 
+  // Whole lists are selected without loading the rest of their items
   $("#select-all-btn").on("click", () => {
-    $("input:checkbox:not(:checked)").prop("checked", true);
+    for (let list of lists) {
+      let suffix = list.dataset.suffix;
+      whole.add(suffix);
+      for (let keys of [selected, excluded]) {
+        for (let key of [...keys].filter((key) => key.endsWith(suffix))) {
+          keys.delete(key);
+        }
+      }
+    }
+    renderLists();
     boxCheckCount();
   });
 
@@ -123,6 +294,32 @@ $(function () {
   $("#import-oauth-next-btn").click(() => {
     importOauthDialog.close();
     importFormDialog.open();
+    $("#import-estimate").text("Estimating quota...");
+    fetch("/quota/import")
+      .then((response) => response.json())
+      .then((quota) => {
+        $("#import-estimate").text(
+          "Estimated quota units: liked videos " + quota.estimate.likedVideos +
+            ", subscriptions " + quota.estimate.subscriptions +
+            ", playlists " + quota.estimate.playlists +
+            ". " + quota.remaining + " left today."
+        );
+      });
+  });
+  let migrateOauthDialog = new mdc.dialog.MDCDialog(
+    document.querySelector("#migrate-oauth-dialog")
+  );
+  let migrateFormDialog = new mdc.dialog.MDCDialog(
+    document.querySelector("#migrate-form-dialog")
+  );
+  $("#migrate-btn").click(() => {
+    window.open("/auth/google/signin?role=target", "authURL", "width=400,height=600");
+
+    migrateOauthDialog.open();
+  });
+  $("#migrate-oauth-next-btn").click(() => {
+    migrateOauthDialog.close();
+    migrateFormDialog.open();
   });
   let exportChoiceDialog = new mdc.dialog.MDCDialog(
     document.querySelector("#export-choice-dialog")
@@ -156,5 +353,45 @@ $(function () {
     exportOauthDialog.close();
     $("#selections").attr("action", "/export");
     exportFormDialog.open();
+    $("#export-estimate").text("Estimating quota...");
+    writeSelection();
+    fetch("/quota/export", {
+      method: "POST",
+      body: new FormData($("#selections")[0]),
+    })
+      .then((response) => response.json())
+      .then((quota) => {
+        $("#export-estimate").text(
+          "Estimated quota units: " + quota.estimate +
+            ". " + quota.remaining + " left today."
+        );
+      });
   });
+
+  function pollJob(element) {
+    let jobId = $(element).data("job-id");
+    fetch("/jobs/" + jobId)
+      .then((response) => response.json())
+      .then((job) => {
+        let status = job.state;
+        if (job.items_total > 0) {
+          status += " " + job.items_done + "/" + job.items_total;
+        }
+        status += " (" + job.throughput + " items/s)";
+        if (job.report && job.report.failed > 0) {
+          status += ", " + job.report.failed + " failed: ";
+          status += job.report.failures.map((failure) => failure.item + " (" + failure.reason + ")").join(", ");
+        }
+        $(element).find(".job-status").text(status);
+        if (job.state == "queued" || job.state == "running") {
+          setTimeout(() => pollJob(element), 2000);
+        } else if (job.state == "done" && !(job.report && job.report.failed > 0)) {
+          window.location.reload();
+        }
+      });
+  }
+
+  for (let job of $(".job-progress")) {
+    pollJob(job);
+  }
 });
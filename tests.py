@@ -1,11 +1,133 @@
 from unittest import TestCase
 from flask import session
-from app import app
+from app import app, user_ids, make_server, task_dispatcher
 import ytmapi
-from models import db, connect_db, User, Subscription, LikedVideo, Playlist, PlaylistVideo, Credential
+from models import db, connect_db, User, Subscription, LikedVideo, Playlist, PlaylistVideo, Credential, Job, QuotaUsage, ExportedItem, PageEtag
+import jobs
+import quota
+import selection
+import prune
+import passwords
+import metrics
+import fakeyoutube
+from sqlalchemy import event
 import jwt
 from flask_bcrypt import Bcrypt
 import os
+import json
+from unittest import mock
+from concurrent.futures import TimeoutError as FutureTimeoutError
+from concurrent.futures.process import BrokenProcessPool
+from googleapiclient.errors import HttpError
+import httplib2
+import urllib.request
+import gzip
+import zstandard
+import datetime
+import threading
+import time
+
+class FakeRequest():
+    """Stand-in for a googleapiclient request, answering 304 when If-None-Match matches"""
+
+    def __init__(self, response):
+        self.response = response
+        self.headers = {}
+
+    def execute(self):
+        if 'etag' in self.response and self.headers.get('If-None-Match') == self.response['etag']:
+            raise HttpError(httplib2.Response({'status': 304}), b'')
+        return dict(self.response)
+
+class FlakyRequest(FakeRequest):
+    """Stand-in for a googleapiclient request failing with each (status, reason) in turn before succeeding"""
+
+    def __init__(self, errors, response=None):
+        super().__init__(response or {})
+        self.errors = list(errors)
+
+    def execute(self):
+        if self.errors:
+            status, reason = self.errors.pop(0)
+            raise make_http_error(status, reason)
+        return dict(self.response)
+
+def make_http_error(status, reason):
+    content = json.dumps({'error': {'errors': [{'reason': reason}]}}).encode('utf-8')
+    return HttpError(httplib2.Response({'status': status}), content)
+
+def empty_listings(youtube):
+    """Makes a mocked service list nothing, as an empty target account would"""
+
+    for resource in (youtube.videos, youtube.subscriptions, youtube.playlistItems):
+        resource.return_value.list.return_value = FakeRequest({'pageInfo': {'totalResults': 0}, 'items': []})
+
+class FakeResource():
+    """Stand-in for a googleapiclient resource serving canned list pages"""
+
+    def __init__(self, pages):
+        self.pages = pages
+        self.calls = []
+
+    def list(self, pageToken=None, **kwargs):
+        self.calls.append(pageToken)
+        return FakeRequest(self.pages[pageToken])
+
+class FakeBatch():
+    """Stand-in for a googleapiclient batch request, failing requests listed in fail"""
+
+    def __init__(self, callback, fail, sizes):
+        self.callback = callback
+        self.fail = fail
+        self.sizes = sizes
+        self.requests = []
+
+    def add(self, request, request_id):
+        self.requests.append((request_id, request))
+
+    def execute(self):
+        self.sizes.append(len(self.requests))
+        for request_id, request in self.requests:
+            if request in self.fail:
+                self.callback(request_id, None, Exception(request))
+            elif isinstance(request, FakeRequest):
+                try:
+                    self.callback(request_id, request.execute(), None)
+                except HttpError as error:
+                    self.callback(request_id, None, error)
+            else:
+                self.callback(request_id, {'id': request}, None)
+
+class FakePlaylistItems():
+    """Stand-in for the playlistItems resource serving pages for several playlists"""
+
+    def __init__(self, playlists):
+        self.playlists = playlists
+
+    def list(self, playlistId, pageToken=None, **kwargs):
+        return FakeRequest(self.playlists[playlistId][pageToken])
+
+def make_pages(count, make_item):
+    """Splits count items into 50 item pages keyed by their page token"""
+
+    pages = {}
+    for start in range(0, count, 50):
+        token = None if start == 0 else 'page%s' % start
+        page = {'items': [make_item(i) for i in range(start, min(start + 50, count))]}
+        if start + 50 < count:
+            page['nextPageToken'] = 'page%s' % (start + 50)
+        page['etag'] = 'etag%s' % start
+        pages[token] = page
+    return pages
+
+def make_like(i):
+    return { "id": "Video %s" % i, "snippet": { "title": "Video Title %s" % i, "thumbnails": { "default": { "url": "https://example.com/%s.jpg" % i } }, "channelTitle": "Channel %s" % i } }
+
+def make_playlist(i):
+    return { "id": "Playlist %s" % i, "snippet": { "title": "Playlist Title %s" % i, "thumbnails": { "default": { "url": "https://example.com/%s.jpg" % i } } }, "status": { "privacyStatus": "private" } }
+
+def make_playlist_item(i):
+    return { "snippet": { "position": i, "resourceId": { "videoId": "Video %s" % i } } }
 
 class IntegrationTests(TestCase):
 
@@ -16,6 +138,11 @@ class IntegrationTests(TestCase):
         self.client = app.test_client()
         db.drop_all()
         db.create_all()
+        ytmapi.use_transport(None)
+        ytmapi.credentials_cache.clear()
+        user_ids.clear()
+        ytmapi.circuit.succeeded()
+        quota.unsaved.clear()
         bcrypt = Bcrypt()
 
         # user account for testing
@@ -66,6 +193,48 @@ class IntegrationTests(TestCase):
             username = authtoken['user']
             self.assertEqual('testuser', username)
 
+    def test_login_hashing_unavailable(self):
+        login = {
+                'username' : 'testuser',
+                'password' : 'testpass'
+                }
+
+        # A dead pool process answers 503 rather than blaming the username, and the pool is replaced
+        broken = mock.Mock()
+        broken.submit.return_value.result.side_effect = BrokenProcessPool()
+        with mock.patch('passwords.pool', broken):
+            resp = self.client.post('/login', data=login)
+            self.assertIsNone(passwords.pool)
+        self.assertEqual(503, resp.status_code)
+        self.assertNotIn('User does not exist!', resp.get_data(as_text=True))
+        broken.shutdown.assert_called_once_with(wait=False)
+
+        # So does a pool too busy to answer in time
+        slow = mock.Mock()
+        slow.submit.return_value.result.side_effect = FutureTimeoutError()
+        with mock.patch('passwords.pool', slow):
+            resp = self.client.post('/signup', data=dict(login, username='newuser', privacyAgree='y'))
+        self.assertEqual(503, resp.status_code)
+        self.assertEqual({'timeout': passwords.HASH_TIMEOUT}, slow.submit.return_value.result.call_args[1])
+        self.assertIsNone(User.query.filter_by(username='newuser').first())
+
+    def test_login_rehashes(self):
+        login = {
+                'username' : 'testuser',
+                'password' : 'testpass'
+                }
+        with mock.patch('passwords.BCRYPT_LOG_ROUNDS', 4):
+            self.client.post('/login', data=login)
+            user = User.query.filter_by(username='testuser').first_or_404()
+            self.assertEqual(4, passwords.hash_rounds(user.password_hash))
+            self.assertEqual((True, None), passwords.check_password(user.password_hash, 'testpass'))
+            self.assertEqual((False, None), passwords.check_password(user.password_hash, 'wrongpass'))
+        with mock.patch('metrics.METRICS_TOKEN', 'scraper'):
+            resp = self.client.get('/metrics', headers={'Authorization': 'Bearer scraper'})
+        text = resp.get_data(as_text=True)
+        self.assertIn('password_hash_seconds_count{operation="check"}', text)
+        self.assertIn('password_rehashes_total ', text)
+
     def test_security_logout(self):
         resp = self.client.get('/logout', follow_redirects=True)
         html = resp.get_data(as_text=True)
@@ -132,6 +301,23 @@ class IntegrationTests(TestCase):
         user = User.query.filter_by(username='testuser').all()
         self.assertEqual(0, len(user))
 
+    def test_user_resolved_once(self):
+        statements = []
+        listener = lambda conn, cursor, statement, parameters, context, executemany: statements.append(statement)
+        event.listen(db.engine, 'before_cursor_execute', listener)
+        try:
+            self.client.get('/jobs')
+            self.client.get('/jobs')
+        finally:
+            event.remove(db.engine, 'before_cursor_execute', listener)
+        # One user query per request, by username and then by the cached id
+        users = [statement for statement in statements if 'FROM users' in statement]
+        self.assertEqual(2, len(users))
+        self.assertIn('users.username =', users[0])
+        self.assertNotIn('users.username =', users[1])
+        self.client.post('/delacc', follow_redirects=True)
+        self.assertNotIn('testuser', user_ids)
+
     def test_cascade_user(self):
         user = User.query.filter_by(username='testuser').first_or_404()
         user_id = user.id
@@ -196,3 +382,821 @@ class IntegrationTests(TestCase):
         resp = self.client.get('/dashboard', follow_redirects=True)
         html = resp.get_data(as_text=True)
         self.assertIn('Test Playlist Title One', html)
+
+    def test_import_likes_paged(self):
+        user = User.query.filter_by(username='testuser').first_or_404()
+        user_id = user.id
+        db.session.add(Credential(user_id=user_id, token='token', refresh_token='refresh'))
+        db.session.commit()
+        videos = FakeResource(make_pages(120, make_like))
+        youtube = mock.Mock()
+        youtube.videos.return_value = videos
+        with mock.patch('ytmapi.build_service', return_value=youtube) as build:
+            pages = ytmapi.get_liked_videos(user)
+            first = next(pages)
+            self.assertEqual(50, len(first['items']))
+            self.assertEqual([None], videos.calls)
+            ytmapi.import_liked_videos(user)
+        self.assertEqual(1, build.call_count)
+        likeslist = LikedVideo.query.filter_by(user_id=user_id).all()
+        self.assertEqual(120, len(likeslist))
+
+    def test_export_ratings_batched(self):
+        user = User.query.filter_by(username='testuser').first_or_404()
+        videos = [LikedVideo(video_id='Video %s' % i) for i in range(120)]
+        sizes = []
+        youtube = mock.Mock()
+        youtube.videos.return_value.rate.side_effect = lambda id, rating: id
+        youtube.new_batch_http_request.side_effect = lambda callback: FakeBatch(callback, ['Video 7'], sizes)
+        with mock.patch('ytmapi.get_service', return_value=youtube):
+            results = ytmapi.export_ratings(videos, user)
+        self.assertEqual([50, 50, 20], sizes)
+        self.assertEqual(120, len(results))
+        self.assertIsNotNone(results['Video 7'][1])
+        self.assertEqual({'id': 'Video 8'}, results['Video 8'][0])
+
+    def test_import_job(self):
+        user = User.query.filter_by(username='testuser').first_or_404()
+        user_id = user.id
+        db.session.add(Credential(user_id=user_id, token='token', refresh_token='refresh'))
+        db.session.commit()
+        self.client.post('/import', data={'likedVideos': 'y'}, follow_redirects=True)
+        job = Job.query.filter_by(user_id=user_id).first_or_404()
+        self.assertEqual('queued', job.state)
+        self.assertEqual(0, len(LikedVideo.query.filter_by(user_id=user_id).all()))
+        pages = make_pages(120, make_like)
+        pages[None]['pageInfo'] = {'totalResults': 120}
+        youtube = mock.Mock()
+        youtube.videos.return_value = FakeResource(pages)
+        with mock.patch('ytmapi.build_service', return_value=youtube):
+            jobs.run_job(jobs.claim_job())
+        resp = self.client.get('/jobs/%s' % job.id)
+        progress = resp.get_json()
+        self.assertEqual('done', progress['state'])
+        self.assertEqual(120, progress['items_done'])
+        self.assertEqual(120, progress['items_total'])
+        self.assertEqual(120, len(LikedVideo.query.filter_by(user_id=user_id).all()))
+
+    def test_cancel_job(self):
+        user = User.query.filter_by(username='testuser').first_or_404()
+        job = jobs.enqueue_job(user, 'import', {'likedVideos': True})
+        job_id = job.id
+        self.client.post('/jobs/%s/cancel' % job_id, follow_redirects=True)
+        resp = self.client.get('/jobs/%s' % job_id)
+        self.assertEqual('cancelled', resp.get_json()['state'])
+        self.assertIsNone(jobs.claim_job())
+
+    def test_recover_stale_jobs(self):
+        user = User.query.filter_by(username='testuser').first_or_404()
+        export_id = jobs.enqueue_job(user, 'export', {'items': []}).id
+        import_id = jobs.enqueue_job(user, 'import', {'likedVideos': True}).id
+        jobs.claim_job()
+        jobs.claim_job()
+
+        # Jobs still sending progress are left alone
+        self.assertEqual(0, jobs.recover_stale_jobs())
+        jobs.make_progress(Job.query.get(export_id))(1)
+        self.assertEqual(0, jobs.recover_stale_jobs(time.time() + jobs.JOB_STALE_AFTER - 60))
+
+        # A dead worker's export is queued again and its import failed
+        self.assertEqual(2, jobs.recover_stale_jobs(time.time() + jobs.JOB_STALE_AFTER + 60))
+        db.session.expire_all()
+        self.assertEqual('queued', Job.query.get(export_id).state)
+        self.assertEqual(1, Job.query.get(export_id).items_done)
+        self.assertEqual('failed', Job.query.get(import_id).state)
+        self.assertEqual(jobs.WORKER_DIED, Job.query.get(import_id).error)
+        self.assertEqual(export_id, jobs.claim_job().id)
+
+    def test_import_playlists_concurrent(self):
+        user = User.query.filter_by(username='testuser').first_or_404()
+        user_id = user.id
+        db.session.add(Credential(user_id=user_id, token='token', refresh_token='refresh'))
+        db.session.commit()
+        sizes = {'Playlist 0': 3, 'Playlist 1': 120, 'Playlist 2': 75}
+        youtube = mock.Mock()
+        youtube.playlists.return_value = FakeResource(make_pages(3, make_playlist))
+        youtube.playlistItems.return_value = FakePlaylistItems({playlist_id: make_pages(size, make_playlist_item) for playlist_id, size in sizes.items()})
+        youtube.new_batch_http_request.side_effect = lambda callback: FakeBatch(callback, [], [])
+        with mock.patch('ytmapi.build_service', return_value=youtube):
+            timings = ytmapi.import_playlists(user)
+        self.assertEqual(set(sizes), set(timings))
+        for playlist_id, size in sizes.items():
+            playlist = Playlist.query.filter_by(user_id=user_id).filter_by(resource_id=playlist_id).first_or_404()
+            self.assertEqual(size, len(PlaylistVideo.query.filter_by(playlist_id=playlist.id).all()))
+
+    def test_reimport_upserts(self):
+        user = User.query.filter_by(username='testuser').first_or_404()
+        user_id = user.id
+        likes = {'items': [make_like(i) for i in range(3)]}
+        ytmapi.save_liked_videos(likes, user)
+        likes['items'][1]['snippet']['title'] = 'Renamed Title'
+        ytmapi.save_liked_videos(likes, user)
+        likeslist = LikedVideo.query.filter_by(user_id=user_id).order_by(LikedVideo.video_id).all()
+        self.assertEqual(3, len(likeslist))
+        self.assertEqual('Renamed Title', likeslist[1].title)
+        playlists = {'items': [make_playlist(i) for i in range(2)]}
+        first_ids = ytmapi.save_playlists(playlists, user)
+        self.assertEqual(first_ids, ytmapi.save_playlists(playlists, user))
+        self.assertEqual(2, len(Playlist.query.filter_by(user_id=user_id).all()))
+
+    def test_reimport_not_modified(self):
+        user = User.query.filter_by(username='testuser').first_or_404()
+        user_id = user.id
+        db.session.add(Credential(user_id=user_id, token='token', refresh_token='refresh'))
+        db.session.commit()
+        youtube = mock.Mock()
+        youtube.videos.return_value = FakeResource(make_pages(120, make_like))
+        youtube.playlists.return_value = FakeResource(make_pages(2, make_playlist))
+        youtube.playlistItems.return_value = FakePlaylistItems({'Playlist 0': make_pages(3, make_playlist_item), 'Playlist 1': make_pages(75, make_playlist_item)})
+        youtube.new_batch_http_request.side_effect = lambda callback: FakeBatch(callback, [], [])
+        with mock.patch('ytmapi.build_service', return_value=youtube):
+            ytmapi.import_liked_videos(user)
+            ytmapi.import_playlists(user)
+            with mock.patch('ytmapi.save_liked_videos') as save_likes, mock.patch('ytmapi.save_playlist_items') as save_items:
+                ytmapi.import_liked_videos(user)
+                ytmapi.import_playlists(user)
+        self.assertEqual(0, save_likes.call_count)
+        self.assertEqual(0, save_items.call_count)
+        self.assertEqual(120, len(LikedVideo.query.filter_by(user_id=user_id).all()))
+        self.assertEqual(78, len(PlaylistVideo.query.all()))
+        etags = ytmapi.load_etags(user)
+        db.session.rollback()
+        self.assertEqual(3, len(etags['videos']))
+        self.assertNotIsInstance(etags['videos'][''], PageEtag)
+
+    def test_import_estimate_cached(self):
+        user = User.query.filter_by(username='testuser').first_or_404()
+        user_id = user.id
+        ytmapi.forget_services(user_id)
+        estimate = {'likedVideos': 3, 'subscriptions': 1, 'playlists': 12}
+        with mock.patch('ytmapi.estimate_import', return_value=estimate) as estimate_import:
+            self.assertEqual(estimate, self.client.get('/quota/import').get_json()['estimate'])
+            self.assertEqual(estimate, self.client.get('/quota/import').get_json()['estimate'])
+            self.assertEqual(1, estimate_import.call_count)
+
+            # Linking another account, or the estimate growing old, asks YouTube again
+            ytmapi.forget_services(user_id)
+            self.client.get('/quota/import')
+            with mock.patch('time.time', return_value=time.time() + ytmapi.IMPORT_ESTIMATE_MAX_AGE + 1):
+                self.client.get('/quota/import')
+            self.assertEqual(3, estimate_import.call_count)
+        ytmapi.forget_services(user_id)
+
+    def test_quota_metering(self):
+        user = User.query.filter_by(username='testuser').first_or_404()
+        user_id = user.id
+        db.session.add(Credential(user_id=user_id, token='token', refresh_token='refresh'))
+        db.session.commit()
+        youtube = mock.Mock()
+        youtube.videos.return_value = FakeResource(make_pages(120, make_like))
+        with mock.patch('ytmapi.build_service', return_value=youtube):
+            ytmapi.import_liked_videos(user)
+        self.assertEqual(3, quota.spent_today())
+        videos = [LikedVideo(video_id='Video %s' % i) for i in range(4)]
+        youtube = mock.Mock()
+        youtube.videos.return_value.rate.side_effect = lambda id, rating: id
+        youtube.new_batch_http_request.side_effect = lambda callback: FakeBatch(callback, [], [])
+        with mock.patch('ytmapi.get_service', return_value=youtube), mock.patch('quota.request_endpoint', return_value='videos.rate'):
+            ytmapi.export_ratings(videos, user)
+        self.assertEqual(203, quota.spent_today())
+        self.assertEqual(203, sum(usage.units for usage in QuotaUsage.query.filter_by(user_id=user_id).all()))
+
+    def test_export_refused_over_quota(self):
+        user = User.query.filter_by(username='testuser').first_or_404()
+        user_id = user.id
+        ytmapi.save_liked_videos({'items': [make_like(i) for i in range(3)]}, user)
+        params = {'Video 0videoid': 'on', 'Video 1videoid': 'on', 'Video 2videoid': 'on'}
+        resp = self.client.post('/quota/export', data=params)
+        self.assertEqual(150, resp.get_json()['estimate'])
+        with mock.patch('quota.DAILY_QUOTA', 100):
+            resp = self.client.post('/export', data=params, follow_redirects=True)
+        self.assertIn('only 100 are left today', resp.get_data(as_text=True))
+        self.assertEqual(0, len(Job.query.filter_by(user_id=user_id).all()))
+        self.client.post('/export', data=params)
+        self.assertEqual(1, len(Job.query.filter_by(user_id=user_id).all()))
+
+    def test_execute_retries(self):
+        user = User.query.filter_by(username='testuser').first_or_404()
+        with mock.patch('time.sleep') as sleep:
+            response = ytmapi.execute(user, FlakyRequest([(503, 'backendError'), (403, 'rateLimitExceeded')], {'id': 'ok'}))
+            self.assertEqual({'id': 'ok'}, response)
+            self.assertEqual(2, sleep.call_count)
+            with self.assertRaises(HttpError):
+                ytmapi.execute(user, FlakyRequest([(404, 'playlistNotFound'), (503, 'backendError')]))
+            self.assertEqual(2, sleep.call_count)
+            self.assertEqual(4, quota.spent_today())
+
+            # Repeated transient failures pause every caller until the circuit resets
+            circuit = ytmapi.CircuitBreaker(2, 60)
+            circuit.failed()
+            circuit.wait()
+            self.assertEqual(2, sleep.call_count)
+            circuit.failed()
+            circuit.wait()
+            self.assertEqual(3, sleep.call_count)
+            self.assertAlmostEqual(60, sleep.call_args[0][0], delta=1)
+            circuit.succeeded()
+            circuit.wait()
+            self.assertEqual(3, sleep.call_count)
+
+    def test_server_answers_requests(self):
+        server = make_server(0, threads=2)
+        threading.Thread(target=server.run, daemon=True).start()
+        try:
+            resp = urllib.request.urlopen('http://localhost:%s/' % server.effective_port, timeout=10)
+            self.assertEqual(200, resp.status)
+            self.assertIn('YouTube Data Migrator', resp.read().decode('utf-8'))
+            self.assertEqual(2, len(task_dispatcher.threads))
+        finally:
+            server.close()
+            task_dispatcher.shutdown()
+
+    def test_metrics_endpoint(self):
+        user = User.query.filter_by(username='testuser').first_or_404()
+        calls = lambda status: metrics.counters.get(metrics.label_key('youtube_api_calls_total', {'endpoint': 'videos.list', 'status': status}), 0)
+        failed, succeeded = calls('503'), calls('200')
+        request = FlakyRequest([(503, 'backendError')], {'id': 'ok'})
+        request.methodId = 'youtube.videos.list'
+        with mock.patch('time.sleep'):
+            ytmapi.execute(user, request)
+        self.assertEqual((failed + 1, succeeded + 1), (calls('503'), calls('200')))
+
+        self.client.get('/jobs')
+        self.assertEqual(401, self.client.get('/metrics').status_code)
+        with mock.patch('metrics.METRICS_TOKEN', 'scraper'):
+            self.assertEqual(401, self.client.get('/metrics').status_code)
+            self.assertEqual(401, self.client.get('/metrics', headers={'Authorization': 'Bearer guess'}).status_code)
+            resp = self.client.get('/metrics', headers={'Authorization': 'Bearer scraper'})
+        text = resp.get_data(as_text=True)
+        self.assertIn('# TYPE http_request_seconds histogram', text)
+        self.assertIn('http_request_seconds_count{method="GET",route="listJobs",status="200"}', text)
+        self.assertIn('http_request_queries_bucket{route="listJobs",le="+Inf"}', text)
+        self.assertIn('youtube_api_errors_total{endpoint="videos.list",reason="backendError"}', text)
+        self.assertIn('waitress_queue_depth 0', text)
+
+    def test_fake_youtube_round_trip(self):
+        user = User.query.filter_by(username='testuser').first_or_404()
+        user_id = user.id
+        db.session.add(Credential(user_id=user_id, token='source', refresh_token='refresh'))
+        db.session.commit()
+        youtube = fakeyoutube.FakeYouTube({'source': fakeyoutube.Account(120, 60, 3, 55), 'target': fakeyoutube.Account(0, 1)})
+        ytmapi.use_transport(fakeyoutube.transport(youtube), fakeyoutube.DISCOVERY)
+        ytmapi.import_liked_videos(user)
+        ytmapi.import_subscriptions(user)
+        ytmapi.import_playlists(user)
+        self.assertEqual(120, LikedVideo.query.filter_by(user_id=user_id).count())
+        self.assertEqual(60, Subscription.query.filter_by(user_id=user_id).count())
+        self.assertEqual(165, PlaylistVideo.query.join(Playlist).filter(Playlist.user_id == user_id).count())
+
+        # Export everything to the target account, which already has one subscription
+        keys = ['video%svideoid' % i for i in range(120)] + ['channel%schannel' % i for i in range(60)] + ['playlist%splaylis' % i for i in range(3)]
+        Credential.query.filter_by(user_id=user_id).update({'token': 'target'})
+        db.session.commit()
+        ytmapi.forget_services(user_id)
+        job = jobs.enqueue_job(user, 'export', {'items': keys})
+        with mock.patch('quota.DAILY_QUOTA', 10 ** 6):
+            jobs.run_job(jobs.claim_job())
+        job = Job.query.get(job.id)
+        self.assertEqual(jobs.DONE, job.state)
+        self.assertEqual({'succeeded': 347, 'duplicate': 1, 'failed': 0, 'failures': []}, json.loads(job.report))
+        target = youtube.accounts['target']
+        self.assertEqual(set(youtube.accounts['source'].likes), target.liked)
+        self.assertEqual(60, len(target.subscriptions))
+        self.assertEqual([55, 55, 55], [len(playlist['items']) for playlist in target.playlists.values()])
+
+    def test_emulator_over_http(self):
+        user = User.query.filter_by(username='testuser').first_or_404()
+        user_id = user.id
+        db.session.add(Credential(user_id=user_id, token='expired', refresh_token='source'))
+        db.session.commit()
+        youtube = fakeyoutube.FakeYouTube({'source': fakeyoutube.Account(30, 12, 2, 9)}, quota=1000, faults={
+            'rate_limit': 0.2, 'page_size': 7, 'empty_pages': 0.2, 'trailing_empty_page': True})
+        server = fakeyoutube.serve(youtube)
+        root = 'http://localhost:%s/' % server.server_address[1]
+        fakeyoutube.random.seed(1)
+
+        # Import through the emulator over HTTP, refreshing the unknown access token at its token endpoint
+        with mock.patch.multiple('ytmapi', YOUTUBE_API_URL=root, DISCOVERY_URL=root + 'discovery/v1/apis/youtube/v3/rest',
+                discovery_document=None, backoff_delay=mock.Mock(return_value=0)), \
+                mock.patch.dict(ytmapi.CLIENT_CONFIG['web'], token_uri=root + 'token'):
+            ytmapi.forget_services(user_id)
+            ytmapi.import_liked_videos(user)
+            ytmapi.import_subscriptions(user)
+            ytmapi.import_playlists(user)
+        server.shutdown()
+        ytmapi.forget_services(user_id)
+        self.assertEqual(30, LikedVideo.query.filter_by(user_id=user_id).count())
+        self.assertEqual(12, Subscription.query.filter_by(user_id=user_id).count())
+        self.assertEqual(18, PlaylistVideo.query.join(Playlist).filter(Playlist.user_id == user_id).count())
+        self.assertTrue(Credential.query.filter_by(user_id=user_id).one().token.startswith('ya29.'))
+
+        # Rate limited calls were retried, and every call that got through was charged
+        state = youtube.state()
+        self.assertGreater(sum(count for key, count in state['calls'].items() if key.endswith('rateLimitExceeded')), 0)
+        self.assertEqual(sum(count for key, count in state['calls'].items() if key.endswith(' ok')), state['quota']['spent'])
+
+        # Writes cost 50 units, so the quota runs out
+        youtube.spent = 980
+        status, headers, content = youtube.handle('POST', '/youtube/v3/videos/rate?id=video1&rating=none', {'Authorization': 'Bearer source'}, None)
+        self.assertEqual(403, status)
+        self.assertIn('quotaExceeded', content.decode('utf-8'))
+
+    def test_export_skips_what_target_has(self):
+        user = User.query.filter_by(username='testuser').first_or_404()
+        user_id = user.id
+        db.session.add(Credential(user_id=user_id, token='source', refresh_token='refresh', account='target'))
+        db.session.commit()
+        youtube = fakeyoutube.FakeYouTube({'source': fakeyoutube.Account(120, 60, 3, 55), 'target': fakeyoutube.Account()})
+        ytmapi.use_transport(fakeyoutube.transport(youtube), fakeyoutube.DISCOVERY)
+        ytmapi.import_liked_videos(user)
+        ytmapi.import_subscriptions(user)
+        ytmapi.import_playlists(user)
+        keys = ['video%svideoid' % i for i in range(120)] + ['channel%schannel' % i for i in range(60)] + ['playlist%splaylis' % i for i in range(3)]
+        Credential.query.filter_by(user_id=user_id).update({'token': 'target'})
+        db.session.commit()
+        ytmapi.forget_services(user_id)
+        jobs.enqueue_job(user, 'export', {'items': keys})
+        with mock.patch('quota.DAILY_QUOTA', 10 ** 6):
+            jobs.run_job(jobs.claim_job())
+
+        # The target loses a few items, and the ledger forgets every video, channel and playlist video
+        target = youtube.accounts['target']
+        for video_id in youtube.accounts['source'].likes[:10]:
+            target.likes.remove(video_id)
+            target.liked.discard(video_id)
+        first = list(target.playlists.values())[0]
+        del first['items'][-5:]
+        ExportedItem.query.filter(ExportedItem.kind != 'playlist').delete()
+        db.session.commit()
+
+        # Exporting again lists the target and only inserts what it lacks
+        youtube.calls.clear()
+        with mock.patch('quota.DAILY_QUOTA', 10 ** 6):
+            job = jobs.enqueue_job(user, 'export', {'items': keys})
+            jobs.run_job(jobs.claim_job())
+        job = Job.query.get(job.id)
+        self.assertEqual({'succeeded': 15, 'duplicate': 330, 'failed': 0, 'failures': []}, json.loads(job.report))
+        writes = {key: count for key, count in youtube.calls.items() if key.startswith('POST')}
+        self.assertEqual({'POST videos/rate ok': 10, 'POST playlistItems ok': 5}, writes)
+        self.assertEqual(120, len(target.likes))
+        self.assertEqual([55, 55, 55], [len(playlist['items']) for playlist in target.playlists.values()])
+
+    def test_migration_streams_between_accounts(self):
+        user = User.query.filter_by(username='testuser').first_or_404()
+        user_id = user.id
+        db.session.add(Credential(user_id=user_id, token='source', refresh_token='refresh'))
+        db.session.commit()
+        youtube = fakeyoutube.FakeYouTube({'source': fakeyoutube.Account(120, 60, 3, 55), 'target': fakeyoutube.Account(0, 1)})
+        ytmapi.use_transport(fakeyoutube.transport(youtube), fakeyoutube.DISCOVERY)
+        params = {'likedVideos': 'y', 'subscriptions': 'y', 'playlists': 'y'}
+
+        # Nothing is queued until the target account is linked
+        resp = self.client.post('/migrate', data=params, follow_redirects=True)
+        self.assertIn('Link the account to migrate to first', resp.get_data(as_text=True))
+        db.session.add(Credential(user_id=user_id, role=ytmapi.TARGET, token='target', refresh_token='refresh', account='target'))
+        db.session.commit()
+
+        # Everything is copied without being saved to the library
+        self.client.post('/migrate', data=params)
+        with mock.patch('quota.DAILY_QUOTA', 10 ** 6):
+            jobs.run_job(jobs.claim_job())
+        job = Job.query.filter_by(user_id=user_id, kind='migrate').one()
+        self.assertEqual(jobs.DONE, job.state)
+        self.assertEqual({'succeeded': 347, 'duplicate': 1, 'failed': 0, 'failures': []}, json.loads(job.report))
+        self.assertEqual((348, 348), (job.items_done, job.items_total))
+        target = youtube.accounts['target']
+        self.assertEqual(set(youtube.accounts['source'].likes), target.liked)
+        self.assertEqual(60, len(target.subscriptions))
+        self.assertEqual([55, 55, 55], [len(playlist['items']) for playlist in target.playlists.values()])
+        self.assertEqual(0, LikedVideo.query.filter_by(user_id=user_id).count())
+
+        # Running it again inserts nothing the ledger already has
+        jobs.enqueue_job(user, 'migrate', {'likedVideos': True, 'playlists': True})
+        with mock.patch('quota.DAILY_QUOTA', 10 ** 6):
+            jobs.run_job(jobs.claim_job())
+        self.assertEqual(3, len(target.playlists))
+        self.assertEqual(120, len(target.likes))
+
+    def test_migration_to_unknown_account_skips_ledger(self):
+        user = User.query.filter_by(username='testuser').first_or_404()
+        user_id = user.id
+
+        # A target linked before accounts were recorded, and what went to some earlier unknown account
+        db.session.add(Credential(user_id=user_id, token='source', refresh_token='refresh'))
+        db.session.add(Credential(user_id=user_id, role=ytmapi.TARGET, token='target', refresh_token='refresh'))
+        db.session.add_all([ExportedItem(user_id=user_id, account='', kind='video', source_id='video%s' % i, created_at=time.time()) for i in range(3)])
+        db.session.commit()
+        youtube = fakeyoutube.FakeYouTube({'source': fakeyoutube.Account(3), 'target': fakeyoutube.Account()})
+        ytmapi.use_transport(fakeyoutube.transport(youtube), fakeyoutube.DISCOVERY)
+        jobs.enqueue_job(user, 'migrate', {'likedVideos': True})
+        jobs.run_job(jobs.claim_job())
+        self.assertEqual(jobs.DONE, Job.query.filter_by(user_id=user_id).one().state)
+        self.assertEqual(3, len(youtube.accounts['target'].likes))
+        self.assertEqual(3, ExportedItem.query.filter_by(user_id=user_id).count())
+
+    def test_read_ahead(self):
+        read = []
+
+        def numbers():
+            for number in range(100):
+                read.append(number)
+                yield number
+
+        # The reader stays at most size items ahead, and stops when the caller does
+        pages = ytmapi.read_ahead(numbers(), 2)
+        self.assertEqual([0, 1, 2], [next(pages) for i in range(3)])
+        time.sleep(0.2)
+        self.assertLessEqual(len(read), 6)
+        pages.close()
+        self.assertLessEqual(len(read), 6)
+
+        # Errors reading are raised to the caller
+        def failing():
+            yield 1
+            raise ValueError('broken')
+        pages = ytmapi.read_ahead(failing(), 2)
+        self.assertEqual(1, next(pages))
+        with self.assertRaises(ValueError):
+            next(pages)
+
+    def test_credentials_refresh_once(self):
+        user = User.query.filter_by(username='testuser').first_or_404()
+        user_id = user.id
+        db.session.add(Credential(user_id=user_id, token='token', refresh_token='refresh'))
+        db.session.commit()
+
+        # Credentials are loaded once and shared
+        credentials = ytmapi.get_credentials(user_id)
+        self.assertIs(credentials, ytmapi.get_credentials(user_id))
+
+        # Threads that find the token expired together refresh it once
+        def refresh(self, request):
+            time.sleep(0.1)
+            self.token = 'fresh'
+            self.expiry = datetime.datetime.utcnow() + datetime.timedelta(hours=1)
+        with mock.patch('google.oauth2.credentials.Credentials.refresh', autospec=True, side_effect=refresh) as grant:
+            stale = ytmapi.StoredCredentials(user_id, token='token', refresh_token='refresh')
+            threads = [threading.Thread(target=c.refresh, args=(None,)) for c in (credentials, stale)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            self.assertEqual(1, grant.call_count)
+            self.assertEqual('fresh', stale.token)
+
+        # The new token and expiry are saved for other processes
+        db.session.expire_all()
+        saved = Credential.query.filter_by(user_id=user_id).one()
+        self.assertEqual('fresh', saved.token)
+        self.assertAlmostEqual(time.time() + 3600, saved.expiry, delta=60)
+        ytmapi.forget_services(user_id)
+        self.assertEqual(ytmapi.expiry_datetime(saved.expiry), ytmapi.get_credentials(user_id).expiry)
+
+    def test_shared_credentials_refresh_once(self):
+        user = User.query.filter_by(username='testuser').first_or_404()
+        user_id = user.id
+        db.session.add(Credential(user_id=user_id, token='token', refresh_token='refresh'))
+        db.session.commit()
+
+        # Fetch threads share one credentials object, and all find it stale at once
+        credentials = ytmapi.get_credentials(user_id)
+        started = threading.Barrier(8)
+        def refresh(self, request):
+            time.sleep(0.1)
+            self.token = 'fresh'
+            self.expiry = datetime.datetime.utcnow() + datetime.timedelta(hours=1)
+        def fetch():
+            started.wait()
+            credentials.refresh(None)
+        with mock.patch('google.oauth2.credentials.Credentials.refresh', autospec=True, side_effect=refresh) as grant:
+            threads = [threading.Thread(target=fetch) for _ in range(8)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        self.assertEqual(1, grant.call_count)
+        self.assertEqual('fresh', credentials.token)
+
+    def test_export_job_report(self):
+        user = User.query.filter_by(username='testuser').first_or_404()
+        user_id = user.id
+        db.session.add(Credential(user_id=user_id, token='token', refresh_token='refresh'))
+        ytmapi.save_liked_videos({'items': [make_like(i) for i in range(3)]}, user)
+        ytmapi.save_subscriptions({'items': [{'snippet': {'title': 'Channel', 'resourceId': {'channelId': 'Channel 0'}, 'thumbnails': {'default': {'url': 'https://example.com/0.jpg'}}}}]}, user)
+        job = jobs.enqueue_job(user, 'export', {'items': ['Video 0videoid', 'Video 1videoid', 'Video 2videoid', 'Channel 0channel']})
+        job_id = job.id
+        ratings = {
+                'Video 0': [],
+                'Video 1': [(403, 'userRateLimitExceeded')],
+                'Video 2': [(403, 'forbidden')]
+                }
+        youtube = mock.Mock()
+        youtube.videos.return_value.rate.side_effect = lambda id, rating: FlakyRequest(ratings[id])
+        youtube.subscriptions.return_value.insert.side_effect = lambda **kwargs: FlakyRequest([(400, 'subscriptionDuplicate')])
+        youtube.new_batch_http_request.side_effect = lambda callback: FakeBatch(callback, [], [])
+        empty_listings(youtube)
+        with mock.patch('ytmapi.build_service', return_value=youtube), mock.patch('time.sleep'):
+            jobs.run_job(jobs.claim_job())
+        progress = self.client.get('/jobs/%s' % job_id).get_json()
+        self.assertEqual('done', progress['state'])
+        self.assertEqual(2, progress['report']['succeeded'])
+        self.assertEqual(1, progress['report']['duplicate'])
+        self.assertEqual([{'item': 'video Video 2', 'reason': 'forbidden'}], progress['report']['failures'])
+
+    def test_export_keeps_playlist_order(self):
+        user = User.query.filter_by(username='testuser').first_or_404()
+        user_id = user.id
+        db.session.add(Credential(user_id=user_id, token='token', refresh_token='refresh', account='target'))
+        dbPlaylistIds = ytmapi.save_playlists({'items': [make_playlist(0)]}, user)
+        ytmapi.save_playlist_items({'items': [make_playlist_item(i) for i in range(8)]}, dbPlaylistIds['Playlist 0'])
+        db.session.commit()
+        self.client.post('/export', data={'Playlist 0playlis': 'on'})
+
+        # Batches answer their calls in reverse, as nothing guarantees their order
+        class ReversedBatch(FakeBatch):
+            def execute(self):
+                self.requests.reverse()
+                super().execute()
+        target = []
+        def insert(part, body):
+            request = FakeRequest({'id': 'Item'})
+            request.execute = lambda: target.append(body['snippet']['resourceId']['videoId']) or {'id': 'Item'}
+            return request
+        youtube = mock.Mock()
+        youtube.playlists.return_value.insert.return_value = FakeRequest({'id': 'Target Playlist'})
+        youtube.playlistItems.return_value.insert.side_effect = insert
+        youtube.new_batch_http_request.side_effect = lambda callback: ReversedBatch(callback, [], [])
+        empty_listings(youtube)
+        with mock.patch('ytmapi.build_service', return_value=youtube):
+            jobs.run_job(jobs.claim_job())
+        self.assertEqual('done', Job.query.filter_by(user_id=user_id).one().state)
+        self.assertEqual(['Video %s' % i for i in range(8)], target)
+
+    def test_export_reports_videos_without_playlist(self):
+        user = User.query.filter_by(username='testuser').first_or_404()
+        user_id = user.id
+        db.session.add(Credential(user_id=user_id, token='token', refresh_token='refresh', account='target'))
+        dbPlaylistIds = ytmapi.save_playlists({'items': [make_playlist(0)]}, user)
+        ytmapi.save_playlist_items({'items': [make_playlist_item(i) for i in range(2)]}, dbPlaylistIds['Playlist 0'])
+        db.session.commit()
+        self.client.post('/export', data={'Playlist 0playlis': 'on'})
+        job_id = Job.query.filter_by(user_id=user_id).first_or_404().id
+        youtube = mock.Mock()
+        youtube.playlists.return_value.insert.return_value = FlakyRequest([(403, 'forbidden')], {})
+        empty_listings(youtube)
+        with mock.patch('ytmapi.build_service', return_value=youtube):
+            jobs.run_job(jobs.claim_job())
+        report = self.client.get('/jobs/%s' % job_id).get_json()['report']
+        self.assertEqual(3, report['failed'])
+        self.assertEqual([
+                {'item': 'playlist Playlist Title 0', 'reason': 'forbidden'},
+                {'item': 'video Video 0 in playlist Playlist Title 0', 'reason': 'PlaylistNotCreated'},
+                {'item': 'video Video 1 in playlist Playlist Title 0', 'reason': 'PlaylistNotCreated'}
+                ], report['failures'])
+        self.assertEqual(0, youtube.playlistItems.return_value.insert.call_count)
+
+    def test_export_to_unknown_account_skips_ledger(self):
+        user = User.query.filter_by(username='testuser').first_or_404()
+        user_id = user.id
+
+        # Credentials linked before accounts were recorded, and what went to some earlier unknown account
+        db.session.add(Credential(user_id=user_id, token='token', refresh_token='refresh'))
+        db.session.add(ExportedItem(user_id=user_id, account='', kind='video', source_id='Video 0', created_at=time.time()))
+        ytmapi.save_liked_videos({'items': [make_like(i) for i in range(2)]}, user)
+        db.session.commit()
+        params = {'Video 0videoid': 'on', 'Video 1videoid': 'on'}
+        self.assertEqual(100, self.client.post('/quota/export', data=params).get_json()['estimate'])
+        self.client.post('/export', data=params)
+        youtube = mock.Mock()
+        youtube.videos.return_value.rate.side_effect = lambda id, rating: id
+        youtube.new_batch_http_request.side_effect = lambda callback: FakeBatch(callback, [], [])
+        empty_listings(youtube)
+        with mock.patch('ytmapi.build_service', return_value=youtube):
+            jobs.run_job(jobs.claim_job())
+        self.assertEqual(2, youtube.videos.return_value.rate.call_count)
+        self.assertEqual(1, len(ExportedItem.query.filter_by(user_id=user_id).all()))
+
+    def test_export_resumes(self):
+        user = User.query.filter_by(username='testuser').first_or_404()
+        user_id = user.id
+        db.session.add(Credential(user_id=user_id, token='token', refresh_token='refresh', account='target'))
+        ytmapi.save_liked_videos({'items': [make_like(i) for i in range(2)]}, user)
+        dbPlaylistIds = ytmapi.save_playlists({'items': [make_playlist(0)]}, user)
+        ytmapi.save_playlist_items({'items': [make_playlist_item(i) for i in range(3)]}, dbPlaylistIds['Playlist 0'])
+        db.session.commit()
+        params = {'Video 0videoid': 'on', 'Video 1videoid': 'on', 'Playlist 0playlis': 'on'}
+        self.client.post('/export', data=params)
+        job_id = Job.query.filter_by(user_id=user_id).first_or_404().id
+        youtube = mock.Mock()
+        youtube.videos.return_value.rate.side_effect = lambda id, rating: id
+        youtube.playlists.return_value.insert.return_value = FakeRequest({'id': 'Target Playlist'})
+        youtube.playlistItems.return_value.insert.side_effect = RuntimeError('worker died')
+        youtube.new_batch_http_request.side_effect = lambda callback: FakeBatch(callback, [], [])
+        empty_listings(youtube)
+        with mock.patch('ytmapi.build_service', return_value=youtube):
+            jobs.run_job(jobs.claim_job())
+        job = Job.query.get(job_id)
+        self.assertEqual('failed', job.state)
+        self.assertEqual(3, len(ExportedItem.query.filter_by(user_id=user_id).all()))
+        self.assertEqual('Target Playlist', ExportedItem.query.filter_by(kind='playlist').first_or_404().target_id)
+
+        # Resuming sends only the playlist's videos, into the playlist already created
+        self.client.post('/jobs/%s/resume' % job_id)
+        youtube.playlistItems.return_value.insert.side_effect = lambda part, body: FakeRequest({'id': body['snippet']['resourceId']['videoId']})
+        with mock.patch('ytmapi.build_service', return_value=youtube):
+            jobs.run_job(jobs.claim_job())
+        progress = self.client.get('/jobs/%s' % job_id).get_json()
+        self.assertEqual('done', progress['state'])
+        self.assertEqual(6, progress['items_done'])
+        self.assertEqual(1, youtube.playlists.return_value.insert.call_count)
+        self.assertEqual(2, youtube.videos.return_value.rate.call_count)
+        self.assertEqual(6, len(ExportedItem.query.filter_by(user_id=user_id, account='target').all()))
+
+        # Exporting the same items again has nothing left to do
+        resp = self.client.post('/quota/export', data=params)
+        self.assertEqual(0, resp.get_json()['estimate'])
+
+    def test_export_resumes_after_items_change(self):
+        user = User.query.filter_by(username='testuser').first_or_404()
+        user_id = user.id
+        db.session.add(Credential(user_id=user_id, token='token', refresh_token='refresh', account='target'))
+        ytmapi.save_liked_videos({'items': [make_like(i) for i in range(2)]}, user)
+        dbPlaylistIds = ytmapi.save_playlists({'items': [make_playlist(0)]}, user)
+        ytmapi.save_playlist_items({'items': [make_playlist_item(i) for i in range(3)]}, dbPlaylistIds['Playlist 0'])
+        db.session.commit()
+        params = {'Video 0videoid': 'on', 'Video 1videoid': 'on', 'Playlist 0playlis': 'on'}
+        self.client.post('/export', data=params)
+        job_id = Job.query.filter_by(user_id=user_id).first_or_404().id
+        youtube = mock.Mock()
+        youtube.videos.return_value.rate.side_effect = lambda id, rating: id
+        youtube.playlists.return_value.insert.return_value = FakeRequest({'id': 'Target Playlist'})
+        youtube.playlistItems.return_value.insert.side_effect = RuntimeError('worker died')
+        youtube.new_batch_http_request.side_effect = lambda callback: FakeBatch(callback, [], [])
+        empty_listings(youtube)
+        with mock.patch('ytmapi.build_service', return_value=youtube):
+            jobs.run_job(jobs.claim_job())
+
+        # A liked video is removed before resuming, moving every later item up
+        LikedVideo.query.filter_by(user_id=user_id, video_id='Video 0').delete()
+        db.session.commit()
+        self.client.post('/jobs/%s/resume' % job_id)
+        youtube.playlistItems.return_value.insert.reset_mock()
+        youtube.playlistItems.return_value.insert.side_effect = lambda part, body: FakeRequest({'id': body['snippet']['resourceId']['videoId']})
+        with mock.patch('ytmapi.build_service', return_value=youtube):
+            jobs.run_job(jobs.claim_job())
+        self.assertEqual('done', Job.query.get(job_id).state)
+        self.assertEqual(1, youtube.playlists.return_value.insert.call_count)
+        self.assertEqual(3, youtube.playlistItems.return_value.insert.call_count)
+        self.assertEqual(3, len(ExportedItem.query.filter_by(user_id=user_id, kind='playlist_video').all()))
+
+    def test_select_whole_lists(self):
+        user = User.query.filter_by(username='testuser').first_or_404()
+        user_id = user.id
+        ytmapi.save_liked_videos({'items': [make_like(i) for i in range(5)]}, user)
+        dbPlaylistIds = ytmapi.save_playlists({'items': [make_playlist(i) for i in range(2)]}, user)
+        ytmapi.save_playlist_items({'items': [make_playlist_item(i) for i in range(2)]}, dbPlaylistIds['Playlist 1'])
+        db.session.commit()
+
+        # A whole list is one key, less the rows unchecked since
+        keys = ['*videoid', '!Video 3videoid', 'Playlist 1playlis']
+        videos, channels, playlists, contents = selection.select_items(user, keys)
+        self.assertEqual(['Video 0', 'Video 1', 'Video 2', 'Video 4'], [video.video_id for video in videos])
+        self.assertEqual(['Playlist 1'], [playlist.resource_id for playlist in playlists])
+        resp = self.client.post('/download-json', data={'*playlis': 'on', '*channel': 'on'})
+        data = json.loads(resp.get_data(as_text=True))
+        self.assertEqual(['Playlist 0', 'Playlist 1'], [playlist['playlist_id'] for playlist in data['playlists']])
+        self.client.post('/delete', data={key: 'on' for key in keys}, follow_redirects=True)
+        self.assertEqual(['Video 3'], [video.video_id for video in LikedVideo.query.filter_by(user_id=user_id).all()])
+        self.assertEqual(['Playlist 0'], [playlist.resource_id for playlist in Playlist.query.filter_by(user_id=user_id).all()])
+
+    def test_selection_constant_queries(self):
+        user = User.query.filter_by(username='testuser').first_or_404()
+        user_id = user.id
+        ytmapi.save_liked_videos({'items': [make_like(i) for i in range(30)]}, user)
+        dbPlaylistIds = ytmapi.save_playlists({'items': [make_playlist(i) for i in range(3)]}, user)
+        for dbPlaylistId in dbPlaylistIds.values():
+            ytmapi.save_playlist_items({'items': [make_playlist_item(i) for i in range(4)]}, dbPlaylistId)
+        db.session.commit()
+        user = User.query.get(user_id)
+        statements = []
+        listener = lambda conn, cursor, statement, parameters, context, executemany: statements.append(statement)
+        event.listen(db.engine, 'before_cursor_execute', listener)
+        try:
+            keys = ['Video 2videoid', 'Video 1videoid', 'Playlist 1playlis']
+            videos, channels, playlists, contents = selection.select_items(user, keys)
+            few = len(statements)
+            keys = ['Video %svideoid' % i for i in reversed(range(30))] + ['Playlist %splaylis' % i for i in range(3)] + ['Missingchannel']
+            with mock.patch('selection.TEMP_TABLE_THRESHOLD', 10):
+                videos, channels, playlists, contents = selection.select_items(user, keys)
+            many = len(statements) - few
+        finally:
+            event.remove(db.engine, 'before_cursor_execute', listener)
+        # One query per kind and one for contents, plus three statements to fill the temporary table
+        self.assertEqual(3, few)
+        self.assertEqual(3 + 1 + 3, many)
+        self.assertEqual(['Video %s' % i for i in reversed(range(30))], [video.video_id for video in videos])
+        self.assertEqual([], channels)
+        self.assertEqual(['Video 0', 'Video 1', 'Video 2', 'Video 3'], contents[playlists[0].id])
+        db.session.commit()
+        params = {key: 'on' for key in keys}
+        self.client.post('/delete', data=params, follow_redirects=True)
+        self.assertEqual(0, len(LikedVideo.query.filter_by(user_id=user_id).all()))
+        self.assertEqual(0, len(Playlist.query.filter_by(user_id=user_id).all()))
+        self.assertEqual(0, len(PlaylistVideo.query.all()))
+
+    def test_download_json_streams(self):
+        user = User.query.filter_by(username='testuser').first_or_404()
+        ytmapi.save_liked_videos({'items': [make_like(i) for i in range(5)]}, user)
+        dbPlaylistIds = ytmapi.save_playlists({'items': [make_playlist(i) for i in range(2)]}, user)
+        ytmapi.save_playlist_items({'items': [make_playlist_item(i) for i in range(3)]}, dbPlaylistIds['Playlist 0'])
+        db.session.commit()
+        params = {'Video 1videoid': 'on', 'Video 3videoid': 'on', 'Video 4videoid': 'on', 'Playlist 0playlis': 'on', 'Playlist 1playlis': 'on'}
+        with mock.patch('downloads.STREAM_BATCH_SIZE', 2):
+            resp = self.client.post('/download-json', data=params)
+            self.assertTrue(resp.is_streamed)
+            data = json.loads(resp.get_data(as_text=True))
+        self.assertIn('attachment', resp.headers['Content-Disposition'])
+        self.assertEqual(['Video 1', 'Video 3', 'Video 4'], [video['video_id'] for video in data['liked_videos']])
+        self.assertEqual([], data['subscriptions'])
+        self.assertEqual(['Video 0', 'Video 1', 'Video 2'], data['playlists'][0]['playlist_items'])
+        self.assertEqual({'playlist_title': 'Playlist Title 1', 'privacy_status': 'private', 'playlist_id': 'Playlist 1', 'playlist_items': []}, data['playlists'][1])
+
+    def test_download_formats(self):
+        user = User.query.filter_by(username='testuser').first_or_404()
+        ytmapi.save_liked_videos({'items': [make_like(i) for i in range(3)]}, user)
+        dbPlaylistIds = ytmapi.save_playlists({'items': [make_playlist(0)]}, user)
+        ytmapi.save_playlist_items({'items': [make_playlist_item(i) for i in range(2)]}, dbPlaylistIds['Playlist 0'])
+        db.session.commit()
+        params = {'Video 0videoid': 'on', 'Video 2videoid': 'on', 'Playlist 0playlis': 'on'}
+        resp = self.client.post('/download-json', data=dict(params, format='ndjson'), headers={'Accept-Encoding': 'gzip'})
+        self.assertEqual('gzip', resp.headers['Content-Encoding'])
+        lines = gzip.decompress(resp.get_data()).decode('utf-8').splitlines()
+        self.assertEqual(['liked_videos', 'liked_videos', 'playlists'], [json.loads(line)['category'] for line in lines])
+        self.assertEqual(['Video 0', 'Video 1'], json.loads(lines[2])['playlist_items'])
+        resp = self.client.post('/download-json', data=dict(params, format='ndjson'), headers={'Accept-Encoding': 'gzip, zstd'})
+        self.assertEqual('zstd', resp.headers['Content-Encoding'])
+        self.assertEqual(lines, zstandard.ZstdDecompressor().decompressobj().decompress(resp.get_data()).decode('utf-8').splitlines())
+        resp = self.client.post('/download-json', data=dict(params, format='csv:playlists'))
+        self.assertNotIn('Content-Encoding', resp.headers)
+        self.assertIn('Your_YouTube_Playlists.csv', resp.headers['Content-Disposition'])
+        self.assertEqual('playlist_id,playlist_title,privacy_status,position,video_id\r\nPlaylist 0,Playlist Title 0,private,0,Video 0\r\nPlaylist 0,Playlist Title 0,private,1,Video 1\r\n',
+                resp.get_data(as_text=True))
+
+    def test_list_api_pages(self):
+        user = User.query.filter_by(username='testuser').first_or_404()
+        ytmapi.save_liked_videos({'items': [make_like(i) for i in range(5)]}, user)
+        db.session.commit()
+        titles = []
+        page = self.client.get('/api/likes?limit=2').get_json()
+        while True:
+            self.assertLessEqual(len(page['items']), 2)
+            titles.extend(item['title'] for item in page['items'])
+            if page['next'] is None:
+                break
+            page = self.client.get('/api/likes?limit=2&after=%s' % page['next']).get_json()
+        self.assertEqual(['Video Title %s' % i for i in range(5)], titles)
+        self.assertEqual({'video_id', 'title', 'channel_title', 'thumbnail'}, set(page['items'][0]))
+        self.assertEqual([], self.client.get('/api/subscriptions').get_json()['items'])
+        self.assertEqual(404, self.client.get('/api/credentials').status_code)
+        with mock.patch('listings.PAGE_SIZE', 3):
+            html = self.client.get('/dashboard').get_data(as_text=True)
+        self.assertIn('Video Title 2', html)
+        self.assertNotIn('Video Title 3', html)
+        self.assertIn('loading="lazy"', html)
+
+    def test_prune_batched(self):
+        user = User.query.filter_by(username='testuser').first_or_404()
+        user_id = user.id
+        ytmapi.save_liked_videos({'items': [make_like(i) for i in range(6)]}, user)
+        dbPlaylistIds = ytmapi.save_playlists({'items': [make_playlist(i) for i in range(2)]}, user)
+        ytmapi.save_playlist_items({'items': [make_playlist_item(i) for i in range(3)]}, dbPlaylistIds['Playlist 0'])
+        LikedVideo.query.filter(LikedVideo.video_id != 'Video 5').update({'expiration_date': 0}, synchronize_session=False)
+        Playlist.query.filter_by(resource_id='Playlist 0').update({'expiration_date': 0}, synchronize_session=False)
+
+        # Finished jobs, ledger rows and quota days past their retention go too
+        now = time.time()
+        old = now - 365 * 24 * 60 * 60
+        db.session.add(Job(user_id=user_id, kind='export', state='done', payload='{}', created_at=old, finished_at=old))
+        db.session.add(Job(user_id=user_id, kind='export', state='running', payload='{}', created_at=old, started_at=old))
+        db.session.add(Job(user_id=user_id, kind='export', state='done', payload='{}', created_at=now, finished_at=now))
+        db.session.add(ExportedItem(user_id=user_id, kind='video', source_id='Video 0', created_at=old))
+        db.session.add(ExportedItem(user_id=user_id, kind='video', source_id='Video 1', created_at=now))
+        db.session.add(QuotaUsage(user_id=user_id, endpoint='videos.list', day='2000-01-01', units=1))
+        db.session.add(QuotaUsage(user_id=user_id, endpoint='videos.list', day=quota.quota_day(), units=1))
+        db.session.commit()
+        statements = []
+        listener = lambda conn, cursor, statement, parameters, context, executemany: statements.append(statement)
+        event.listen(db.engine, 'before_cursor_execute', listener)
+        try:
+            with mock.patch('prune.PRUNE_BATCH_SIZE', 2):
+                counts = prune.prune()
+        finally:
+            event.remove(db.engine, 'before_cursor_execute', listener)
+        self.assertEqual({'liked_videos': 5, 'subscriptions': 0, 'playlists': 1, 'page_etags': 0, 'jobs': 1, 'export_ledger': 1, 'quota_usage': 1}, counts)
+        self.assertEqual(['running', 'done'], [job.state for job in Job.query.order_by(Job.created_at).all()])
+        self.assertEqual(['Video 1'], [item.source_id for item in ExportedItem.query.all()])
+        self.assertEqual([quota.quota_day()], [usage.day for usage in QuotaUsage.query.all()])
+        self.assertEqual(3, len([statement for statement in statements if statement.startswith('DELETE FROM liked_videos')]))
+        self.assertEqual(['Video 5'], [video.video_id for video in LikedVideo.query.filter_by(user_id=user_id).all()])
+        self.assertEqual(['Playlist 1'], [playlist.resource_id for playlist in Playlist.query.filter_by(user_id=user_id).all()])
+        self.assertEqual(0, len(PlaylistVideo.query.all()))
@@ -0,0 +1,71 @@
+from models import db, connect_db
+import jobs
+import metrics
+import prune
+import ytmapi
+import logging
+import os
+import threading
+import time
+from flask import Flask
+
+logger = logging.getLogger(__name__)
+
+app = Flask(__name__)
+
+DATABASE_URL = os.environ['DATABASE_URL']
+app.config['SQLALCHEMY_DATABASE_URI'] = DATABASE_URL
+app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+connect_db(app)
+metrics.watch_queries(db.engine)
+
+# Number of jobs run at once and seconds to wait when the queue is empty
+WORKER_THREADS = int(os.environ.get('WORKER_THREADS', 4))
+POLL_INTERVAL = float(os.environ.get('WORKER_POLL_INTERVAL', 2))
+
+# Port the worker serves its metrics on, if set
+METRICS_PORT = os.environ.get('METRICS_PORT')
+
+def work():
+    """
+    Claims and runs queued jobs until the process exits
+    """
+
+    while True:
+        # Leave jobs queued while the API is failing
+        ytmapi.circuit.wait()
+
+        # Each job gets its own app context, and so its own database session
+        with app.app_context():
+            job = jobs.claim_job()
+            if job is not None:
+                jobs.run_job(job)
+                continue
+        time.sleep(POLL_INTERVAL)
+
+def prune_periodically():
+    """
+    Deletes expired rows every PRUNE_INTERVAL seconds until the process exits
+    """
+
+    while True:
+        with app.app_context():
+            try:
+                prune.prune()
+            except Exception:
+                logger.exception('Prune failed')
+                db.session.rollback()
+        time.sleep(prune.PRUNE_INTERVAL)
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+
+    if METRICS_PORT:
+        metrics.serve(int(METRICS_PORT))
+
+    threads = [threading.Thread(target=work, daemon=True) for i in range(WORKER_THREADS)]
+    threads.append(threading.Thread(target=prune_periodically, daemon=True))
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
@@ -1,17 +1,98 @@
-from models import db, connect_db, User, Subscription, LikedVideo, Playlist, PlaylistVideo, Credential
+from models import db, Subscription, LikedVideo, Playlist, PlaylistVideo, Credential, PageEtag
+from sqlalchemy import and_, or_, tuple_
+from sqlalchemy.dialects import postgresql
 import os
 import google.oauth2.credentials
 import google_auth_oauthlib.flow
 import googleapiclient.discovery
 import googleapiclient.errors
 import google.auth
-import oauthlib
 import requests
+import quota
+import metrics
+import jwt
 import datetime
+import json
+import queue
+import random
+import socket
+import tempfile
+import threading
+import time
+import logging
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
 api_service_name = "youtube"
 api_version = "v3"
 
+# Root URL the YouTube Data API is called at, such as http://localhost:8090/ for the
+# local emulator in fakeyoutube.py, or None for Google
+YOUTUBE_API_URL = os.environ.get('YOUTUBE_API_URL')
+
+# Discovery document is fetched once per process and kept on disk between restarts,
+# except an emulator's which is fetched from the emulator and never cached
+DISCOVERY_URL = 'https://www.googleapis.com/discovery/v1/apis/youtube/v3/rest'
+if YOUTUBE_API_URL:
+    DISCOVERY_URL = YOUTUBE_API_URL.rstrip('/') + '/discovery/v1/apis/youtube/v3/rest'
+DISCOVERY_CACHE_PATH = os.environ.get('DISCOVERY_CACHE_PATH', os.path.join(tempfile.gettempdir(), 'youtube-v3-discovery.json'))
+DISCOVERY_MAX_AGE = 60 * 60 * 24
+
+# Seconds a built service object is reused before credentials are reloaded
+SERVICE_MAX_AGE = 60 * 5
+
+# Seconds loaded credentials are reused before being read from the database again
+CREDENTIALS_MAX_AGE = SERVICE_MAX_AGE
+
+# Stored access tokens this close to expiring are refreshed rather than reused
+TOKEN_REFRESH_SLACK = 60
+
+# Roles of a user's linked Google accounts. Imports read from and exports write to
+# the source account, and migrations copy from it straight into the target account.
+SOURCE = 'source'
+TARGET = 'target'
+
+# Most calls the YouTube API accepts in one batch request
+BATCH_SIZE = 50
+
+# Re-imports only rewrite an unchanged row once its expiration date is this many seconds old
+EXPIRATION_REFRESH_SLACK = 60 * 60 * 24
+
+# Number of playlists whose contents are fetched at the same time
+PLAYLIST_FETCH_WORKERS = int(os.environ.get('PLAYLIST_FETCH_WORKERS', 4))
+
+# Times a failing call is sent before giving up, and the backoff between tries in seconds
+RETRY_ATTEMPTS = int(os.environ.get('RETRY_ATTEMPTS', 5))
+RETRY_BASE_DELAY = 1
+RETRY_MAX_DELAY = 32
+
+# Transient failures in a row that pause all API calls, and for how many seconds
+CIRCUIT_FAILURE_THRESHOLD = int(os.environ.get('CIRCUIT_FAILURE_THRESHOLD', 10))
+CIRCUIT_RESET_TIMEOUT = int(os.environ.get('CIRCUIT_RESET_TIMEOUT', 60))
+
+# Seconds an import estimate shown to a user is reused before asking YouTube again
+IMPORT_ESTIMATE_MAX_AGE = int(os.environ.get('IMPORT_ESTIMATE_MAX_AGE', 60 * 60))
+
+# Error reasons that go away if the call is sent again later
+RETRYABLE_REASONS = ('rateLimitExceeded', 'userRateLimitExceeded', 'backendError', 'internalError')
+
+# Error reasons meaning the item is already in the state the call asked for
+DUPLICATE_REASONS = ('subscriptionDuplicate', 'videoAlreadyInPlaylist')
+
+# Error reasons after which no other call can succeed today
+FATAL_REASONS = ('quotaExceeded', 'dailyLimitExceeded')
+
+# How an API error should be handled
+RETRY = 'retry'
+DUPLICATE = 'duplicate'
+FATAL = 'fatal'
+PERMANENT = 'permanent'
+
+# Exceptions a call to the API can fail with
+API_ERRORS = (googleapiclient.errors.HttpError, ConnectionError, socket.timeout)
+
+logger = logging.getLogger(__name__)
+
 # Get secrets from environment
 GOOGLE_CLIENT_SECRET = os.environ['GOOGLE_CLIENT_SECRET']
 
@@ -21,13 +102,16 @@ GOOGLE_PROJECT_ID = 'youtube-data-migrator'
 GOOGLE_REDIRECT_URIS = ["https://yt-data-migrator.herokuapp.com"]
 GOOGLE_JAVASCRIPT_ORIGINS = ["https://yt-data-migrator.herokuapp.com"]
 
+# OAuth 2.0 endpoint access tokens are exchanged and refreshed at, which the emulator also serves
+GOOGLE_TOKEN_URI = os.environ.get('GOOGLE_TOKEN_URI', 'https://www.googleapis.com/oauth2/v3/token')
+
 # Client configuration for an OAuth 2.0 web server application
 # (cf. https://developers.google.com/identity/protocols/OAuth2WebServer)
 CLIENT_CONFIG = {'web': {
     'client_id': GOOGLE_CLIENT_ID,
     'project_id': GOOGLE_PROJECT_ID,
     'auth_uri': 'https://accounts.google.com/o/oauth2/auth',
-    'token_uri': 'https://www.googleapis.com/oauth2/v3/token',
+    'token_uri': GOOGLE_TOKEN_URI,
     'auth_provider_x509_cert_url': 'https://www.googleapis.com/oauth2/v1/certs',
     'client_secret': GOOGLE_CLIENT_SECRET,
     'redirect_uris': GOOGLE_REDIRECT_URIS,
@@ -49,13 +133,108 @@ def make_expiration_date():
     expiration = datetime.datetime.utcnow() + datetime.timedelta(days=14)
     return expiration.timestamp()
 
-def get_credentials(user_id):
+class StoredCredentials(google.oauth2.credentials.Credentials):
+    """
+    Google credentials for one of a user's linked accounts that save refreshed
+    tokens to the credentials table
+
+    Only one refresh per account runs at a time. Threads in this process queue
+    on a lock and other processes on the credentials row lock; whoever waited
+    takes the token the first refresh saved instead of refreshing again.
+    Refreshing uses its own connection, so it works in fetch threads that
+    have no database session.
+    """
+
+    def __init__(self, user_id, *args, role=SOURCE, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.user_id = user_id
+        self.role = role
+
+    def refresh(self, request):
+        table = Credential.__table__
+        row = and_(table.c.user_id == self.user_id, table.c.role == self.role)
+
+        # Threads sharing this object see each other's refresh on self, so
+        # compare against the token this thread found stale, not self.token
+        rejected = self.token
+        with refresh_lock(self.user_id, self.role), db.engine.begin() as connection:
+            query = db.select([table.c.token, table.c.expiry]).where(row)
+            if db.engine.dialect.name == 'postgresql':
+                query = query.with_for_update()
+            stored = connection.execute(query).first()
+
+            # Someone else refreshed while this thread waited
+            if stored is not None and stored.token != rejected and not token_expired(stored.expiry):
+                self.token = stored.token
+                self.expiry = expiry_datetime(stored.expiry)
+                return
+
+            super().refresh(request)
+            connection.execute(table.update().where(row).values(
+                    token = self.token,
+                    refresh_token = self.refresh_token,
+                    expiry = expiry_timestamp(self.expiry)
+                    ))
+
+refresh_locks = {}
+refresh_locks_lock = threading.Lock()
+
+def refresh_lock(user_id, role=SOURCE):
+    """
+    Returns the lock that keeps token refreshes of a user's account in this process one at a time
+    """
+
+    with refresh_locks_lock:
+        return refresh_locks.setdefault((user_id, role), threading.Lock())
+
+def expiry_timestamp(expiry):
+    """
+    Converts google-auth's naive UTC expiry datetime to a timestamp for the database
+    """
+
+    if expiry is None:
+        return None
+
+    return expiry.replace(tzinfo=datetime.timezone.utc).timestamp()
+
+def expiry_datetime(timestamp):
+    """
+    Converts a stored expiry timestamp to the naive UTC datetime google-auth expects
+    """
+
+    if timestamp is None:
+        return None
+
+    return datetime.datetime.utcfromtimestamp(timestamp)
+
+def token_expired(timestamp):
+    """
+    Returns True if a stored access token is unknown, expired or about to expire
+    """
+
+    return timestamp is None or timestamp - TOKEN_REFRESH_SLACK <= time.time()
+
+credentials_cache = {}
+credentials_lock = threading.Lock()
+
+def get_credentials(user_id, role=SOURCE):
     """
     Returns credentials object formatted for Google API requests
+
+    Credentials are cached per user and role for CREDENTIALS_MAX_AGE seconds
+    and shared by every thread, so a refreshed token is reused by all of them.
     """
 
-    token = Credential.query.filter_by(user_id=user_id).first_or_404()
-    credentials = google.oauth2.credentials.Credentials(
+    now = time.time()
+    with credentials_lock:
+        cached = credentials_cache.get((user_id, role))
+        if cached is not None and cached[1] > now:
+            return cached[0]
+
+    token = Credential.query.filter_by(user_id=user_id, role=role).first_or_404()
+    credentials = StoredCredentials(
+            user_id,
+            role = role,
             token = token.token,
             refresh_token = token.refresh_token,
             token_uri = CLIENT_CONFIG['web']['token_uri'],
@@ -63,10 +242,159 @@ def get_credentials(user_id):
             client_secret = GOOGLE_CLIENT_SECRET,
             scopes = SCOPES
             )
+    credentials.expiry = expiry_datetime(token.expiry)
+
+    with credentials_lock:
+        credentials_cache[(user_id, role)] = (credentials, now + CREDENTIALS_MAX_AGE)
 
     return credentials
 
 
+discovery_document = None
+discovery_lock = threading.Lock()
+
+def get_discovery_document():
+    """
+    Returns the parsed YouTube discovery document, loading it once per process
+    """
+
+    global discovery_document
+    with discovery_lock:
+        if discovery_document is None:
+            discovery_document = load_discovery_document()
+
+    return discovery_document
+
+def load_discovery_document():
+    """
+    Reads the discovery document from disk, downloading it when missing or stale
+    """
+
+    if YOUTUBE_API_URL:
+        return load_emulator_discovery_document()
+
+    # Use the disk copy if it is recent enough
+    try:
+        if time.time() - os.path.getmtime(DISCOVERY_CACHE_PATH) < DISCOVERY_MAX_AGE:
+            with open(DISCOVERY_CACHE_PATH) as f:
+                return json.load(f)
+    except (OSError, ValueError):
+        pass
+
+    # Download and parse a fresh copy
+    response = requests.get(DISCOVERY_URL, timeout=30)
+    response.raise_for_status()
+    document = response.json()
+
+    # Write to a temporary file first so other processes never read a partial copy
+    try:
+        fd, tmppath = tempfile.mkstemp(dir=os.path.dirname(DISCOVERY_CACHE_PATH))
+        with os.fdopen(fd, "w") as f:
+            json.dump(document, f)
+        os.replace(tmppath, DISCOVERY_CACHE_PATH)
+    except OSError:
+        pass
+
+    return document
+
+def load_emulator_discovery_document():
+    """
+    Downloads the discovery document of the API at YOUTUBE_API_URL, pointing its calls there
+    """
+
+    response = requests.get(DISCOVERY_URL, timeout=30)
+    response.raise_for_status()
+    document = response.json()
+    document['rootUrl'] = YOUTUBE_API_URL.rstrip('/') + '/'
+
+    return document
+
+# Makes the HTTP transport of each new service object from the user's credentials,
+# or None to send requests to Google. Benchmarks swap in a fake YouTube here.
+transport = None
+
+def use_transport(factory, document=None):
+    """
+    Sends the requests of service objects built from now on through factory(credentials),
+    optionally building them from another discovery document
+
+    Pass None to go back to Google.
+    """
+
+    global transport, discovery_document
+    with discovery_lock:
+        transport = factory
+        if document is not None:
+            discovery_document = document
+    with services_lock:
+        services.clear()
+
+    return
+
+def build_service(credentials):
+    """
+    Builds a YouTube service object from the cached discovery document
+    """
+
+    document = get_discovery_document()
+
+    # Building fills in defaults on the shared document, so only one build runs at a time
+    with discovery_lock:
+        if transport is not None:
+            youtube = googleapiclient.discovery.build_from_document(document, http=transport(credentials))
+        else:
+            youtube = googleapiclient.discovery.build_from_document(document, credentials=credentials)
+
+    return youtube
+
+services = {}
+services_lock = threading.Lock()
+
+def get_service(user, credentials=None, role=SOURCE):
+    """
+    Returns a cached YouTube service object for the user's account in role
+
+    httplib2 connections are not thread-safe, so each thread gets its own
+    service object per account. Threads without a database session pass in
+    credentials loaded elsewhere.
+    """
+
+    key = (user.id, role, threading.get_ident())
+    now = time.time()
+    with services_lock:
+        cached = services.get(key)
+        if cached is not None and cached[1] > now:
+            return cached[0]
+
+    # Build the service object
+    if credentials is None:
+        credentials = get_credentials(user.id, role)
+    youtube = build_service(credentials)
+
+    # Save it, dropping any entries that have expired
+    with services_lock:
+        for stale in [k for k, v in services.items() if v[1] <= now]:
+            del services[stale]
+        services[key] = (youtube, now + SERVICE_MAX_AGE)
+
+    return youtube
+
+def forget_services(user_id):
+    """
+    Drops cached service objects, credentials and import estimates for all of a user's accounts so new credentials take effect
+    """
+
+    with services_lock:
+        for key in [k for k in services if k[0] == user_id]:
+            del services[key]
+    with credentials_lock:
+        for key in [k for k in credentials_cache if k[0] == user_id]:
+            del credentials_cache[key]
+    with import_estimates_lock:
+        import_estimates.pop(user_id, None)
+
+    return
+
 def get_authorization_url():
     """
     Makes OAuth 2.0 flow url for user to authorize consent
@@ -93,239 +421,947 @@ def get_authorization_url():
 
     return authorization_url, state
 
-def get_playlists(user, page=None):
+def list_request(youtube, resource, page=None, **params):
     """
-    Authenticated API request to get user's playlists
+    Builds a request for one page of a list endpoint
     """
 
-    # Get credentials
-    credentials = get_credentials(user.id)
+    request = getattr(youtube, resource)().list(
+            maxResults=50,
+            pageToken=page,
+            **params
+            )
 
-    # Build the service object
-    youtube = googleapiclient.discovery.build(
-            api_service_name, api_version, credentials=credentials, cache_discovery=False)
+    return request
 
-    # Request parameters
-    request = youtube.playlists().list(
+def error_reason(exception):
+    """
+    Returns the reason Google gave for a failed call, such as rateLimitExceeded
+    """
+
+    if not isinstance(exception, googleapiclient.errors.HttpError):
+        return type(exception).__name__
+
+    try:
+        error = json.loads(exception.content.decode('utf-8'))['error']
+        return error['errors'][0]['reason']
+    except (ValueError, KeyError, IndexError, TypeError):
+        return str(exception.resp.status)
+
+def classify_error(exception):
+    """
+    Sorts a failed call into RETRY, DUPLICATE, FATAL or PERMANENT
+    """
+
+    if isinstance(exception, (ConnectionError, socket.timeout)):
+        return RETRY
+    if not isinstance(exception, googleapiclient.errors.HttpError):
+        return PERMANENT
+
+    reason = error_reason(exception)
+    if exception.resp.status >= 500 or exception.resp.status == 429 or reason in RETRYABLE_REASONS:
+        return RETRY
+    if reason in DUPLICATE_REASONS:
+        return DUPLICATE
+    if reason in FATAL_REASONS:
+        return FATAL
+
+    return PERMANENT
+
+def backoff_delay(attempt):
+    """
+    Seconds to wait before retry number attempt, doubling each time with full jitter
+    """
+
+    return random.uniform(0, min(RETRY_MAX_DELAY, RETRY_BASE_DELAY * 2 ** attempt))
+
+class CircuitBreaker():
+    """
+    Pauses every API call in the process once calls keep failing transiently
+
+    After threshold failures in a row the circuit opens, and wait() blocks
+    callers for reset_timeout seconds. The next call after that is a trial:
+    one success closes the circuit, one more failure opens it again.
+    """
+
+    def __init__(self, threshold, reset_timeout):
+        self.threshold = threshold
+        self.reset_timeout = reset_timeout
+        self.lock = threading.Lock()
+        self.failures = 0
+        self.opened_at = None
+
+    def wait(self):
+        """
+        Blocks until the circuit lets calls through
+        """
+
+        with self.lock:
+            if self.opened_at is None:
+                return
+            delay = self.opened_at + self.reset_timeout - time.time()
+        if delay > 0:
+            logger.warning('YouTube API circuit open, pausing for %.0fs', delay)
+            time.sleep(delay)
+
+        return
+
+    def succeeded(self):
+        with self.lock:
+            self.failures = 0
+            self.opened_at = None
+
+    def failed(self):
+        with self.lock:
+            self.failures += 1
+            if self.failures >= self.threshold:
+                self.opened_at = time.time()
+
+# Shared by all threads, since they all talk to the same API
+circuit = CircuitBreaker(CIRCUIT_FAILURE_THRESHOLD, CIRCUIT_RESET_TIMEOUT)
+
+metrics.describe('youtube_api_calls_total', 'counter', 'YouTube API calls by endpoint and HTTP status')
+metrics.describe('youtube_api_errors_total', 'counter', 'Failed YouTube API calls by endpoint and error reason')
+metrics.describe('youtube_api_seconds', 'histogram', 'Seconds each YouTube API request took, a batch counting as one request')
+
+def call_status(exception):
+    """
+    Returns the HTTP status of an API call for metrics, or the exception name if there was no response
+    """
+
+    if exception is None:
+        return '200'
+    if isinstance(exception, googleapiclient.errors.HttpError):
+        return str(exception.resp.status)
+
+    return type(exception).__name__
+
+def count_call(endpoint, exception=None):
+    """
+    Counts an API call and its outcome in the metrics
+    """
+
+    status = call_status(exception)
+    metrics.inc('youtube_api_calls_total', endpoint=endpoint, status=status)
+    if exception is not None and status != '304':
+        metrics.inc('youtube_api_errors_total', endpoint=endpoint, reason=error_reason(exception))
+
+    return
+
+def execute(user, request):
+    """
+    Sends a single API request on behalf of a user, metering its quota cost
+
+    Transient failures are retried with backoff up to RETRY_ATTEMPTS times
+    in total; any other error is raised straight away.
+    """
+
+    for attempt in range(RETRY_ATTEMPTS):
+        circuit.wait()
+        quota.record(user.id, request)
+        endpoint = quota.request_endpoint(request)
+        try:
+            with metrics.timed('youtube_api_seconds', endpoint=endpoint):
+                response = request.execute()
+        except API_ERRORS as exception:
+            count_call(endpoint, exception)
+            if classify_error(exception) != RETRY:
+                # The API answered, so it is up
+                circuit.succeeded()
+                raise
+            circuit.failed()
+            if attempt + 1 == RETRY_ATTEMPTS:
+                raise
+            logger.warning('Retrying %s after %s', endpoint, error_reason(exception))
+            time.sleep(backoff_delay(attempt))
+            continue
+        count_call(endpoint)
+        circuit.succeeded()
+
+        return response
+
+def paginate(user, resource, page=None, etags=None, role=SOURCE, **params):
+    """
+    Authenticated API requests yielding one page of a list response at a time
+
+    etags maps page tokens to StoredEtags from an earlier import. Those pages
+    are requested with If-None-Match, and unchanged ones come back as
+    not_modified_page() placeholders without being downloaded again.
+    """
+
+    etags = etags or {}
+    while True:
+        # Get the service object
+        youtube = get_service(user, role=role)
+
+        # Request parameters
+        request = list_request(youtube, resource, page, **params)
+        cached = etags.get(page or '')
+        if cached is not None:
+            request.headers['If-None-Match'] = cached.etag
+
+        # Hand each page to the caller before requesting the next one
+        try:
+            response = execute(user, request)
+            response['pageToken'] = page
+        except googleapiclient.errors.HttpError as error:
+            if cached is None or error.resp.status != 304:
+                raise
+            response = not_modified_page(cached)
+        yield response
+        page = response.get('nextPageToken')
+        if page is None:
+            return
+
+def not_modified_page(cached):
+    """
+    Placeholder page for a 304 response, filled in from the StoredEtag
+    """
+
+    response = {
+            'notModified' : True,
+            'pageToken' : cached.page_token or None,
+            'items' : [],
+            'itemCount' : cached.item_count,
+            'pageInfo' : {'totalResults' : cached.total_results}
+            }
+    if cached.next_page_token is not None:
+        response['nextPageToken'] = cached.next_page_token
+
+    return response
+
+def page_count(response):
+    """
+    Returns the number of items on a page, including unchanged pages
+    """
+
+    return response.get('itemCount', len(response['items']))
+
+# Plain copy of a PageEtag row, safe to hand to the fetch threads
+StoredEtag = namedtuple('StoredEtag', ['page_token', 'etag', 'next_page_token', 'item_count', 'total_results'])
+
+def load_etags(user):
+    """
+    Returns the user's unexpired page ETags as {resource: {page_token: StoredEtag}}
+
+    Plain values rather than PageEtag rows, since the fetch threads read them
+    after the main thread has committed and expired its session.
+    """
+
+    etags = {}
+    now = datetime.datetime.utcnow().timestamp()
+    rows = db.session.query(PageEtag.resource, *(getattr(PageEtag, field) for field in StoredEtag._fields)) \
+            .filter(PageEtag.user_id == user.id, PageEtag.expiration_date > now)
+    for row in rows:
+        etags.setdefault(row.resource, {})[row.page_token] = StoredEtag(*row[1:])
+
+    return etags
+
+def save_etags(user, resource, pages):
+    """
+    Saves the ETags of freshly downloaded pages so the next import can skip them
+    """
+
+    expiration_date = make_expiration_date()
+    rows = []
+    for page in pages:
+        if page.get('notModified') or 'etag' not in page:
+            continue
+        rows.append({
+                'user_id' : user.id,
+                'resource' : resource,
+                'page_token' : page.get('pageToken') or '',
+                'etag' : page['etag'],
+                'next_page_token' : page.get('nextPageToken'),
+                'item_count' : len(page['items']),
+                'total_results' : page.get('pageInfo', {}).get('totalResults', 0),
+                'expiration_date' : expiration_date
+                })
+    upsert_rows(PageEtag, rows, ['user_id', 'resource', 'page_token'])
+    db.session.commit()
+
+    return
+
+def forget_etags(user):
+    """
+    Drops the user's page ETags, so the next import downloads everything again
+    """
+
+    PageEtag.query.filter_by(user_id=user.id).delete()
+    db.session.commit()
+
+    return
+
+def refresh_expiration(model, user):
+    """
+    Pushes back the expiration date of rows skipped because their pages were unchanged
+    """
+
+    expiration_date = make_expiration_date()
+    for table in (model, PageEtag):
+        table.query.filter_by(user_id=user.id).filter(table.expiration_date < expiration_date - EXPIRATION_REFRESH_SLACK).update(
+                {'expiration_date': expiration_date}, synchronize_session=False)
+    db.session.commit()
+
+    return
+
+def report_progress(progress, done, total=0):
+    """
+    Passes a count of finished items, and any newly discovered total, to a progress callback
+    """
+
+    if progress is not None:
+        progress(done, total)
+
+    return
+
+def report_failure(failures, item, exception):
+    """
+    Adds an item that failed to a list of (item, exception) pairs
+
+    Without a list to add to, or when no later call could succeed either,
+    the exception is raised instead.
+    """
+
+    if failures is None or classify_error(exception) == FATAL:
+        raise exception
+    failures.append((item, exception))
+
+    return
+
+def page_total(response, first_page):
+    """
+    Returns the total result count from the first page of a list response
+    """
+
+    if not first_page:
+        return 0
+
+    return response.get('pageInfo', {}).get('totalResults', 0)
+
+def chunked(iterable, size):
+    """
+    Yields lists of up to size items from iterable
+    """
+
+    chunk = []
+    for item in iterable:
+        chunk.append(item)
+        if len(chunk) == size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+def read_ahead(iterable, size):
+    """
+    Yields the items of iterable while a thread reads up to size items ahead of the caller
+
+    An exception raised reading is raised to the caller in its place. Closing
+    the generator, as happens when the caller stops early or raises, stops the
+    thread after the item it is reading.
+    """
+
+    items = queue.Queue(size)
+    stop = threading.Event()
+    end = object()
+
+    def put(entry):
+        while not stop.is_set():
+            try:
+                items.put(entry, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def read():
+        try:
+            for item in iterable:
+                if not put((item, None)):
+                    return
+        except Exception as exception:
+            put((end, exception))
+        else:
+            put((end, None))
+
+    thread = threading.Thread(target=read, daemon=True)
+    thread.start()
+    try:
+        while True:
+            item, exception = items.get()
+            if exception is not None:
+                raise exception
+            if item is end:
+                return
+            yield item
+    finally:
+        stop.set()
+        thread.join()
+
+def execute_batch(user, calls, progress=None, role=SOURCE):
+    """
+    Sends (key, request) pairs to the API in batches of BATCH_SIZE
+
+    Returns a dictionary mapping each key to a (response, exception) tuple,
+    one of which is None, so callers can match outcomes to their source rows.
+    Calls that fail transiently are retried like execute() does, and a FATAL
+    error such as quotaExceeded is raised once its batch is done.
+    """
+
+    results = {}
+    for chunk in chunked(calls, BATCH_SIZE):
+
+        # Resend only the calls that failed transiently, with backoff between rounds
+        pending = chunk
+        for attempt in range(RETRY_ATTEMPTS):
+            circuit.wait()
+            send_batch(user, pending, results, role)
+            retry = [(key, request) for key, request in pending if classify_error(results[key][1]) == RETRY]
+            if len(retry) == len(pending):
+                circuit.failed()
+            else:
+                circuit.succeeded()
+            if not retry or attempt + 1 == RETRY_ATTEMPTS:
+                break
+            logger.warning('Retrying %s of %s batched calls', len(retry), len(pending))
+            time.sleep(backoff_delay(attempt))
+            pending = retry
+
+        # Stop before sending more calls that cannot succeed
+        for key, request in chunk:
+            exception = results[key][1]
+            if exception is not None and classify_error(exception) == FATAL:
+                raise exception
+        report_progress(progress, len(chunk))
+
+    return results
+
+def send_batch(user, calls, results, role=SOURCE):
+    """
+    Sends (key, request) pairs as one batch, storing each outcome in results
+    """
+
+    keys = {}
+    endpoints = {}
+
+    def callback(request_id, response, exception):
+        results[keys[request_id]] = (response, exception)
+        count_call(endpoints[request_id], exception)
+
+    # Get the service object
+    youtube = get_service(user, role=role)
+
+    # Group requests into one HTTP call
+    batch = youtube.new_batch_http_request(callback=callback)
+    for request_id, (key, request) in enumerate(calls):
+        keys[str(request_id)] = key
+        endpoints[str(request_id)] = quota.request_endpoint(request)
+        batch.add(request, request_id=str(request_id))
+        quota.record(user.id, request)
+
+    # A failure of the batch itself is a failure of every call in it
+    try:
+        with metrics.timed('youtube_api_seconds', endpoint='batch'):
+            batch.execute()
+    except API_ERRORS as exception:
+        for key, request in calls:
+            results[key] = (None, exception)
+            count_call(quota.request_endpoint(request), exception)
+
+    return
+
+def get_playlists(user, page=None, role=SOURCE):
+    """
+    Authenticated API request to get user's playlists, one page at a time
+
+    Playlist pages are always downloaded, since their contents can change
+    without the page itself changing.
+    """
+
+    return paginate(
+            user,
+            'playlists',
+            page=page,
+            role=role,
             part="snippet, status",
-            maxResults=50,
             mine=True,
-            pageToken=page
+            fields="nextPageToken,pageInfo/totalResults,items(id,snippet(title,thumbnails/default/url),status/privacyStatus)"
             )
 
-    # Recursive requests append to original response object until no data left
-    response = request.execute()
-    if 'nextPageToken' in response:
-        pageToken = response['nextPageToken']
-        newResponse = get_playlists(user, pageToken)
-        response['items'].extend(newResponse['items'])
+def get_playlist_items(user, playlist_id, page=None, etags=None, role=SOURCE):
+    """
+    Authenticated API request to get contents of single playlist, one page at a time
+    """
 
-    return response
+    return paginate(user, 'playlistItems', page=page, etags=etags, role=role, **playlist_items_params(playlist_id))
 
-def get_playlist_items(user, playlist_id, page=None):
+def playlist_items_params(playlist_id):
     """
-    Authenticated API request to get contents of single playlist
+    Request parameters for listing the contents of a playlist
     """
 
-    # Get credentials
-    credentials = get_credentials(user.id)
+    params = {
+            'part' : "snippet",
+            'playlistId' : playlist_id,
+            'fields' : "etag,nextPageToken,pageInfo/totalResults,items/snippet(position,resourceId/videoId)"
+            }
 
-    # Build the service object
-    youtube = googleapiclient.discovery.build(
-            api_service_name, api_version, credentials=credentials, cache_discovery=False)
+    return params
 
-    # Request parameters
-    request = youtube.playlistItems().list(
-            part="snippet",
-            playlistId=playlist_id,
-            maxResults=50,
-            pageToken=page
-            )
+def get_first_playlist_items(user, playlist_ids, etags=None):
+    """
+    Batched API request for the first page of each playlist's contents
 
-    # Recursive requests append to original response object until no data left
-    response = request.execute()
-    if 'nextPageToken' in response:
-        pageToken = response['nextPageToken']
-        newResponse = get_playlist_items(user, playlist_id, pageToken)
-        response['items'].extend(newResponse['items'])
+    etags maps playlist ids to their stored first page StoredEtag, and unchanged
+    first pages come back as not_modified_page() placeholders.
+    """
 
-    return response
+    etags = etags or {}
+    youtube = get_service(user)
+    calls = []
+    for playlist_id in playlist_ids:
+        request = list_request(youtube, 'playlistItems', **playlist_items_params(playlist_id))
+        if playlist_id in etags:
+            request.headers['If-None-Match'] = etags[playlist_id].etag
+        calls.append((playlist_id, request))
+
+    results = execute_batch(user, calls)
+    for playlist_id, (response, exception) in results.items():
+        if response is not None:
+            response['pageToken'] = None
+        elif isinstance(exception, googleapiclient.errors.HttpError) and exception.resp.status == 304 and playlist_id in etags:
+            results[playlist_id] = (not_modified_page(etags[playlist_id]), None)
+
+    return results
+
+def upsert_rows(model, rows, keys, returning=()):
+    """
+    Inserts row dictionaries for a model, updating rows whose keys already exist
+
+    Existing rows are only rewritten when a value changed or their expiration
+    date is more than EXPIRATION_REFRESH_SLACK old, so re-importing unchanged
+    data costs no writes. On Postgres this is one INSERT ... ON CONFLICT and
+    the returning columns of inserted or updated rows come back as a list of
+    tuples; other databases return an empty list.
+    """
+
+    # Rows sharing a key in one statement would conflict with each other
+    rows = list({tuple(row[key] for key in keys): row for row in rows}.values())
+    if not rows:
+        return []
+
+    if db.engine.dialect.name == 'postgresql':
+        return upsert_rows_postgresql(model, rows, keys, returning)
+
+    upsert_rows_generic(model, rows, keys)
+
+    return []
+
+def upsert_rows_postgresql(model, rows, keys, returning):
+    """
+    Upserts rows with a single INSERT ... ON CONFLICT statement
+    """
+
+    table = model.__table__
+    statement = postgresql.insert(table).values(rows)
+    updates = [column for column in rows[0] if column not in keys]
+
+    if updates:
+        # Only touch rows that changed or are due a new expiration date
+        changed = [table.c[column].is_distinct_from(statement.excluded[column]) for column in updates if column != 'expiration_date']
+        if 'expiration_date' in updates:
+            changed.append(table.c.expiration_date < statement.excluded.expiration_date - EXPIRATION_REFRESH_SLACK)
+        statement = statement.on_conflict_do_update(
+                index_elements=keys,
+                set_={column: statement.excluded[column] for column in updates},
+                where=or_(*changed)
+                )
+    else:
+        statement = statement.on_conflict_do_nothing(index_elements=keys)
+
+    if returning:
+        return db.session.execute(statement.returning(*returning)).fetchall()
+    db.session.execute(statement)
+
+    return []
+
+def upsert_rows_generic(model, rows, keys):
+    """
+    Upserts rows on databases without INSERT ... ON CONFLICT support in SQLAlchemy
+    """
+
+    table = model.__table__
+    updates = [column for column in rows[0] if column not in keys]
+
+    # Read the existing versions of these rows
+    query = db.session.query(*[table.c[column] for column in keys + updates])
+    for key in keys:
+        query = query.filter(table.c[key].in_(set(row[key] for row in rows)))
+    existing = {tuple(row[:len(keys)]): dict(zip(updates, row[len(keys):])) for row in query}
+
+    # Insert new rows together and update changed rows one at a time
+    new_rows = []
+    for row in rows:
+        current = existing.get(tuple(row[key] for key in keys))
+        if current is None:
+            new_rows.append(row)
+            continue
+        changed = any(current[column] != row[column] for column in updates if column != 'expiration_date')
+        if 'expiration_date' in updates:
+            changed = changed or current['expiration_date'] < row['expiration_date'] - EXPIRATION_REFRESH_SLACK
+        if changed:
+            db.session.execute(table.update()
+                    .where(and_(*[table.c[key] == row[key] for key in keys]))
+                    .values({column: row[column] for column in updates}))
+    if new_rows:
+        db.session.execute(table.insert().values(new_rows))
+
+    return
 
 def save_playlists(playlists, user):
     """
     Saves playlist data from YouTube API response to database
+
+    Returns a dictionary mapping each playlist's resource id to its database id.
     """
 
+    expiration_date = make_expiration_date()
+    rows = []
     for playlist in playlists['items']:
-        newPlaylist = Playlist(
-                user_id = user.id,
-                resource_id = playlist['id'],
-                title = playlist['snippet']['title'],
-                thumbnail = playlist['snippet']['thumbnails']['default']['url'],
-                privacy_status = playlist['status']['privacyStatus'],
-                expiration_date = make_expiration_date()
-                )
-        db.session.add(newPlaylist)
+        rows.append({
+                'user_id' : user.id,
+                'resource_id' : playlist['id'],
+                'title' : playlist['snippet']['title'],
+                'thumbnail' : playlist['snippet']['thumbnails']['default']['url'],
+                'privacy_status' : playlist['status']['privacyStatus'],
+                'expiration_date' : expiration_date
+                })
+    ids = dict(upsert_rows(Playlist, rows, ['user_id', 'resource_id'], (Playlist.resource_id, Playlist.id)))
+
+    # Unchanged rows are not returned, so their ids are read back in one query
+    missing = [row['resource_id'] for row in rows if row['resource_id'] not in ids]
+    if missing:
+        ids.update(db.session.query(Playlist.resource_id, Playlist.id)
+                .filter(Playlist.user_id == user.id)
+                .filter(Playlist.resource_id.in_(missing)))
     db.session.commit()
 
-    return
+    return ids
 
 def save_playlist_items(playlist_items, dbPlaylistId):
     """
     Saves playlist items data from YouTube API response to database
     """
-    for video in playlist_items['items']:
-        newVid = PlaylistVideo(
-                playlist_id = dbPlaylistId,
-                video_id = video['snippet']['resourceId']['videoId']
-                )
-        db.session.add(newVid)
+
+    rows = []
+    for index, video in enumerate(playlist_items['items']):
+        rows.append({
+                'playlist_id' : dbPlaylistId,
+                'video_id' : video['snippet']['resourceId']['videoId'],
+                'position' : video['snippet'].get('position', index)
+                })
+    upsert_rows(PlaylistVideo, rows, ['playlist_id', 'video_id', 'position'])
+
+    # Drop videos that used to sit at these positions
+    if rows:
+        PlaylistVideo.query.filter_by(playlist_id=dbPlaylistId).filter(
+                PlaylistVideo.position.in_([row['position'] for row in rows])).filter(
+                ~tuple_(PlaylistVideo.video_id, PlaylistVideo.position).in_([(row['video_id'], row['position']) for row in rows])).delete(
+                synchronize_session=False)
     db.session.commit()
 
     return
 
-def import_playlists(user):
+class DetachedUser():
+    """Stands in for a user in threads without a database session, carrying only its id."""
+
+    def __init__(self, user_id):
+        self.id = user_id
+
+def fetch_playlist_items(user, credentials, playlist_id, first_page, etags=None):
     """
-    Gets and saves playlists and playlist items
+    Fetches the remaining pages of a playlist, run in a thread without database access
+
+    Returns the playlist id, every page including the first, and the seconds spent.
     """
 
-    # Gets playlists from API
-    playlists = get_playlists(user)
+    start = time.time()
+    get_service(user, credentials)
+    pages = [first_page]
+    pages.extend(get_playlist_items(user, playlist_id, first_page['nextPageToken'], etags))
 
-    # Saves playlists to database
-    save_playlists(playlists, user)
+    return playlist_id, pages, time.time() - start
 
-    # Iterates over playlist object to save playlist items to appropriate playlist in database
-    for playlist in playlists['items']:
+def save_playlist_pages(user, playlist_id, dbPlaylistId, pages):
+    """
+    Saves the changed pages of a playlist's contents, and their ETags, skipping unchanged ones
 
-        # Get matching playlist in database
-        playlist_id = playlist['id']
-        dbPlaylist = Playlist.query.filter_by(resource_id=playlist_id).first_or_404()
+    Returns the number of items on all pages.
+    """
 
-        # Gets playlist items from API
-        playlist_items = get_playlist_items(user, playlist_id)
+    changed = [page for page in pages if not page.get('notModified')]
+    if changed:
+        save_playlist_items({'items': [item for page in changed for item in page['items']]}, dbPlaylistId)
 
-        # Saves playlist items to database
-        save_playlist_items(playlist_items, dbPlaylist.id)
+        # Drop videos past the end of a playlist that got shorter
+        total = pages[0].get('pageInfo', {}).get('totalResults')
+        if total is not None:
+            PlaylistVideo.query.filter_by(playlist_id=dbPlaylistId).filter(PlaylistVideo.position >= total).delete(synchronize_session=False)
+        save_etags(user, 'playlistItems:' + playlist_id, changed)
 
-    return
+    return sum(map(page_count, pages))
 
-def get_liked_videos(user, page=None):
+def import_playlists(user, progress=None, failures=None):
     """
-    Authenticated API request to get user's liked videos
+    Gets and saves playlists and playlist items page by page
+
+    Playlists with more than one page of contents are fetched concurrently by
+    PLAYLIST_FETCH_WORKERS threads, while this thread does every database write.
+    Pages of contents that have not changed since the last import are skipped.
+    Playlists whose contents cannot be fetched are added to failures.
+    Returns the seconds spent fetching each playlist.
     """
 
-    # Get credentials
     credentials = get_credentials(user.id)
+    etags = load_etags(user)
+    timings = {}
+
+    # Commits here expire the user, which fetch threads must not reload through this thread's session
+    detached = DetachedUser(user.id)
+    with ThreadPoolExecutor(max_workers=PLAYLIST_FETCH_WORKERS) as pool:
+
+        # Saves each page of playlists to database as it arrives
+        for index, playlists in enumerate(get_playlists(user)):
+            dbPlaylistIds = save_playlists(playlists, user)
+            report_progress(progress, len(playlists['items']), page_total(playlists, index == 0))
+
+            # Fetches the first page of every playlist on this page in one batch
+            playlist_ids = [playlist['id'] for playlist in playlists['items']]
+            first_etags = {}
+            for playlist_id in playlist_ids:
+                etag = etags.get('playlistItems:' + playlist_id, {}).get('')
+                if etag is not None:
+                    first_etags[playlist_id] = etag
+            start = time.time()
+            first_pages = get_first_playlist_items(user, playlist_ids, first_etags)
+            batch_time = time.time() - start
+
+            # Saves single page playlists now and hands longer ones to the pool
+            futures = {}
+            for playlist_id in playlist_ids:
+                playlist_items, exception = first_pages[playlist_id]
+                if exception is not None:
+                    report_failure(failures, 'playlist ' + playlist_id, exception)
+                    continue
+                report_progress(progress, 0, page_total(playlist_items, True))
+                if 'nextPageToken' in playlist_items:
+                    future = pool.submit(fetch_playlist_items, detached, credentials, playlist_id, playlist_items,
+                        etags.get('playlistItems:' + playlist_id))
+                    futures[future] = playlist_id
+                else:
+                    timings[playlist_id] = batch_time
+                    saved = save_playlist_pages(user, playlist_id, dbPlaylistIds[playlist_id], [playlist_items])
+                    report_progress(progress, saved)
+
+            # Saves each longer playlist in one transaction as its fetch finishes
+            for future in as_completed(futures):
+                try:
+                    playlist_id, pages, seconds = future.result()
+                except API_ERRORS as exception:
+                    report_failure(failures, 'playlist ' + futures[future], exception)
+                    continue
+                timings[playlist_id] = batch_time + seconds
+                saved = save_playlist_pages(user, playlist_id, dbPlaylistIds[playlist_id], pages)
+                report_progress(progress, saved)
+
+    # Log the slowest playlists so the long tail is visible
+    for playlist_id, seconds in sorted(timings.items(), key=lambda timing: timing[1], reverse=True)[:10]:
+        logger.info('Fetched playlist %s in %.2fs', playlist_id, seconds)
+
+    return timings
+
+def get_liked_videos(user, page=None, etags=None, role=SOURCE):
+    """
+    Authenticated API request to get user's liked videos, one page at a time
+    """
 
-    # Build the service object
-    youtube = googleapiclient.discovery.build(
-            api_service_name, api_version, credentials=credentials, cache_discovery=False)
-
-    # Request parameters
-    request = youtube.videos().list(
+    return paginate(
+            user,
+            'videos',
+            page=page,
+            etags=etags,
+            role=role,
             part="snippet",
             myRating="like",
-            maxResults=50,
-            pageToken=page
+            fields="etag,nextPageToken,pageInfo/totalResults,items(id,snippet(title,channelTitle,thumbnails/default/url))"
             )
 
-    # Recursive requests append to original response object until no data left
-    response = request.execute()
-    if 'nextPageToken' in response:
-        pageToken = response['nextPageToken']
-        newResponse = get_liked_videos(user, pageToken)
-        response['items'].extend(newResponse['items'])
-
-    return response
-
 def save_liked_videos(liked_videos, user):
     """
     Saves liked videos data from YouTube API response to database
     """
 
+    expiration_date = make_expiration_date()
+    rows = []
     for video in liked_videos['items']:
-        newVid = LikedVideo(
-                user_id = user.id,
-                video_id = video['id'],
-                title = video['snippet']['title'],
-                channel_title = video['snippet']['channelTitle'],
-                thumbnail = video['snippet']['thumbnails']['default']['url'],
-                expiration_date = make_expiration_date()
-                )
-        db.session.add(newVid)
+        rows.append({
+                'user_id' : user.id,
+                'video_id' : video['id'],
+                'title' : video['snippet']['title'],
+                'channel_title' : video['snippet']['channelTitle'],
+                'thumbnail' : video['snippet']['thumbnails']['default']['url'],
+                'expiration_date' : expiration_date
+                })
+    upsert_rows(LikedVideo, rows, ['user_id', 'video_id'])
     db.session.commit()
 
     return
 
-def import_liked_videos(user):
+def import_liked_videos(user, progress=None):
     """
     Combines functions to get liked videos from API and save to database
     """
 
-    likes = get_liked_videos(user)
-    save_liked_videos(likes, user)
+    # Saves each changed page to database as it arrives
+    unchanged = False
+    for index, likes in enumerate(get_liked_videos(user, etags=load_etags(user).get('videos'))):
+        if likes.get('notModified'):
+            unchanged = True
+        else:
+            save_liked_videos(likes, user)
+            save_etags(user, 'videos', [likes])
+        report_progress(progress, page_count(likes), page_total(likes, index == 0))
+
+    # Rows on unchanged pages still need a new expiration date
+    if unchanged:
+        refresh_expiration(LikedVideo, user)
 
     return
 
-def get_subscriptions(user, page=None):
+def get_subscriptions(user, page=None, etags=None, role=SOURCE):
     """
-    Authenticated API request to get user's subscriptions
+    Authenticated API request to get user's subscriptions, one page at a time
     """
 
-    # Get credentials
-    credentials = get_credentials(user.id)
-
-    # Build the service object
-    youtube = googleapiclient.discovery.build(
-            api_service_name, api_version, credentials=credentials, cache_discovery=False)
-
-    # Request parameters
-    request = youtube.subscriptions().list(
+    return paginate(
+            user,
+            'subscriptions',
+            page=page,
+            etags=etags,
+            role=role,
             part="snippet",
             mine=True,
-            maxResults=50,
             order='alphabetical',
-            pageToken=page
+            fields="etag,nextPageToken,pageInfo/totalResults,items/snippet(title,resourceId/channelId,thumbnails/default/url)"
             )
 
-    # Recursive requests append to original response object until no data left
-    response = request.execute()
-    if 'nextPageToken' in response:
-        pageToken = response['nextPageToken']
-        newResponse = get_subscriptions(user, pageToken)
-        response['items'].extend(newResponse['items'])
-
-    return response
-
 def save_subscriptions(subscriptions, user):
     """
     Saves subscriptions data from YouTube API response to database
     """
 
+    expiration_date = make_expiration_date()
+    rows = []
     for sub in subscriptions['items']:
-        newSub = Subscription(
-                user_id = user.id,
-                channel_id = sub['snippet']['resourceId']['channelId'],
-                title = sub['snippet']['title'],
-                thumbnail = sub['snippet']['thumbnails']['default']['url'],
-                expiration_date = make_expiration_date()
-                )
-        db.session.add(newSub)
+        rows.append({
+                'user_id' : user.id,
+                'channel_id' : sub['snippet']['resourceId']['channelId'],
+                'title' : sub['snippet']['title'],
+                'thumbnail' : sub['snippet']['thumbnails']['default']['url'],
+                'expiration_date' : expiration_date
+                })
+    upsert_rows(Subscription, rows, ['user_id', 'channel_id'])
     db.session.commit()
 
     return
 
-def import_subscriptions(user):
+def import_subscriptions(user, progress=None):
     """
     Combines functions to get subscriptions from API and save to database
     """
 
-    subs = get_subscriptions(user)
-    save_subscriptions(subs, user)
+    # Saves each changed page to database as it arrives
+    unchanged = False
+    for index, subs in enumerate(get_subscriptions(user, etags=load_etags(user).get('subscriptions'))):
+        if subs.get('notModified'):
+            unchanged = True
+        else:
+            save_subscriptions(subs, user)
+            save_etags(user, 'subscriptions', [subs])
+        report_progress(progress, page_count(subs), page_total(subs, index == 0))
+
+    # Rows on unchanged pages still need a new expiration date
+    if unchanged:
+        refresh_expiration(Subscription, user)
 
     return
 
+import_estimates = {}
+import_estimates_lock = threading.Lock()
+
+def cached_import_estimate(user):
+    """
+    Returns the estimate of importing every category, reusing one made in the
+    last IMPORT_ESTIMATE_MAX_AGE seconds
+
+    Estimating pages through all of the user's playlists, so opening the
+    import dialog again neither spends quota nor holds a request thread.
+    """
+
+    now = time.time()
+    with import_estimates_lock:
+        cached = import_estimates.get(user.id)
+    if cached is not None and cached[1] > now:
+        return cached[0]
+
+    estimate = estimate_import(user)
+    with import_estimates_lock:
+        # Only users who asked recently stay in the cache
+        for user_id in [k for k, (_, expires) in import_estimates.items() if expires <= now]:
+            del import_estimates[user_id]
+        import_estimates[user.id] = (estimate, now + IMPORT_ESTIMATE_MAX_AGE)
+
+    return estimate
+
+def estimate_import(user, categories=('subscriptions', 'likedVideos', 'playlists')):
+    """
+    Predicts the quota units importing each of the given categories will spend
+
+    Uses the totals reported by one item list requests, and every playlist's
+    item count, so the estimate itself costs a few units.
+    """
+
+    estimate = {}
+
+    # One page per 50 liked videos, and per 50 subscriptions
+    for category in ('likedVideos', 'subscriptions'):
+        if category in categories:
+            estimate[category] = quota.estimate_pages(count_items(user, category))
+
+    # One page per 50 playlists, plus one page per 50 videos in each playlist
+    if 'playlists' not in categories:
+        return estimate
+    estimate['playlists'] = 0
+    for playlists in paginate(user, 'playlists', part="contentDetails", mine=True, fields="nextPageToken,items/contentDetails/itemCount"):
+        estimate['playlists'] += 1
+        for playlist in playlists['items']:
+            estimate['playlists'] += quota.estimate_pages(playlist['contentDetails']['itemCount'])
+
+    return estimate
+
+def count_items(user, category, role=SOURCE):
+    """
+    Returns how many liked videos or subscriptions the user's account in role has, for one quota unit
+    """
+
+    youtube = get_service(user, role=role)
+    if category == 'likedVideos':
+        request = youtube.videos().list(part="id", myRating="like", maxResults=1, fields="pageInfo/totalResults")
+    else:
+        request = youtube.subscriptions().list(part="id", mine=True, maxResults=1, fields="pageInfo/totalResults")
+
+    return execute(user, request).get('pageInfo', {}).get('totalResults', 0)
 
 def get_access_token(code, state):
     """
@@ -345,89 +1381,137 @@ def get_access_token(code, state):
     # Credentials are saved to service object
     return flow.credentials
 
-def save_credentials(response, user):
+def account_id(credentials):
+    """
+    Returns the Google account id credentials belong to, from their OpenID token
+
+    The token came straight from Google's token endpoint, so its signature is
+    not checked again.
+    """
+
+    id_token = getattr(credentials, 'id_token', None)
+    if not id_token:
+        return None
+
+    return jwt.decode(id_token, verify=False).get('sub')
+
+def save_credentials(response, user, role=SOURCE):
     """
-    Saves credentials to database for user
+    Saves credentials to database for the user's account in role
     """
 
     # Overwrite credentials if already exist
     try:
-        creds = Credential.query.filter_by(user_id=user.id).first_or_404()
+        creds = Credential.query.filter_by(user_id=user.id, role=role).first_or_404()
         creds.token = response.token
         creds.refresh_token = response.refresh_token
+        creds.expiry = expiry_timestamp(response.expiry)
+        creds.account = account_id(response)
 
     # Save credentials to database
     except:
         newCreds = Credential(
                 user_id = user.id,
+                role = role,
                 token = response.token,
-                refresh_token = response.refresh_token
+                refresh_token = response.refresh_token,
+                expiry = expiry_timestamp(response.expiry),
+                account = account_id(response)
                 )
         db.session.add(newCreds)
     db.session.commit()
 
+    # Stop using service objects built with the old credentials
+    forget_services(user.id)
+
     return
 
-def export_subscription(channel, user):
+def subscription_request(youtube, channel_id):
     """
-    Authenticated API request to subscribe to a channel
+    Builds a request to subscribe to a channel
     """
 
-    # Get credentials
-    credentials = get_credentials(user.id)
-
-    # Build the service object
-    youtube = googleapiclient.discovery.build(
-            api_service_name, api_version, credentials=credentials, cache_discovery=False)
-
-    # Request parameters
     request = youtube.subscriptions().insert(
             part="snippet",
             body={
                 "snippet": {
                     "resourceId": {
                         "kind": "youtube#channel",
-                        "channelId": channel.channel_id
+                        "channelId": channel_id
                         }
                     }
                 }
             )
-    request.execute()
+
+    return request
+
+def export_subscription(channel, user):
+    """
+    Authenticated API request to subscribe to a channel
+    """
+
+    # Get the service object
+    youtube = get_service(user)
+
+    # Request parameters
+    request = subscription_request(youtube, channel.channel_id)
+    execute(user, request)
      
     return
 
-def export_rating(video, user):
+def export_subscriptions(channels, user, progress=None, role=SOURCE):
     """
-    Authenticated API request to upvote a single video
+    Batched API requests to subscribe to channels, keyed by channel id
     """
 
-    # Get credentials
-    credentials = get_credentials(user.id)
+    youtube = get_service(user, role=role)
+    calls = [(channel.channel_id, subscription_request(youtube, channel.channel_id)) for channel in channels]
 
-    # Build the service object
-    youtube = googleapiclient.discovery.build(
-            api_service_name, api_version, credentials=credentials, cache_discovery=False)
+    return execute_batch(user, calls, progress, role)
+
+def rating_request(youtube, video_id):
+    """
+    Builds a request to upvote a single video
+    """
 
-    # Request parameters
     request = youtube.videos().rate(
-            id=video.video_id,
+            id=video_id,
             rating="like"
             )
-    request.execute()
+
+    return request
+
+def export_rating(video, user):
+    """
+    Authenticated API request to upvote a single video
+    """
+
+    # Get the service object
+    youtube = get_service(user)
+
+    # Request parameters
+    request = rating_request(youtube, video.video_id)
+    execute(user, request)
 
     return
 
-def export_playlist(playlist, user):
+def export_ratings(videos, user, progress=None, role=SOURCE):
     """
-    Authenticated API request to create a single playlist
+    Batched API requests to upvote videos, keyed by video id
     """
 
-    # Get credentials
-    credentials = get_credentials(user.id)
+    youtube = get_service(user, role=role)
+    calls = [(video.video_id, rating_request(youtube, video.video_id)) for video in videos]
 
-    # Build the service object
-    youtube = googleapiclient.discovery.build(
-            api_service_name, api_version, credentials=credentials, cache_discovery=False)
+    return execute_batch(user, calls, progress, role)
+
+def export_playlist(playlist, user, role=SOURCE):
+    """
+    Authenticated API request to create a single playlist
+    """
+
+    # Get the service object
+    youtube = get_service(user, role=role)
 
     # Request parameters
     request = youtube.playlists().insert(
@@ -441,22 +1525,15 @@ def export_playlist(playlist, user):
                     }
                 }
             )
-    response = request.execute()
+    response = execute(user, request)
 
     return response
 
-def export_playlist_vid(videoId, playlistId, user):
+def playlist_vid_request(youtube, videoId, playlistId):
     """
-    Authenticated API request to add a single video to a playlist
+    Builds a request to add a single video to a playlist
     """
-    # Get credentials
-    credentials = get_credentials(user.id)
-
-    # Build the service object
-    youtube = googleapiclient.discovery.build(
-            api_service_name, api_version, credentials=credentials, cache_discovery=False)
 
-    # Request parameters
     request = youtube.playlistItems().insert(
             part="snippet",
             body={
@@ -469,6 +1546,41 @@ def export_playlist_vid(videoId, playlistId, user):
                     }
                 }
             )
-    request.execute()
+
+    return request
+
+def export_playlist_vid(videoId, playlistId, user):
+    """
+    Authenticated API request to add a single video to a playlist
+    """
+    # Get the service object
+    youtube = get_service(user)
+
+    # Request parameters
+    request = playlist_vid_request(youtube, videoId, playlistId)
+    execute(user, request)
 
     return
+
+def export_playlist_vids(videoIds, playlistId, user, progress=None, role=SOURCE):
+    """
+    API requests to add videos to a playlist, returning outcomes keyed by position in videoIds
+
+    Calls in a batch may run in any order, so each video is added only after
+    the one before it, keeping the target playlist in the source's order.
+    Outcomes are (response, exception) tuples as from execute_batch(), and a
+    FATAL error is raised straight away.
+    """
+
+    youtube = get_service(user, role=role)
+    results = {}
+    for position, videoId in enumerate(videoIds):
+        try:
+            results[position] = (execute(user, playlist_vid_request(youtube, videoId, playlistId)), None)
+        except API_ERRORS as exception:
+            if classify_error(exception) == FATAL:
+                raise
+            results[position] = (None, exception)
+    report_progress(progress, len(videoIds))
+
+    return results